@@ -0,0 +1,190 @@
+import json
+import time
+from array import array
+
+class ChangeJournal:
+    """
+    Append-only journal of attribute changes applied to CallGraph nodes.
+
+    Events are stored column-wise in compact arrays instead of inside the node
+    dictionaries, so the graph stays small and the history can be queried,
+    rolled back and persisted.
+    """
+
+    def __init__(self):
+        """
+        Initializes an empty ChangeJournal.
+        """
+        # Interned strings (node ids, source ids, field names)
+        self._symbols = []
+        self._symbol_ids = {}
+
+        # One entry per event, all columns have the same length
+        self._nodes = array("l")
+        self._sources = array("l")
+        self._fields = array("l")
+        self._timestamps = array("d")
+        self._existed = array("b")
+        self._old_values = []
+        self._new_values = []
+
+        # Per-node index of event positions for fast lookup
+        self._node_index = {}
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def _intern(self, symbol):
+        symbol_id = self._symbol_ids.get(symbol)
+        if symbol_id is None:
+            symbol_id = len(self._symbols)
+            self._symbols.append(symbol)
+            self._symbol_ids[symbol] = symbol_id
+        return symbol_id
+
+    def record(self, node_id, source_id, field, old, new, timestamp=None, existed=None):
+        """
+        Appends a change event to the journal.
+
+        :param node_id: The node whose attribute changed.
+        :param source_id: The node the change was propagated from.
+        :param field: The name of the changed attribute.
+        :param old: The value before the change (None if it was unset).
+        :param new: The value after the change.
+        :param timestamp: Time of the change (defaults to now).
+        :param existed: Whether the attribute was set before the change (defaults to old is not None).
+        :return: The position of the new event in the journal.
+        """
+        position = len(self._nodes)
+        node_symbol = self._intern(node_id)
+        self._nodes.append(node_symbol)
+        self._sources.append(self._intern(source_id))
+        self._fields.append(self._intern(field))
+        self._timestamps.append(time.time() if timestamp is None else timestamp)
+        self._existed.append(old is not None if existed is None else bool(existed))
+        self._old_values.append(old)
+        self._new_values.append(new)
+        self._node_index.setdefault(node_symbol, []).append(position)
+        return position
+
+    def _event(self, position):
+        return {
+            "node": self._symbols[self._nodes[position]],
+            "source": self._symbols[self._sources[position]],
+            "field": self._symbols[self._fields[position]],
+            "old": self._old_values[position],
+            "existed": bool(self._existed[position]),
+            "new": self._new_values[position],
+            "timestamp": self._timestamps[position],
+        }
+
+    def events(self, start=0):
+        """
+        Returns all events recorded from the given position onwards.
+
+        :param start: The first event position to return.
+        :return: A list of event dictionaries in recording order.
+        """
+        return [self._event(position) for position in range(start, len(self._nodes))]
+
+    def events_for(self, node_id):
+        """
+        Returns the events recorded for a single node.
+
+        :param node_id: The node to look up.
+        :return: A list of event dictionaries in recording order.
+        """
+        node_symbol = self._symbol_ids.get(node_id)
+        if node_symbol is None:
+            return []
+        return [self._event(position) for position in self._node_index.get(node_symbol, [])]
+
+    def snapshot(self):
+        """
+        Marks the current end of the journal.
+
+        :return: An opaque marker that can be passed to rollback().
+        """
+        return len(self._nodes)
+
+    def rollback(self, snapshot, graph=None):
+        """
+        Discards every event recorded after the snapshot.
+
+        If a graph is given, the old values of the discarded events are written
+        back to its nodes (newest first), undoing the propagation steps.
+
+        :param snapshot: A marker previously returned by snapshot().
+        :param graph: The CallGraph to restore, if any.
+        :return: The list of discarded events, newest first.
+        """
+        if snapshot < 0 or snapshot > len(self._nodes):
+            raise ValueError(f"Invalid journal snapshot: {snapshot}")
+
+        discarded = []
+        for position in range(len(self._nodes) - 1, snapshot - 1, -1):
+            event = self._event(position)
+            discarded.append(event)
+            if graph is not None and graph.has_node(event["node"]):
+                attributes = graph.nodes[event["node"]]
+                if event["existed"]:
+                    attributes[event["field"]] = event["old"]
+                else:
+                    attributes.pop(event["field"], None)
+            self._node_index[self._nodes[position]].pop()
+
+        del self._nodes[snapshot:]
+        del self._sources[snapshot:]
+        del self._fields[snapshot:]
+        del self._timestamps[snapshot:]
+        del self._existed[snapshot:]
+        del self._old_values[snapshot:]
+        del self._new_values[snapshot:]
+        return discarded
+
+    def save(self, path):
+        """
+        Serializes the journal to a JSON file.
+
+        :param path: The file to write.
+        """
+        with open(path, "w") as f:
+            json.dump(
+                {
+                    "symbols": self._symbols,
+                    "nodes": self._nodes.tolist(),
+                    "sources": self._sources.tolist(),
+                    "fields": self._fields.tolist(),
+                    "timestamps": self._timestamps.tolist(),
+                    "existed": self._existed.tolist(),
+                    "old": self._old_values,
+                    "new": self._new_values,
+                },
+                f,
+            )
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads a journal previously written with save().
+
+        :param path: The file to read.
+        :return: A ChangeJournal instance.
+        """
+        with open(path, "r") as f:
+            data = json.load(f)
+
+        journal = cls()
+        for symbol in data["symbols"]:
+            journal._intern(symbol)
+        journal._nodes.extend(data["nodes"])
+        journal._sources.extend(data["sources"])
+        journal._fields.extend(data["fields"])
+        journal._timestamps.extend(data["timestamps"])
+        # Journals saved before the flag was recorded treat None as unset
+        journal._existed.extend(data.get("existed", [old is not None for old in data["old"]]))
+        journal._old_values.extend(data["old"])
+        journal._new_values.extend(data["new"])
+        for position, node_symbol in enumerate(journal._nodes):
+            journal._node_index.setdefault(node_symbol, []).append(position)
+        return journal
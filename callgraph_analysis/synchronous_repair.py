@@ -1,18 +1,22 @@
 import networkx as nx
 
+from callgraph_analysis.change_journal import ChangeJournal
+
 class SynchronousRepair:
     """
     Handles the synchronous repair process in the CallGraph.
     Ensures modifications to one node are propagated to its related nodes and dependencies.
     """
 
-    def __init__(self, graph):
+    def __init__(self, graph, journal=None):
         """
         Initializes the SynchronousRepair class.
 
         :param graph: The CallGraph (a NetworkX DiGraph).
+        :param journal: The ChangeJournal recording applied updates (a new one is created if omitted).
         """
         self.graph = graph
+        self.journal = journal if journal is not None else ChangeJournal()
 
     def propagate_changes(self, modified_node):
         """
@@ -44,22 +48,47 @@ class SynchronousRepair:
 
         # Example: Update parameters or variable types
         if 'parameters' in source_attributes:
+            had_parameters = 'parameters' in target_attributes
             old_parameters = target_attributes.get('parameters', None)
             target_attributes['parameters'] = source_attributes['parameters']
+            self.journal.record(target_node, source_node, 'parameters', old_parameters, source_attributes['parameters'], existed=had_parameters)
             print(f"Updated parameters for {target_node}: {old_parameters} -> {source_attributes['parameters']}")
 
         # Example: Update dependent variable types
         if 'type' in source_attributes and source_attributes['type'] == 'variable':
+            had_type = 'type' in target_attributes
             old_type = target_attributes.get('type', None)
             target_attributes['type'] = source_attributes['type']
+            self.journal.record(target_node, source_node, 'type', old_type, source_attributes['type'], existed=had_type)
             print(f"Updated type for {target_node}: {old_type} -> {source_attributes['type']}")
 
-        # Propagate change logs to track updates
-        if 'change_log' in source_attributes:
-            if 'change_log' not in target_attributes:
-                target_attributes['change_log'] = []
-            target_attributes['change_log'].append(f"Updated due to changes in {source_node}")
-            print(f"Updated change log for {target_node}: {target_attributes['change_log']}")
+    def get_change_log(self, node):
+        """
+        Returns the recorded updates applied to a node.
+
+        :param node: The node to look up.
+        :return: A list of change events, oldest first.
+        """
+        return self.journal.events_for(node)
+
+    def snapshot(self):
+        """
+        Marks the current propagation state so it can be rolled back later.
+
+        :return: A journal snapshot marker.
+        """
+        return self.journal.snapshot()
+
+    def rollback(self, snapshot):
+        """
+        Undoes all updates applied since the given snapshot.
+
+        :param snapshot: A marker returned by snapshot().
+        :return: The list of undone change events, newest first.
+        """
+        undone = self.journal.rollback(snapshot, self.graph)
+        print(f"Rolled back {len(undone)} updates.")
+        return undone
 
     def validate_propagation(self, modified_node):
         """
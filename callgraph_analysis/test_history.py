@@ -0,0 +1,152 @@
+import sqlite3
+import subprocess
+import time
+
+class TestHistory:
+    """
+    Persists per-test durations and outcomes in a local SQLite database, so that
+    validations can be scheduled from past runs.
+    """
+
+    # Not a test class, keep pytest from collecting it
+    __test__ = False
+
+    def __init__(self, db_path="test_history.db", window=20):
+        """
+        Initializes the TestHistory class.
+
+        :param db_path: The SQLite database file.
+        :param window: Number of most recent runs per test used for statistics.
+        """
+        self.db_path = db_path
+        self.window = window
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS test_runs (
+                repo TEXT NOT NULL,
+                commit_sha TEXT NOT NULL,
+                test_id TEXT NOT NULL,
+                outcome TEXT NOT NULL,
+                duration REAL NOT NULL,
+                recorded_at REAL NOT NULL
+            )
+            """
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS test_runs_repo_test ON test_runs (repo, test_id, recorded_at)"
+        )
+        self.connection.commit()
+
+    @staticmethod
+    def current_commit(repo_dir):
+        """
+        Returns the checked out git commit of a repository.
+
+        :param repo_dir: A directory inside the repository.
+        :return: The commit SHA, or "unknown" if it cannot be determined.
+        """
+        try:
+            result = subprocess.run(
+                ["git", "rev-parse", "HEAD"],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                text=True,
+                cwd=repo_dir
+            )
+        except (FileNotFoundError, NotADirectoryError):
+            return "unknown"
+        return result.stdout.strip() if result.returncode == 0 else "unknown"
+
+    def record(self, repo, commit, results):
+        """
+        Stores the results of a test run.
+
+        :param repo: The repository the tests belong to.
+        :param commit: The commit the tests ran against.
+        :param results: A dictionary mapping test IDs to {"outcome": str, "duration": float}.
+        """
+        recorded_at = time.time()
+        self.connection.executemany(
+            "INSERT INTO test_runs VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (repo, commit, test_id, result["outcome"], result["duration"], recorded_at)
+                for test_id, result in results.items()
+            ],
+        )
+        self.connection.commit()
+
+    def _recent_runs(self, repo):
+        rows = self.connection.execute(
+            "SELECT test_id, commit_sha, outcome, duration FROM test_runs WHERE repo = ? ORDER BY recorded_at DESC",
+            (repo,),
+        )
+        runs = {}
+        for test_id, commit, outcome, duration in rows:
+            test_runs = runs.setdefault(test_id, [])
+            if len(test_runs) < self.window:
+                test_runs.append((commit, outcome, duration))
+        return runs
+
+    def durations(self, repo):
+        """
+        Returns the average recent duration of every known test.
+
+        :param repo: The repository the tests belong to.
+        :return: A dictionary mapping test IDs to durations in seconds.
+        """
+        return {
+            test_id: sum(run[2] for run in runs) / len(runs)
+            for test_id, runs in self._recent_runs(repo).items()
+        }
+
+    def failure_rates(self, repo):
+        """
+        Returns the recent failure rate of every known test.
+
+        :param repo: The repository the tests belong to.
+        :return: A dictionary mapping test IDs to the fraction of failed or errored runs.
+        """
+        return {
+            test_id: sum(run[1] in ("failed", "error") for run in runs) / len(runs)
+            for test_id, runs in self._recent_runs(repo).items()
+        }
+
+    def flaky_tests(self, repo):
+        """
+        Returns the tests that both passed and failed on the same commit.
+
+        :param repo: The repository the tests belong to.
+        :return: A set of flaky test IDs.
+        """
+        flaky = set()
+        for test_id, runs in self._recent_runs(repo).items():
+            outcomes_by_commit = {}
+            for commit, outcome, _ in runs:
+                outcomes_by_commit.setdefault(commit, set()).add(outcome)
+            for outcomes in outcomes_by_commit.values():
+                if "passed" in outcomes and outcomes & {"failed", "error"}:
+                    flaky.add(test_id)
+                    break
+        return flaky
+
+    def order(self, repo, test_ids):
+        """
+        Orders tests fail-fast: historically failing tests first, then longest first.
+
+        :param repo: The repository the tests belong to.
+        :param test_ids: The test IDs to order.
+        :return: The ordered list of test IDs.
+        """
+        failure_rates = self.failure_rates(repo)
+        durations = self.durations(repo)
+        return sorted(
+            test_ids,
+            key=lambda test_id: (-failure_rates.get(test_id, 0.0), -durations.get(test_id, 0.0)),
+        )
+
+    def close(self):
+        """
+        Closes the database connection.
+        """
+        self.connection.close()
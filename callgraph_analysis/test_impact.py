@@ -0,0 +1,179 @@
+import os
+
+class TestImpactAnalysis:
+    """
+    Maps test functions in the CallGraph to the production nodes they reach, so that
+    only the tests affected by a change need to be executed.
+
+    The CallGraph records name usages per file, so reach is computed per test
+    module and shared by every test function of that module.
+    """
+
+    # Not a test class, keep pytest from collecting it
+    __test__ = False
+
+    def __init__(self, graph):
+        """
+        Initializes the TestImpactAnalysis class.
+
+        :param graph: The CallGraph (a NetworkX DiGraph) built by create_graph.
+        """
+        self.graph = graph
+        self._definitions = None
+        self._modules = None
+        self._file_usages = None
+        self._reach = None
+
+    @staticmethod
+    def is_test_file(file_node):
+        """
+        Checks whether a file node belongs to a test module.
+
+        :param file_node: The file node in the CallGraph.
+        :return: True if the file is a test module, False otherwise.
+        """
+        filename = os.path.basename(file_node)
+        return filename.endswith(".py") and (filename.startswith("test_") or filename.endswith("_test.py"))
+
+    @staticmethod
+    def split_node(node):
+        """
+        Splits a CallGraph node into its file node and the remaining name parts.
+        """
+        file_node, _, rest = node.partition(".py:")
+        if not rest:
+            return node, []
+        return file_node + ".py", rest.split(":")
+
+    def _index(self):
+        """
+        Indexes definitions and modules by name and usages by file.
+
+        A module is indexed under its file name without ".py" and a package under
+        its directory name, so that `import calc` followed by `calc.add(...)`
+        (a usage of `calc`) reaches the whole module.
+        """
+        self._definitions = {}
+        self._modules = {}
+        self._file_usages = {}
+        for node in self.graph.nodes:
+            file_node, parts = self.split_node(node)
+            if not parts:
+                if node.endswith(".py"):
+                    module_name = os.path.basename(node)[: -len(".py")]
+                    if module_name != "__init__":
+                        self._modules.setdefault(module_name, set()).add(node)
+                    package_name = os.path.basename(os.path.dirname(node))
+                    if package_name:
+                        self._modules.setdefault(package_name, set()).add(node)
+                continue
+            name = parts[0]
+            if name.endswith("_usage"):
+                self._file_usages.setdefault(file_node, set()).add(name[: -len("_usage")])
+                continue
+            if name.endswith("_def"):
+                name = name[: -len("_def")]
+            elif len(parts) > 1:
+                name = parts[-1]
+            self._definitions.setdefault(name, set()).add(node)
+
+    def _with_members(self, node):
+        """
+        Returns the node together with the members it contains (e.g. methods of a class).
+        """
+        members = {node}
+        stack = [node]
+        while stack:
+            current = stack.pop()
+            if not self.graph.has_node(current):
+                continue
+            for successor in self.graph.successors(current):
+                if successor.startswith(current + ":") and successor not in members:
+                    members.add(successor)
+                    stack.append(successor)
+        return members
+
+    def test_nodes(self):
+        """
+        Lists the test functions and test methods in the CallGraph.
+
+        :return: A list of test nodes.
+        """
+        candidates = []
+        methods = set()
+        for node in self.graph.nodes:
+            file_node, parts = self.split_node(node)
+            if not parts or not self.is_test_file(file_node):
+                continue
+            if len(parts) == 2:
+                methods.add((file_node, parts[1]))
+            if parts[-1].startswith("test"):
+                candidates.append((node, file_node, parts))
+
+        # ClassFunctionVisitor also lists methods as top-level definitions, skip those duplicates
+        return [
+            node
+            for node, file_node, parts in candidates
+            if len(parts) > 1 or (file_node, parts[0]) not in methods
+        ]
+
+    def reach(self):
+        """
+        Computes the production nodes reached by every test node.
+
+        A test reaches the production definitions and modules whose names are
+        used in its module, and transitively everything those modules use. All
+        the tests of a module share the same reach.
+
+        :return: A dictionary mapping each test node to a set of production nodes.
+        """
+        if self._reach is not None:
+            return self._reach
+        if self._definitions is None:
+            self._index()
+
+        file_reach = {}
+        self._reach = {}
+        for test_node in self.test_nodes():
+            test_file, _ = self.split_node(test_node)
+            if test_file not in file_reach:
+                file_reach[test_file] = self._reach_from_file(test_file)
+            self._reach[test_node] = file_reach[test_file]
+        return self._reach
+
+    def _reach_from_file(self, start_file):
+        reached = set()
+        visited_files = {start_file}
+        queue = [start_file]
+        while queue:
+            file_node = queue.pop(0)
+            for name in self._file_usages.get(file_node, ()):
+                # module imports are used as e.g. `calc.add(...)`
+                definitions = self._definitions.get(name, set()) | self._modules.get(name, set())
+                for definition in definitions:
+                    definition_file, _ = self.split_node(definition)
+                    if self.is_test_file(definition_file):
+                        continue
+                    reached.update(self._with_members(definition))
+                    if definition_file not in visited_files:
+                        visited_files.add(definition_file)
+                        queue.append(definition_file)
+        return reached
+
+    def affected_tests(self, changed_nodes):
+        """
+        Selects the tests whose reach intersects the changed nodes.
+
+        :param changed_nodes: CallGraph nodes modified by a repair (files, classes, functions or variables).
+        :return: A sorted list of affected test nodes.
+        """
+        changed = set()
+        for node in changed_nodes:
+            changed.update(self._with_members(node))
+
+        affected = []
+        for test_node, reached in self.reach().items():
+            test_file, _ = self.split_node(test_node)
+            if test_file in changed or test_node in changed or not reached.isdisjoint(changed):
+                affected.append(test_node)
+        return sorted(affected)
@@ -0,0 +1,210 @@
+import importlib.util
+import os
+import re
+import signal
+import subprocess
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# Matches the per-test lines printed by pytest -v, e.g. "test_a.py::test_b PASSED [ 50%]"
+RESULT_LINE = re.compile(r"^(\S+::\S+) (PASSED|FAILED|ERROR|SKIPPED|XFAIL|XPASS)\b")
+
+# Marks the end of collection, e.g. "collected 3 items" or "collecting ... collected 1 item"
+TESTS_STARTED = re.compile(r"\bcollected \d+ items?\b")
+
+class RunLimits:
+    """
+    Timeouts, resource caps and early-stop state shared by all processes of one validation run.
+    """
+
+    def __init__(self, timeout=None, per_test_timeout=None, memory_limit_mb=None, cpu_limit=None, maxfail=None):
+        """
+        Initializes the RunLimits class.
+
+        :param timeout: Wall-clock limit for the whole run in seconds.
+        :param per_test_timeout: Limit for a single test in seconds.
+        :param memory_limit_mb: Address space cap per test process in megabytes (RLIMIT_AS).
+        :param cpu_limit: CPU time cap per test process in seconds (RLIMIT_CPU).
+        :param maxfail: Stop the run once this many tests have failed.
+        """
+        self.timeout = timeout
+        self.per_test_timeout = per_test_timeout
+        self.memory_limit_mb = memory_limit_mb
+        self.cpu_limit = cpu_limit
+        self.maxfail = maxfail
+        self.deadline = time.time() + timeout if timeout else None
+        self.failures = 0
+        self.stop_event = threading.Event()
+        self._lock = threading.Lock()
+
+    def pytest_args(self):
+        """
+        Returns the pytest options enforcing the limits pytest can handle itself.
+
+        Per-test timeouts use the pytest-timeout plugin when it is installed;
+        otherwise they are enforced by killing a run that prints nothing for
+        longer than the limit once collection has finished. Collection itself
+        is only bounded by the run's timeout.
+        """
+        args = ["-v"]
+        if self.maxfail:
+            args.append(f"--maxfail={self.maxfail}")
+        if self.per_test_timeout and importlib.util.find_spec("pytest_timeout") is not None:
+            args.append(f"--timeout={self.per_test_timeout}")
+        return args
+
+    def remaining(self):
+        """
+        Returns the seconds left until the run's deadline, or None without a timeout.
+        """
+        if self.deadline is None:
+            return None
+        return max(self.deadline - time.time(), 0.0)
+
+    def rlimits(self):
+        """
+        Returns the RLIMIT caps as (resource, (soft, hard)) pairs.
+        """
+        rlimits = []
+        if resource is None:
+            return rlimits
+        if self.memory_limit_mb:
+            limit = int(self.memory_limit_mb) * 1024 * 1024
+            rlimits.append((resource.RLIMIT_AS, (limit, limit)))
+        if self.cpu_limit:
+            rlimits.append((resource.RLIMIT_CPU, (int(self.cpu_limit), int(self.cpu_limit))))
+        return rlimits
+
+    def apply_rlimits(self, pid=None):
+        """
+        Applies the RLIMIT caps to a running process, or to the current one if pid is None.
+        """
+        for which, limit in self.rlimits():
+            if pid is None:
+                resource.setrlimit(which, limit)
+            else:
+                resource.prlimit(pid, which, limit)
+
+    def preexec(self):
+        """
+        Returns a function applying the RLIMIT caps in the child process before
+        it executes the command, or None without caps.
+
+        The function only calls resource.setrlimit, which takes no locks and
+        imports nothing, so it is safe to run after a fork from a threaded parent.
+        """
+        if not self.rlimits():
+            return None
+        return self.apply_rlimits
+
+    def record_outcome(self, outcome):
+        """
+        Counts a test outcome and signals the early stop once the verdict is known.
+        """
+        if outcome not in ("FAILED", "ERROR"):
+            return
+        with self._lock:
+            self.failures += 1
+            if self.maxfail and self.failures >= self.maxfail:
+                self.stop_event.set()
+
+def _read_lines(stream, lines, on_line):
+    for line in iter(stream.readline, ""):
+        lines.append(line)
+        on_line(line)
+    stream.close()
+
+def _kill(process):
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        process.kill()
+
+def run_with_limits(command, limits, cwd=None, log_file=None):
+    """
+    Runs a pytest command while enforcing the given limits.
+
+    Output is streamed line by line (to log_file if given), so the per-test
+    results printed so far are available even when the run is killed.
+
+    :param command: The command to run.
+    :param limits: The RunLimits of the current validation run.
+    :param cwd: The working directory of the command.
+    :param log_file: An open file receiving stdout and stderr (optional).
+    :return: A dictionary with returncode, stdout, stderr, results, timed_out and stopped_early.
+    """
+    popen_args = dict(
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        cwd=cwd,
+        start_new_session=True
+    )
+    try:
+        process = subprocess.Popen(command, preexec_fn=limits.preexec(), **popen_args)
+    except RuntimeError:
+        # preexec_fn is not supported in subinterpreters, cap the child once it runs
+        process = subprocess.Popen(command, **popen_args)
+        if limits.rlimits() and hasattr(resource, "prlimit"):
+            try:
+                limits.apply_rlimits(process.pid)
+            except ProcessLookupError:
+                # Already exited
+                pass
+
+    stdout_lines, stderr_lines = [], []
+    results = {}
+    # The per-test clock starts once collection has finished
+    last_output = [None]
+    write_lock = threading.Lock()
+
+    def _on_line(line):
+        if last_output[0] is not None or TESTS_STARTED.search(line):
+            last_output[0] = time.time()
+        if log_file is not None:
+            with write_lock:
+                log_file.write(line)
+                log_file.flush()
+        match = RESULT_LINE.match(line)
+        if match:
+            results[match.group(1)] = {"outcome": match.group(2).lower(), "duration": None}
+            limits.record_outcome(match.group(2))
+
+    readers = [
+        threading.Thread(target=_read_lines, args=(process.stdout, stdout_lines, _on_line), daemon=True),
+        threading.Thread(target=_read_lines, args=(process.stderr, stderr_lines, _on_line), daemon=True),
+    ]
+    for reader in readers:
+        reader.start()
+
+    timed_out = stopped_early = False
+    while process.poll() is None:
+        now = time.time()
+        if limits.deadline is not None and now >= limits.deadline:
+            timed_out = True
+        elif limits.per_test_timeout and last_output[0] is not None and now - last_output[0] >= limits.per_test_timeout:
+            timed_out = True
+        elif limits.stop_event.is_set():
+            stopped_early = True
+        if timed_out or stopped_early:
+            _kill(process)
+            break
+        time.sleep(0.05)
+
+    process.wait()
+    for reader in readers:
+        reader.join(timeout=1)
+
+    return {
+        "returncode": process.returncode,
+        "stdout": "".join(stdout_lines),
+        "stderr": "".join(stderr_lines),
+        "results": results,
+        "timed_out": timed_out,
+        "stopped_early": stopped_early,
+    }
@@ -0,0 +1,126 @@
+import heapq
+import os
+import subprocess
+import xml.etree.ElementTree as ET
+
+def collect_test_ids(test_command, targets, rootdir, timeout=None):
+    """
+    Collects the pytest node IDs under the given targets without running them.
+
+    :param test_command: The pytest command.
+    :param targets: Test directories, files or node IDs to collect.
+    :param rootdir: The directory node IDs are made relative to; tests must later run from it.
+    :param timeout: Seconds after which the collection is killed (optional).
+    :return: A list of test node IDs.
+    :raises subprocess.TimeoutExpired: If the collection outlives the timeout.
+    """
+    result = subprocess.run(
+        [test_command, "--collect-only", "-q", f"--rootdir={rootdir}"] + [absolute_target(target) for target in targets],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        cwd=rootdir,
+        timeout=timeout
+    )
+    return [line.strip() for line in result.stdout.splitlines() if "::" in line]
+
+def absolute_target(target):
+    """
+    Makes the path part of a pytest target (a path or a node ID) absolute.
+
+    :param target: A test directory, file or node ID.
+    :return: The same target with an absolute path.
+    """
+    path, separator, rest = target.partition("::")
+    return os.path.abspath(path) + separator + rest
+
+def split_into_shards(test_ids, num_shards, durations=None, default_duration=None):
+    """
+    Splits tests into shards with balanced expected run time.
+
+    Tests are assigned longest-first to the currently shortest shard. Tests
+    without a recorded duration are assumed to take the average known duration.
+
+    :param test_ids: The test node IDs to split.
+    :param num_shards: The number of shards.
+    :param durations: A dictionary mapping test IDs to historical durations in seconds.
+    :param default_duration: The duration assumed for unknown tests.
+    :return: A list of non-empty shards, each a list of test IDs.
+    """
+    durations = durations or {}
+    if default_duration is None:
+        known = [durations[test_id] for test_id in test_ids if test_id in durations]
+        default_duration = sum(known) / len(known) if known else 1.0
+
+    num_shards = max(1, min(num_shards, len(test_ids)))
+    shards = [[] for _ in range(num_shards)]
+    heap = [(0.0, index) for index in range(num_shards)]
+    ordered = sorted(test_ids, key=lambda test_id: durations.get(test_id, default_duration), reverse=True)
+    for test_id in ordered:
+        load, index = heapq.heappop(heap)
+        shards[index].append(test_id)
+        heapq.heappush(heap, (load + durations.get(test_id, default_duration), index))
+    return [shard for shard in shards if shard]
+
+def _testcase_id(testcase):
+    """
+    Rebuilds the pytest node ID of a junit testcase (xunit1 family).
+    """
+    name = testcase.get("name", "")
+    classname = testcase.get("classname", "")
+    file_path = testcase.get("file")
+    if file_path is None:
+        parts = classname.split(".")
+        return "/".join(parts) + ".py::" + name
+    module = file_path[:-3].replace("/", ".") if file_path.endswith(".py") else file_path
+    rest = classname[len(module):].lstrip(".") if classname.startswith(module) else ""
+    return "::".join([file_path] + (rest.split(".") if rest else []) + [name])
+
+def parse_junit_results(junit_file):
+    """
+    Parses a junit XML report written by pytest.
+
+    :param junit_file: The path of the report.
+    :return: A dictionary mapping test IDs to {"outcome": str, "duration": float}.
+    """
+    results = {}
+    for testcase in ET.parse(junit_file).getroot().iter("testcase"):
+        outcome = "passed"
+        if testcase.find("failure") is not None:
+            outcome = "failed"
+        elif testcase.find("error") is not None:
+            outcome = "error"
+        elif testcase.find("skipped") is not None:
+            outcome = "skipped"
+        results[_testcase_id(testcase)] = {
+            "outcome": outcome,
+            "duration": float(testcase.get("time", 0.0)),
+        }
+    return results
+
+def write_junit_report(results, junit_file, suite_name="validation"):
+    """
+    Writes aggregated test results as a junit XML report.
+
+    :param results: A dictionary mapping test IDs to {"outcome": str, "duration": float}.
+    :param junit_file: The path of the report.
+    :param suite_name: The name of the test suite.
+    """
+    outcomes = [result["outcome"] for result in results.values()]
+    root = ET.Element("testsuites")
+    suite = ET.SubElement(
+        root,
+        "testsuite",
+        name=suite_name,
+        tests=str(len(results)),
+        failures=str(outcomes.count("failed")),
+        errors=str(outcomes.count("error")),
+        skipped=str(outcomes.count("skipped")),
+        time=f"{sum(result['duration'] for result in results.values()):.3f}",
+    )
+    for test_id, result in results.items():
+        testcase = ET.SubElement(suite, "testcase", name=test_id, time=f"{result['duration']:.3f}")
+        if result["outcome"] in ("failed", "error", "skipped"):
+            tag = "failure" if result["outcome"] == "failed" else result["outcome"]
+            ET.SubElement(testcase, tag)
+    ET.ElementTree(root).write(junit_file, encoding="utf-8", xml_declaration=True)
@@ -1,25 +1,122 @@
-import subprocess
 import os
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from callgraph_analysis.test_history import TestHistory
+from callgraph_analysis.test_impact import TestImpactAnalysis
+from callgraph_analysis.test_runner import RESULT_LINE, RunLimits, run_with_limits
+from callgraph_analysis.test_sharding import (
+    collect_test_ids,
+    parse_junit_results,
+    split_into_shards,
+    write_junit_report,
+)
+from callgraph_analysis.warm_worker import WarmWorkerPool, discover_imports
 
 class Validation:
     """
     Handles validation of changes in the codebase by executing regression tests and ensuring correctness.
     """
 
-    def __init__(self, test_command="pytest", test_dir="tests"):
+    def __init__(
+        self,
+        test_command="pytest",
+        test_dir="tests",
+        graph=None,
+        num_shards=1,
+        log_dir="validation_logs",
+        history=None,
+        repo=None,
+        quarantine_flaky=False,
+        warm_workers=0,
+        timeout=None,
+        per_test_timeout=None,
+        memory_limit_mb=None,
+        cpu_limit=None,
+        maxfail=None,
+    ):
         """
         Initializes the Validation class.
 
         :param test_command: The command to run the tests (default is pytest).
         :param test_dir: The directory containing the test files.
+        :param graph: The CallGraph used to select the tests affected by a change (optional).
+        :param num_shards: Number of parallel test processes (1 runs the tests in a single process).
+        :param log_dir: The directory receiving per-shard logs and junit reports in sharded mode.
+        :param history: A TestHistory store used to schedule tests and record their results (optional).
+        :param repo: The key of the tested repository in the history store (defaults to the test directory).
+        :param quarantine_flaky: Skip tests the history store reports as flaky.
+        :param warm_workers: Number of warm pytest workers used by validate_specific_test (0 spawns pytest for every run).
+        :param timeout: Wall-clock limit for a whole validation in seconds.
+        :param per_test_timeout: Limit for a single test in seconds.
+        :param memory_limit_mb: Address space cap per test process in megabytes.
+        :param cpu_limit: CPU time cap per test process in seconds.
+        :param maxfail: Stop a validation as soon as this many tests failed.
         """
         self.test_command = test_command
         self.test_dir = test_dir
+        self.graph = graph
+        self.impact_analysis = TestImpactAnalysis(graph) if graph is not None else None
+        self.num_shards = num_shards
+        self.log_dir = log_dir
+        self.test_durations = {}
+        self.history = history
+        self.repo = repo if repo is not None else os.path.abspath(test_dir)
+        self.quarantine_flaky = quarantine_flaky
+        self.warm_workers = warm_workers
+        self.warm_pool = None
+        self.timeout = timeout
+        self.per_test_timeout = per_test_timeout
+        self.memory_limit_mb = memory_limit_mb
+        self.cpu_limit = cpu_limit
+        self.maxfail = maxfail
+        self.last_report = {}
+        self.last_results = {}
+
+    def _graph_file_paths(self):
+        """
+        Maps CallGraph file nodes under the test directory to their paths on disk.
+
+        :return: A dictionary mapping file nodes to file paths.
+        """
+        paths = {}
+        for dirpath, _, filenames in os.walk(self.test_dir):
+            # Same naming scheme as create_graph
+            parent_name = os.path.basename(dirpath) or self.test_dir
+            for filename in filenames:
+                if filename.endswith(".py"):
+                    paths[os.path.join(parent_name, filename)] = os.path.join(dirpath, filename)
+        return paths
+
+    def select_tests(self, changed_nodes):
+        """
+        Selects the tests affected by the changed nodes using the CallGraph.
 
-    def validate_changes(self):
+        :param changed_nodes: CallGraph nodes modified by a repair.
+        :return: A tuple (selected test IDs, total number of tests in the CallGraph).
+        """
+        file_paths = self._graph_file_paths()
+        all_tests = [node for node in self.impact_analysis.test_nodes() if TestImpactAnalysis.split_node(node)[0] in file_paths]
+        selected = []
+        for test_node in self.impact_analysis.affected_tests(changed_nodes):
+            file_node, parts = TestImpactAnalysis.split_node(test_node)
+            if file_node in file_paths:
+                selected.append("::".join([file_paths[file_node]] + parts))
+        return selected, len(all_tests)
+
+    def validate_changes(self, changed_nodes=None, full_suite=False):
         """
         Executes regression tests to validate the changes in the codebase.
 
+        When a CallGraph and the changed nodes are given, only the tests reaching
+        those nodes are executed, unless full_suite is set or no test is selected.
+
+        The run is stopped when a timeout expires or once maxfail tests failed; the
+        per-test results collected until then are kept in last_results.
+
+        :param changed_nodes: CallGraph nodes modified by a repair (optional).
+        :param full_suite: Run the whole test directory even if a selection is possible.
         :return: True if all tests pass, False otherwise.
         """
         print(f"Running regression tests using {self.test_command} in {self.test_dir}...")
@@ -28,19 +125,38 @@ class Validation:
             print(f"Error: Test directory '{self.test_dir}' does not exist.")
             return False
 
+        targets = [self.test_dir]
+        selected, total = None, None
+        if self.impact_analysis is not None and changed_nodes is not None and not full_suite:
+            selected, total = self.select_tests(changed_nodes)
+            print(f"Selected {len(selected)} of {total} tests affected by the changes.")
+            if selected:
+                targets = selected
+            else:
+                # The CallGraph may miss how a test reaches the changes, never pass on an empty selection
+                print("No tests were selected for the changes, running the full suite.")
+                selected, total = None, None
+
         try:
-            result = subprocess.run(
-                [self.test_command, self.test_dir],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True
-            )
-            print("Test Output:")
-            print(result.stdout)
-            print("Test Errors:")
-            print(result.stderr)
+            start_time = time.time()
+            limits = self._new_limits()
+            if self.num_shards > 1 or self.history is not None:
+                passed = self._run_sharded(targets, limits)
+            else:
+                result = run_with_limits(
+                    [self.test_command] + limits.pytest_args() + targets,
+                    limits
+                )
+                print("Test Output:")
+                print(result["stdout"])
+                print("Test Errors:")
+                print(result["stderr"])
+                self.last_results = result["results"]
+                self._report_interruption(result)
+                passed = result["returncode"] == 0 and not result["timed_out"] and not result["stopped_early"]
+            self._report_selection(selected, total, time.time() - start_time)
 
-            if result.returncode == 0:
+            if passed:
                 print("All tests passed successfully.")
                 return True
             else:
@@ -55,10 +171,188 @@ class Validation:
             print(str(e))
             return False
 
+    def _new_limits(self):
+        """
+        Creates the limits for a new validation run.
+        """
+        return RunLimits(
+            timeout=self.timeout,
+            per_test_timeout=self.per_test_timeout,
+            memory_limit_mb=self.memory_limit_mb,
+            cpu_limit=self.cpu_limit,
+            maxfail=self.maxfail,
+        )
+
+    def _report_interruption(self, result, name="Test run"):
+        """
+        Prints why a run was interrupted, if it was.
+        """
+        if result["timed_out"]:
+            print(f"{name} timed out, returning {len(result['results'])} partial results.")
+        elif result["stopped_early"]:
+            print(f"{name} stopped early after reaching maxfail={self.maxfail}.")
+
+    def _run_sharded(self, targets, limits):
+        """
+        Runs the collected tests in parallel shards balanced by historical durations.
+
+        Each shard streams its output to its own log file and writes a junit report;
+        the per-shard reports are merged into a single junit report in log_dir.
+        Node IDs are relative to the test directory, which is used as pytest rootdir.
+
+        With a history store, flaky tests can be quarantined, each shard runs its
+        historically failing tests first, and the results are recorded afterwards.
+
+        :param targets: Test directories, files or node IDs to run.
+        :param limits: The RunLimits shared by all shards.
+        :return: True if every shard passed, False otherwise.
+        """
+        rootdir = os.path.abspath(self.test_dir)
+        try:
+            test_ids = collect_test_ids(self.test_command, targets, rootdir, timeout=limits.remaining())
+        except subprocess.TimeoutExpired:
+            print("Test collection timed out.")
+            self.last_results = {}
+            return False
+        if not test_ids:
+            print("No tests collected.")
+            self.last_results = {}
+            return True
+
+        durations = self.test_durations
+        if self.history is not None:
+            durations = {**self.history.durations(self.repo), **self.test_durations}
+            if self.quarantine_flaky:
+                flaky = self.history.flaky_tests(self.repo)
+                quarantined = [test_id for test_id in test_ids if test_id in flaky]
+                if quarantined:
+                    print(f"Quarantined {len(quarantined)} flaky tests: {quarantined}")
+                    test_ids = [test_id for test_id in test_ids if test_id not in flaky]
+                if not test_ids:
+                    self.last_results = {}
+                    return True
+
+        shards = split_into_shards(test_ids, self.num_shards, durations)
+        if self.history is not None:
+            shards = [self.history.order(self.repo, shard) for shard in shards]
+        os.makedirs(self.log_dir, exist_ok=True)
+        print(f"Running {len(test_ids)} tests in {len(shards)} shards, logs in {self.log_dir}...")
+
+        def _run_shard(index, shard):
+            log_path = os.path.join(self.log_dir, f"shard_{index}.log")
+            junit_file = os.path.abspath(os.path.join(self.log_dir, f"shard_{index}.xml"))
+            if os.path.exists(junit_file):
+                os.remove(junit_file)
+            with open(log_path, "w") as log_file:
+                result = run_with_limits(
+                    [self.test_command, f"--rootdir={rootdir}", f"--junitxml={junit_file}", "-o", "junit_family=xunit1"]
+                    + limits.pytest_args()
+                    + shard,
+                    limits,
+                    cwd=rootdir,
+                    log_file=log_file
+                )
+            return log_path, junit_file, result
+
+        with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+            shard_runs = list(executor.map(_run_shard, range(len(shards)), shards))
+
+        passed = True
+        results = {}
+        recorded = {}
+        for index, (log_path, junit_file, result) in enumerate(shard_runs):
+            self._report_interruption(result, name=f"Shard {index}")
+            if result["returncode"] != 0 or result["timed_out"] or result["stopped_early"]:
+                print(f"Shard {index} failed, see {log_path}.")
+                passed = False
+            # Killed shards write no junit report, fall back to the streamed results
+            results.update(result["results"])
+            if os.path.exists(junit_file):
+                shard_results = parse_junit_results(junit_file)
+                recorded.update(shard_results)
+                results.update(shard_results)
+
+        for test_id, result in recorded.items():
+            self.test_durations[test_id] = result["duration"]
+        self.last_results = results
+        if self.history is not None:
+            self.history.record(self.repo, TestHistory.current_commit(rootdir), recorded)
+        write_junit_report(
+            {test_id: {**result, "duration": result["duration"] or 0.0} for test_id, result in results.items()},
+            os.path.join(self.log_dir, "junit.xml")
+        )
+        return passed
+
+    def _report_selection(self, selected, total, elapsed):
+        """
+        Records the fraction of tests selected and the estimated time saved.
+
+        The saving assumes that unselected tests take as long on average as the
+        selected ones.
+        """
+        if selected is None:
+            self.last_report = {"selected": None, "total": None, "fraction": 1.0, "elapsed": elapsed, "estimated_time_saved": 0.0}
+            return
+        fraction = len(selected) / total if total else 1.0
+        saved = elapsed * (total - len(selected)) / len(selected)
+        self.last_report = {"selected": len(selected), "total": total, "fraction": fraction, "elapsed": elapsed, "estimated_time_saved": saved}
+        print(f"Ran {fraction:.1%} of the tests in {elapsed:.2f}s (estimated {saved:.2f}s saved).")
+
+    def _get_warm_pool(self):
+        """
+        Starts the warm worker pool on first use.
+
+        :return: The WarmWorkerPool, or None if warm workers are disabled or unsupported.
+        """
+        if self.warm_workers <= 0 or self.test_command != "pytest" or not WarmWorkerPool.is_supported():
+            return None
+        if self.warm_pool is None:
+            modules = discover_imports(self.test_dir) if os.path.exists(self.test_dir) else []
+            self.warm_pool = WarmWorkerPool(self.warm_workers, self._project_dirs(), modules)
+            print(f"Started {self.warm_workers} warm test workers ({self.warm_pool.startup_time:.2f}s preload).")
+            if self.warm_pool.cold_start_time is not None:
+                print(f"A cold pytest start takes {self.warm_pool.cold_start_time:.2f}s.")
+        return self.warm_pool
+
+    def _project_dirs(self):
+        """
+        Returns the source directories of the tested project: the test directory
+        and the git repository containing it.
+        """
+        project_dirs = [os.path.abspath(self.test_dir)]
+        try:
+            result = subprocess.run(
+                ["git", "rev-parse", "--show-toplevel"],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                text=True,
+                cwd=self.test_dir,
+                timeout=30
+            )
+        except (FileNotFoundError, NotADirectoryError, subprocess.TimeoutExpired):
+            return project_dirs
+        if result.returncode == 0 and result.stdout.strip():
+            project_dirs.append(os.path.abspath(result.stdout.strip()))
+        return project_dirs
+
+    def close(self):
+        """
+        Stops the warm worker pool, if any.
+        """
+        if self.warm_pool is not None:
+            self.warm_pool.close()
+            self.warm_pool = None
+
     def validate_specific_test(self, test_file):
         """
         Runs a specific test file to validate changes.
 
+        With warm workers enabled the test runs in a child forked from a worker
+        that already imported pytest and the project's dependencies. last_report
+        holds the startup time the run saved: the cold start time of the pool
+        minus the time from fork to pytest.main, or 0.0 on the cold path. Both
+        paths enforce the same RunLimits.
+
         :param test_file: The test file to execute.
         :return: True if the test passes, False otherwise.
         """
@@ -69,18 +363,39 @@ class Validation:
             return False
 
         try:
-            result = subprocess.run(
-                [self.test_command, test_file],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True
-            )
-            print("Test Output:")
-            print(result.stdout)
-            print("Test Errors:")
-            print(result.stderr)
+            start_time = time.time()
+            warm_pool = self._get_warm_pool()
+            limits = self._new_limits()
+            if warm_pool is not None:
+                returncode, output, timed_out, fork_time = warm_pool.run([test_file], limits)
+                print("Test Output:")
+                print(output)
+                self.last_results = {
+                    match.group(1): {"outcome": match.group(2).lower(), "duration": None}
+                    for match in map(RESULT_LINE.match, output.splitlines())
+                    if match
+                }
+                if timed_out:
+                    print(f"Test run timed out, returning {len(self.last_results)} partial results.")
+                    returncode = 1
+                saved = warm_pool.startup_time_saved(fork_time)
+                self.last_report = {"elapsed": time.time() - start_time, "startup_time_saved": saved}
+                print(f"Warm worker saved {saved:.2f}s of startup.")
+            else:
+                result = run_with_limits(
+                    [self.test_command] + limits.pytest_args() + [test_file],
+                    limits
+                )
+                print("Test Output:")
+                print(result["stdout"])
+                print("Test Errors:")
+                print(result["stderr"])
+                self.last_results = result["results"]
+                self._report_interruption(result)
+                returncode = 1 if result["timed_out"] or result["stopped_early"] else result["returncode"]
+                self.last_report = {"elapsed": time.time() - start_time, "startup_time_saved": 0.0}
 
-            if result.returncode == 0:
+            if returncode == 0:
                 print(f"Test {test_file} passed successfully.")
                 return True
             else:
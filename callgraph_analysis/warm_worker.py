@@ -0,0 +1,318 @@
+import ast
+import importlib
+import multiprocessing
+import os
+import queue
+import signal
+import subprocess
+import sys
+import sysconfig
+import tempfile
+import time
+
+from callgraph_analysis.test_runner import TESTS_STARTED, RunLimits
+
+# Seconds a worker may take past the run's deadline to report back before it is killed
+REPORT_GRACE = 10
+
+def discover_imports(test_dir):
+    """
+    Collects the top-level modules imported by the test files in a directory.
+
+    :param test_dir: The directory containing the test files.
+    :return: A sorted list of module names.
+    """
+    modules = set()
+    for dirpath, _, filenames in os.walk(test_dir):
+        for filename in filenames:
+            if not filename.endswith(".py"):
+                continue
+            try:
+                with open(os.path.join(dirpath, filename), "r") as source:
+                    tree = ast.parse(source.read())
+            except (SyntaxError, UnicodeDecodeError, ValueError):
+                continue
+            for node in ast.walk(tree):
+                if isinstance(node, ast.Import):
+                    modules.update(alias.name.split(".")[0] for alias in node.names)
+                elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+                    modules.add(node.module.split(".")[0])
+    return sorted(modules)
+
+def _installed_dirs():
+    """
+    Returns the directories of the standard library and installed packages.
+    """
+    paths = sysconfig.get_paths()
+    return {os.path.abspath(paths[key]) for key in ("stdlib", "platstdlib", "purelib", "platlib") if key in paths}
+
+def _is_project_module(module, project_dirs, installed_dirs=()):
+    module_file = getattr(module, "__file__", None)
+    if module_file is None:
+        return False
+    module_file = os.path.abspath(module_file)
+    # A virtualenv may live inside the project, its packages are not project sources
+    if any(module_file.startswith(installed_dir + os.sep) for installed_dir in installed_dirs):
+        return False
+    return any(module_file.startswith(project_dir + os.sep) for project_dir in project_dirs)
+
+def _preload(modules, project_dirs):
+    """
+    Imports pytest and the given modules, then drops every module that lives in
+    the project itself so repaired sources are always imported fresh.
+    """
+    import pytest  # noqa: F401
+
+    for name in modules:
+        try:
+            importlib.import_module(name)
+        except Exception:
+            continue
+    installed_dirs = _installed_dirs()
+    for name, module in list(sys.modules.items()):
+        if _is_project_module(module, project_dirs, installed_dirs):
+            del sys.modules[name]
+
+def measure_cold_start(modules):
+    """
+    Times a fresh interpreter importing pytest and the given modules, the startup
+    cost a cold pytest run pays before it collects the tests.
+
+    :param modules: Names of the modules to import.
+    :return: The elapsed seconds, or None if the interpreter could not be run.
+    """
+    script = (
+        "import importlib\n"
+        "import pytest\n"
+        f"for name in {list(modules)!r}:\n"
+        "    try:\n"
+        "        importlib.import_module(name)\n"
+        "    except Exception:\n"
+        "        pass\n"
+    )
+    start_time = time.time()
+    try:
+        subprocess.run(
+            [sys.executable, "-c", script],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            timeout=300
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    return time.time() - start_time
+
+def _run_child(args, limit_values, output):
+    """
+    Runs pytest in a child forked from the worker, enforcing the run's limits.
+
+    :param args: The pytest command line arguments.
+    :param limit_values: The deadline, per-test timeout and RLIMIT caps of the run.
+    :param output: The file receiving the child's stdout and stderr.
+    :return: A tuple (return code, timed out, seconds from fork to pytest.main or None).
+    """
+    import pytest
+
+    limits = RunLimits(memory_limit_mb=limit_values["memory_limit_mb"], cpu_limit=limit_values["cpu_limit"])
+    read_fd, write_fd = os.pipe()
+    fork_start = time.time()
+    pid = os.fork()
+    if pid == 0:
+        # Child: run the tests in isolation and exit with pytest's return code
+        os.close(read_fd)
+        os.setpgid(0, 0)
+        os.dup2(output.fileno(), 1)
+        os.dup2(output.fileno(), 2)
+        # The worker's sys.stdout may be a replaced stream, write straight to the file
+        sys.stdout = open(1, "w", buffering=1, closefd=False)
+        sys.stderr = open(2, "w", buffering=1, closefd=False)
+        try:
+            limits.apply_rlimits()
+            os.write(write_fd, repr(time.time() - fork_start).encode())
+            os.close(write_fd)
+            returncode = int(pytest.main(args))
+        except BaseException:
+            returncode = 3
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(returncode)
+
+    os.close(write_fd)
+    deadline, per_test_timeout = limit_values["deadline"], limit_values["per_test_timeout"]
+    # The per-test clock starts once collection has finished
+    output_size, last_output = 0, None
+    while True:
+        waited_pid, status = os.waitpid(pid, os.WNOHANG)
+        if waited_pid:
+            return (os.WEXITSTATUS(status) if os.WIFEXITED(status) else 1), False, _read_fork_time(read_fd)
+        now = time.time()
+        size = os.fstat(output.fileno()).st_size
+        if size != output_size:
+            if last_output is not None or TESTS_STARTED.search(os.pread(output.fileno(), size, 0).decode(errors="replace")):
+                last_output = now
+            output_size = size
+        test_stalled = per_test_timeout and last_output is not None and now - last_output >= per_test_timeout
+        if (deadline is not None and now >= deadline) or test_stalled:
+            try:
+                os.killpg(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            os.waitpid(pid, 0)
+            return 1, True, _read_fork_time(read_fd)
+        time.sleep(0.05)
+
+def _read_fork_time(read_fd):
+    with os.fdopen(read_fd, "rb") as pipe:
+        data = pipe.read()
+    return float(data) if data else None
+
+def _serve(connection, project_dirs, modules):
+    """
+    Worker loop: preloads the imports once, then runs every request in a forked child.
+    """
+    start_time = time.time()
+    _preload(modules, project_dirs)
+    connection.send(time.time() - start_time)
+
+    while True:
+        request = connection.recv()
+        if request is None:
+            break
+        args, limit_values = request
+        with tempfile.TemporaryFile(mode="w+") as output:
+            returncode, timed_out, fork_time = _run_child(args, limit_values, output)
+            output.seek(0)
+            connection.send((returncode, output.read(), timed_out, fork_time))
+    connection.close()
+
+class WarmTestWorker:
+    """
+    A persistent process with pytest and the project's dependencies already imported.
+    Each run is executed in a child forked from it, so runs stay isolated.
+    """
+
+    def __init__(self, project_dirs, modules=()):
+        """
+        Starts the worker and waits until its imports are preloaded.
+
+        :param project_dirs: Modules under these directories are never preloaded.
+        :param modules: Names of the modules to preload.
+        """
+        context = multiprocessing.get_context("fork")
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(
+            target=_serve,
+            args=(child_connection, [os.path.abspath(path) for path in project_dirs], list(modules)),
+            daemon=True,
+        )
+        self.process.start()
+        child_connection.close()
+        self.startup_time = self.connection.recv()
+        self.broken = False
+
+    def run(self, args, limits=None):
+        """
+        Runs pytest with the given arguments in a fresh forked child.
+
+        The worker kills a child that outlives the deadline or the per-test timeout
+        of the limits, whose pytest options and RLIMIT caps also apply. A worker
+        that does not report back in time is killed and marked as broken.
+
+        :param args: The pytest command line arguments.
+        :param limits: The RunLimits of the run (optional).
+        :return: A tuple (return code, combined output, timed out, seconds from fork to pytest.main or None).
+        """
+        limits = limits or RunLimits()
+        limit_values = {
+            "deadline": limits.deadline,
+            "per_test_timeout": limits.per_test_timeout,
+            "memory_limit_mb": limits.memory_limit_mb,
+            "cpu_limit": limits.cpu_limit,
+        }
+        self.connection.send((limits.pytest_args() + list(args), limit_values))
+        while not self.connection.poll(1):
+            too_late = limits.deadline is not None and time.time() >= limits.deadline + REPORT_GRACE
+            if too_late or not self.process.is_alive():
+                self.broken = True
+                self.process.kill()
+                return 1, "", too_late, None
+        return self.connection.recv()
+
+    def close(self):
+        """
+        Stops the worker.
+        """
+        try:
+            self.connection.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.connection.close()
+
+class WarmWorkerPool:
+    """
+    A thread-safe pool of WarmTestWorker processes.
+    """
+
+    def __init__(self, size, project_dirs, modules=()):
+        """
+        Starts the workers of the pool.
+
+        :param size: The number of workers.
+        :param project_dirs: Modules under these directories are never preloaded.
+        :param modules: Names of the modules to preload.
+        """
+        self.project_dirs = project_dirs
+        self.modules = modules
+        self.workers = [WarmTestWorker(project_dirs, modules) for _ in range(size)]
+        self.idle = queue.Queue()
+        for worker in self.workers:
+            self.idle.put(worker)
+        self.startup_time = max(worker.startup_time for worker in self.workers)
+        self.cold_start_time = measure_cold_start(modules)
+
+    @staticmethod
+    def is_supported():
+        """
+        Checks whether the platform can fork worker children.
+        """
+        return hasattr(os, "fork") and "fork" in multiprocessing.get_all_start_methods()
+
+    def startup_time_saved(self, fork_time):
+        """
+        Returns the startup time a warm run saved over a cold pytest run.
+
+        :param fork_time: The fork time reported by run().
+        :return: The cold start time minus the fork time, never below zero.
+        """
+        if self.cold_start_time is None or fork_time is None:
+            return 0.0
+        return max(0.0, self.cold_start_time - fork_time)
+
+    def run(self, args, limits=None):
+        """
+        Runs pytest on the next idle worker, replacing the worker if it broke.
+
+        :param args: The pytest command line arguments.
+        :param limits: The RunLimits of the run (optional).
+        :return: A tuple (return code, combined output, timed out, seconds from fork to pytest.main or None).
+        """
+        worker = self.idle.get()
+        try:
+            return worker.run(args, limits)
+        finally:
+            if worker.broken:
+                worker.close()
+                replacement = WarmTestWorker(self.project_dirs, self.modules)
+                self.workers[self.workers.index(worker)] = replacement
+                worker = replacement
+            self.idle.put(worker)
+
+    def close(self):
+        """
+        Stops all workers of the pool.
+        """
+        for worker in self.workers:
+            worker.close()
@@ -1,5 +1,6 @@
 import argparse
 import ast
+import asyncio
 import concurrent.futures
 import json
 import os
@@ -10,9 +11,19 @@ from threading import Lock
 from datasets import load_dataset
 from tqdm import tqdm
 
-from agentless.util.api_requests import num_tokens_from_messages
-from agentless.util.model import make_model
+from agentless.util.accounting import configure_accounting, get_ledger
+from agentless.util.api_requests import num_tokens_from_messages, request_metrics
+from agentless.util.client_pool import aclose_async_clients
+from agentless.util.hedging import configure_hedging
+from agentless.util.model import arun_codegen_calls, make_model, run_codegen_calls
 from agentless.util.postprocess_data import remove_comments_and_docstrings
+from agentless.util.prompt_cache import (
+    cache_usage,
+    min_cacheable_tokens,
+    plan_prompt,
+)
+from agentless.util.rate_limiter import configure_rate_limiter
+from agentless.util.response_cache import configure_response_cache
 from agentless.util.utils import load_jsonl, setup_logger
 
 generate_tests_prompt_template = """
@@ -94,6 +105,13 @@ def extract_first_code_block(text):
 
 
 def gen_test(instance_id, args, swe_bench_data, prev_o, write_lock=None):
+    return run_codegen_calls(
+        _gen_test(instance_id, args, swe_bench_data, prev_o, write_lock)
+    )
+
+
+def _gen_test(instance_id, args, swe_bench_data, prev_o, write_lock=None):
+    """Generates tests for one instance, yielding its codegen calls (see run_codegen_calls)."""
 
     if args.target_id is not None:
         if args.target_id != instance_id:
@@ -128,9 +146,16 @@ def gen_test(instance_id, args, swe_bench_data, prev_o, write_lock=None):
     raw_output = ""
 
     prompt_template = generate_tests_prompt_template
-    message = prompt_template.format(
-        problem_statement=problem_statement,
-    ).strip()
+    if args.plan_prompt_cache:
+        message = plan_prompt(
+            prompt_template,
+            min_prefix_tokens=min_cacheable_tokens(args.model),
+            problem_statement=problem_statement,
+        )
+    else:
+        message = prompt_template.format(
+            problem_statement=problem_statement,
+        ).strip()
 
     logger.info(f"prompting with message:\n{message}")
 
@@ -141,7 +166,9 @@ def gen_test(instance_id, args, swe_bench_data, prev_o, write_lock=None):
     model = make_model(
         model=args.model,
         logger=logger,
+        instance_id=instance_id,
         backend=args.backend,
+        base_url=args.base_url,
         max_tokens=1024,
         temperature=0,
         batch_size=1,
@@ -163,8 +190,8 @@ def gen_test(instance_id, args, swe_bench_data, prev_o, write_lock=None):
                 },
             }
         else:
-            greedy_traj = model.codegen(
-                message, num_samples=1, prompt_cache=args.max_samples > 1
+            greedy_traj = (
+                yield (model, "codegen", message, 1, args.max_samples > 1)
             )[0]
 
     sample_responses.append(greedy_traj)
@@ -172,10 +199,13 @@ def gen_test(instance_id, args, swe_bench_data, prev_o, write_lock=None):
     model = make_model(
         model=args.model,
         logger=logger,
+        instance_id=instance_id,
         backend=args.backend,
+        base_url=args.base_url,
         max_tokens=1024,
         temperature=0.8,
         batch_size=args.max_samples - 1,  # minus the 1 greedy sample
+        max_parallel_samples=args.sample_parallelism,
     )
 
     if args.mock:
@@ -196,8 +226,12 @@ def gen_test(instance_id, args, swe_bench_data, prev_o, write_lock=None):
     else:
         if args.max_samples - 1:
             # always use cached prompt if possible for later samples
-            sample_trajs = model.codegen(
-                message, num_samples=args.max_samples - 1, prompt_cache=True
+            sample_trajs = yield (
+                model,
+                "codegen",
+                message,
+                args.max_samples - 1,
+                True,
             )
         else:
             sample_trajs = []
@@ -222,6 +256,9 @@ def gen_test(instance_id, args, swe_bench_data, prev_o, write_lock=None):
         counts.append(count)
         raw_outputs.append(raw_output)
 
+    prompt_cache_usage = cache_usage(sample_responses)
+    logger.info(f"prompt cache usage: {prompt_cache_usage}")
+
     if write_lock is not None:
         write_lock.acquire()
     with open(args.output_file, "a") as f:
@@ -237,6 +274,7 @@ def gen_test(instance_id, args, swe_bench_data, prev_o, write_lock=None):
                         [""]
                     ],  # To make the tests compatible with the repair setup
                     "file_names": [["reproduce_bug.py"]],
+                    "prompt_cache_usage": prompt_cache_usage,
                 }
             )
             + "\n"
@@ -245,6 +283,26 @@ def gen_test(instance_id, args, swe_bench_data, prev_o, write_lock=None):
         write_lock.release()
 
 
+async def _generate_tests_async(instances, args, swe_bench_data, prev_o):
+    # all instances share one event loop; their requests are bounded by the client pool
+    write_lock = Lock()
+    tasks = [
+        asyncio.create_task(
+            arun_codegen_calls(
+                _gen_test(instance_id, args, swe_bench_data, prev_o, write_lock)
+            )
+        )
+        for instance_id in instances
+    ]
+    try:
+        for task in tqdm(
+            asyncio.as_completed(tasks), total=len(instances), colour="MAGENTA"
+        ):
+            await task
+    finally:
+        await aclose_async_clients()
+
+
 def generate_tests(args):
     with open(f"{args.output_folder}/args.json", "w") as f:
         json.dump(vars(args), f, indent=4)
@@ -253,7 +311,9 @@ def generate_tests(args):
     instances = swe_bench_data["instance_id"]
     prev_o = load_jsonl(args.output_file) if os.path.exists(args.output_file) else []
 
-    if args.num_threads == 1:
+    if args.async_requests:
+        asyncio.run(_generate_tests_async(instances, args, swe_bench_data, prev_o))
+    elif args.num_threads == 1:
         for instance_id in tqdm(instances, total=len(instances), colour="MAGENTA"):
             gen_test(instance_id, args, swe_bench_data, prev_o)
     else:
@@ -274,6 +334,10 @@ def generate_tests(args):
             ):
                 future.result()
 
+    with open(f"{args.output_folder}/request_metrics.json", "w") as f:
+        json.dump(request_metrics(), f, indent=4)
+    get_ledger().write_report(f"{args.output_folder}/accounting.json")
+
 
 def post_process_tests(args):
     """
@@ -517,6 +581,82 @@ def main():
         default=1,
         help="Number of threads to use for creating API requests",
     )
+    parser.add_argument(
+        "--rpm", type=float, help="Client-side limit of LLM requests per minute."
+    )
+    parser.add_argument(
+        "--tpm", type=float, help="Client-side limit of LLM tokens per minute."
+    )
+    parser.add_argument(
+        "--rate_limit_file",
+        type=str,
+        help="Share the rpm/tpm limits with other processes using this file.",
+    )
+    parser.add_argument(
+        "--hedge_requests",
+        action="store_true",
+        help="Duplicate requests slower than the p95 latency so far and keep the first reply.",
+    )
+    parser.add_argument(
+        "--max_hedge_rate",
+        type=float,
+        default=0.1,
+        help="Largest fraction of requests that may be hedged.",
+    )
+    parser.add_argument(
+        "--response_cache",
+        type=str,
+        help="SQLite file caching LLM responses by request content.",
+    )
+    parser.add_argument(
+        "--response_cache_size_mb",
+        type=float,
+        help="Evict least recently used cached responses above this size.",
+    )
+    parser.add_argument(
+        "--replay",
+        action="store_true",
+        help="Only serve responses from --response_cache, never call the API.",
+    )
+    parser.add_argument(
+        "--base_url",
+        type=str,
+        default=None,
+        help="Send requests to this endpoint instead, e.g. util/mock_llm_server.py.",
+    )
+    parser.add_argument(
+        "--async_requests",
+        action="store_true",
+        help="Run all instances on one event loop with the async API clients.",
+    )
+    parser.add_argument(
+        "--sample_parallelism",
+        type=int,
+        default=8,
+        help="Number of samples of one instance requested concurrently",
+    )
+    parser.add_argument(
+        "--plan_prompt_cache",
+        action="store_true",
+        help="Send the static prompt instructions as a separately cached prefix (anthropic), "
+        "when they are long enough to be cached.",
+    )
+    parser.add_argument(
+        "--max_instance_cost",
+        type=float,
+        help="Stop sampling an instance above this USD cost.",
+    )
+    parser.add_argument(
+        "--max_instance_tokens",
+        type=int,
+        help="Stop sampling an instance above this many tokens.",
+    )
+    parser.add_argument(
+        "--max_run_cost", type=float, help="Stop all sampling above this USD cost."
+    )
+    parser.add_argument(
+        "--max_run_tokens", type=int, help="Stop all sampling above this many tokens."
+    )
     parser.add_argument("--target_id", type=str)
     parser.add_argument(
         "--mock", action="store_true", help="Mock run to compute prompt tokens."
@@ -530,6 +670,18 @@ def main():
     )
 
     args = parser.parse_args()
+    configure_rate_limiter(args.rpm, args.tpm, args.rate_limit_file)
+    configure_hedging(args.hedge_requests, args.max_hedge_rate)
+    configure_accounting(
+        "reproduction_tests",
+        args.max_instance_cost,
+        args.max_instance_tokens,
+        args.max_run_cost,
+        args.max_run_tokens,
+    )
+    configure_response_cache(
+        args.response_cache, args.response_cache_size_mb, args.replay
+    )
 
     assert (not "deepseek" in args.model) or (
         args.backend == "deepseek"
@@ -1,15 +1,21 @@
 import argparse
+import asyncio
 import concurrent.futures
 import json
 import os
 from difflib import unified_diff
 from threading import Lock
+from typing import Optional
 
 from datasets import load_dataset
 from tqdm import tqdm
 
-from agentless.util.api_requests import num_tokens_from_messages
-from agentless.util.model import make_model
+from agentless.util.accounting import configure_accounting, get_ledger
+from agentless.util.api_requests import num_tokens_from_messages, request_metrics
+from agentless.util.client_pool import aclose_async_clients
+from agentless.util.context_packer import ContextPacker
+from agentless.util.hedging import configure_hedging
+from agentless.util.model import arun_codegen_calls, make_model, run_codegen_calls
 from agentless.util.postprocess_data import (
     check_code_differ_by_just_empty_lines,
     check_syntax,
@@ -22,11 +28,18 @@ from agentless.util.postprocess_data import (
     split_edit_multifile_commands,
 )
 from agentless.util.preprocess_data import (
-    get_full_file_paths_and_classes_and_functions,
     get_repo_structure,
     line_wrap_content,
     transfer_arb_locs_to_locs,
 )
+from agentless.util.prompt_cache import (
+    cache_usage,
+    min_cacheable_tokens,
+    plan_prompt,
+)
+from agentless.util.rate_limiter import configure_rate_limiter
+from agentless.util.repo_index import RepoIndex
+from agentless.util.response_cache import configure_response_cache
 from agentless.util.utils import cleanup_logger, load_jsonl, setup_logger
 
 repair_relevant_file_instruction = """
@@ -234,13 +247,36 @@ def construct_topn_file_context(
     add_space: bool = False,
     sticky_scroll: bool = False,
     no_line_number: bool = True,
+    token_budget: Optional[int] = None,
+    model: str = "gpt-4o-2024-05-13",
+    budget_report: Optional[dict] = None,
+    repo_index: Optional[RepoIndex] = None,
 ):
     """Concatenate provided locations to form a context.
 
     loc: {"file_name_1": ["loc_str_1"], ...}
+
+    Pass the instance's `repo_index` to resolve every file's locs against it
+    instead of indexing `structure` again.
+
+    With `token_budget`, the located lines are packed into that many tokens of
+    `model` by a ContextPacker, with windows of at most `context_window` lines,
+    and the budget spent on each file is written into `budget_report`.
     """
     file_loc_intervals = dict()
     topn_content = ""
+    packer = None
+    if token_budget is not None:
+        packer = ContextPacker(
+            token_budget,
+            context_window,
+            model=model,
+            add_space=add_space,
+            no_line_number=no_line_number,
+        )
+
+    if repo_index is None and structure is not None:
+        repo_index = RepoIndex(structure)
 
     for pred_file, locs in file_to_locs.items():
         content = file_contents[pred_file]
@@ -252,24 +288,52 @@ def construct_topn_file_context(
             loc_interval,
             fine_grain_loc_only,
             file_content=file_contents[pred_file] if pred_file in file_contents else "",
+            repo_index=repo_index,
         )
 
         if len(line_locs) > 0:
             # Note that if no location is predicted, we exclude this file.
-            file_loc_content = line_wrap_content(
-                content,
-                context_intervals,
-                add_space=add_space,
-                no_line_number=no_line_number,
-                sticky_scroll=sticky_scroll,
-            )
-            topn_content += f"### {pred_file}\n{file_loc_content}\n\n\n"
             file_loc_intervals[pred_file] = context_intervals
+            if packer is not None:
+                packer.add_file(pred_file, content, line_locs)
+
+    if packer is not None:
+        report = packer.pack()
+        if budget_report is not None:
+            budget_report.update(report)
+        packed_intervals = {
+            pred_file: packer.intervals(pred_file) for pred_file in file_loc_intervals
+        }
+        # files whose locs all fell outside the budget are excluded too
+        file_loc_intervals = {
+            pred_file: intervals
+            for pred_file, intervals in packed_intervals.items()
+            if intervals
+        }
+
+    for pred_file, context_intervals in file_loc_intervals.items():
+        file_loc_content = line_wrap_content(
+            file_contents[pred_file],
+            context_intervals,
+            add_space=add_space,
+            no_line_number=no_line_number,
+            sticky_scroll=sticky_scroll,
+        )
+        topn_content += f"### {pred_file}\n{file_loc_content}\n\n\n"
 
     return topn_content, file_loc_intervals
 
 
+def _format_prompt(template, **fields):
+    return template.format(**fields).strip()
+
+
 def process_loc(loc, args, swe_bench_data, prev_o, write_lock=None):
+    return run_codegen_calls(_process_loc(loc, args, swe_bench_data, prev_o, write_lock))
+
+
+def _process_loc(loc, args, swe_bench_data, prev_o, write_lock=None):
+    """Repairs one instance, yielding its codegen calls (see run_codegen_calls)."""
     instance_id = loc["instance_id"]
 
     if args.target_id is not None:
@@ -315,9 +379,13 @@ def process_loc(loc, args, swe_bench_data, prev_o, write_lock=None):
     bench_data = [x for x in swe_bench_data if x["instance_id"] == instance_id][0]
     problem_statement = bench_data["problem_statement"]
     structure = get_repo_structure(
-        instance_id, bench_data["repo"], bench_data["base_commit"], "playground"
+        instance_id,
+        bench_data["repo"],
+        bench_data["base_commit"],
+        "playground",
+        logger=logger,
     )
-    files, _, _ = get_full_file_paths_and_classes_and_functions(structure)
+    repo_index = RepoIndex(structure)
     raw_outputs, counts, all_generations, traj, prev_contents, file_names = (
         [],
         [],
@@ -331,21 +399,17 @@ def process_loc(loc, args, swe_bench_data, prev_o, write_lock=None):
     topn_content = ""
     # Construct file contents
     file_contents = dict()
-    for i, pred_file in enumerate(pred_files):
-        content = None
-        for file_content in files:
-            if file_content[0] == pred_file:
-                content = "\n".join(file_content[1])
-                file_contents[pred_file] = content
-                break
-
+    for pred_file in pred_files:
+        content = repo_index.file_text(pred_file)
         assert content is not None, f"{pred_file} file not found"
+        file_contents[pred_file] = content
     # Construct top-n file context
     file_to_edit_locs = dict()
 
     if "found_edit_locs" in loc:
         file_to_edit_locs = loc["found_edit_locs"]
 
+    context_budget = dict()
     topn_content, file_loc_intervals = construct_topn_file_context(
         file_to_edit_locs,
         pred_files,
@@ -357,7 +421,13 @@ def process_loc(loc, args, swe_bench_data, prev_o, write_lock=None):
         add_space=args.add_space,
         no_line_number=args.diff_format or args.str_replace_format,
         sticky_scroll=args.sticky_scroll,
+        token_budget=args.context_token_budget,
+        model=args.model,
+        budget_report=context_budget,
+        repo_index=repo_index,
     )
+    if args.context_token_budget is not None:
+        logger.info(f"context budget: {json.dumps(context_budget)}")
 
     if topn_content.strip() == "":
         if write_lock is not None:
@@ -391,11 +461,20 @@ def process_loc(loc, args, swe_bench_data, prev_o, write_lock=None):
         else repair_prompt_combine_topn
     )
     file_instruction = repair_relevant_file_instruction
-    message = prompt_template.format(
+    fields = dict(
         repair_relevant_file_instruction=file_instruction,
         problem_statement=problem_statement,
         content=topn_content.rstrip(),
-    ).strip()
+    )
+    if args.plan_prompt_cache:
+        message = plan_prompt(
+            prompt_template,
+            static_fields=("repair_relevant_file_instruction",),
+            min_prefix_tokens=min_cacheable_tokens(args.model),
+            **fields,
+        )
+    else:
+        message = _format_prompt(prompt_template, **fields)
     logger.info(f"prompting with message:\n{message}")
 
     all_generations, counts, traj, prev_contents, file_names = [], [], [], [], []
@@ -404,10 +483,14 @@ def process_loc(loc, args, swe_bench_data, prev_o, write_lock=None):
     model = make_model(
         model=args.model,
         logger=logger,
+        instance_id=instance_id,
         backend=args.backend,
+        base_url=args.base_url,
         max_tokens=1024,
         temperature=0,
         batch_size=1,
+        stream_stop_blocks=args.stream_stop_blocks,
+        stream_quiet_chars=args.stream_quiet_chars,
     )
     if args.skip_greedy:
         greedy_traj = {
@@ -426,24 +509,30 @@ def process_loc(loc, args, swe_bench_data, prev_o, write_lock=None):
                 },
             }
         else:
-            if args.str_replace_format:
-                greedy_traj = model.codegen_w_tool(
-                    message, num_samples=1, prompt_cache=args.max_samples > 1
-                )[0]
-            else:
-                greedy_traj = model.codegen(
-                    message, num_samples=1, prompt_cache=args.max_samples > 1
-                )[0]
+            greedy_traj = (
+                yield (
+                    model,
+                    "codegen_w_tool" if args.str_replace_format else "codegen",
+                    message,
+                    1,
+                    args.max_samples > 1,
+                )
+            )[0]
 
     sample_responses.append(greedy_traj)
     # get temperature samples
     model = make_model(
         model=args.model,
         logger=logger,
+        instance_id=instance_id,
         backend=args.backend,
+        base_url=args.base_url,
         max_tokens=1024,
         temperature=0.8,
         batch_size=args.max_samples - 1,  # minus the 1 greedy sample
+        max_parallel_samples=args.sample_parallelism,
+        stream_stop_blocks=args.stream_stop_blocks,
+        stream_quiet_chars=args.stream_quiet_chars,
     )
 
     if args.mock:
@@ -464,14 +553,13 @@ def process_loc(loc, args, swe_bench_data, prev_o, write_lock=None):
     else:
         if args.max_samples - 1:
             # always use cached prompt if possible for later samples
-            if args.str_replace_format:
-                sample_trajs = model.codegen_w_tool(
-                    message, num_samples=args.max_samples - 1, prompt_cache=True
-                )
-            else:
-                sample_trajs = model.codegen(
-                    message, num_samples=args.max_samples - 1, prompt_cache=True
-                )
+            sample_trajs = yield (
+                model,
+                "codegen_w_tool" if args.str_replace_format else "codegen",
+                message,
+                args.max_samples - 1,
+                True,
+            )
         else:
             sample_trajs = []
 
@@ -510,27 +598,50 @@ def process_loc(loc, args, swe_bench_data, prev_o, write_lock=None):
         counts.append(count)
         raw_outputs.append(raw_output)
 
+    prompt_cache_usage = cache_usage(sample_responses)
+    logger.info(f"prompt cache usage: {prompt_cache_usage}")
+
+    output = {
+        "instance_id": instance_id,
+        "raw_output": raw_outputs,
+        "all_generations": [all_generations],
+        "try_count": counts,
+        "traj": traj,
+        "prev_content": [prev_contents],
+        "file_names": [file_names],
+        "prompt_cache_usage": prompt_cache_usage,
+    }
+    if args.context_token_budget is not None:
+        # post-processing cannot recompute the packed intervals from the locs
+        output["context_budget"] = context_budget
+        output["file_loc_intervals"] = file_loc_intervals
+
     if write_lock is not None:
         write_lock.acquire()
     with open(args.output_file, "a") as f:
-        f.write(
-            json.dumps(
-                {
-                    "instance_id": instance_id,
-                    "raw_output": raw_outputs,
-                    "all_generations": [all_generations],
-                    "try_count": counts,
-                    "traj": traj,
-                    "prev_content": [prev_contents],
-                    "file_names": [file_names],
-                }
-            )
-            + "\n"
-        )
+        f.write(json.dumps(output) + "\n")
     if write_lock is not None:
         write_lock.release()
 
 
+async def _repair_async(locs, args, swe_bench_data, prev_o):
+    # all instances share one event loop; their requests are bounded by the client pool
+    write_lock = Lock()
+    tasks = [
+        asyncio.create_task(
+            arun_codegen_calls(
+                _process_loc(loc, args, swe_bench_data, prev_o, write_lock)
+            )
+        )
+        for loc in locs
+    ]
+    try:
+        for task in tqdm(asyncio.as_completed(tasks), total=len(locs), colour="MAGENTA"):
+            await task
+    finally:
+        await aclose_async_clients()
+
+
 def repair(args):
     with open(f"{args.output_folder}/args.json", "w") as f:
         json.dump(vars(args), f, indent=4)
@@ -543,7 +654,9 @@ def repair(args):
         for loc in locs:
             f.write(json.dumps(loc) + "\n")
 
-    if args.num_threads == 1:
+    if args.async_requests:
+        asyncio.run(_repair_async(locs, args, swe_bench_data, prev_o))
+    elif args.num_threads == 1:
         for loc in tqdm(locs, total=len(locs), colour="MAGENTA"):
             process_loc(loc, args, swe_bench_data, prev_o)
     else:
@@ -564,6 +677,10 @@ def repair(args):
             ):
                 future.result()
 
+    with open(f"{args.output_folder}/request_metrics.json", "w") as f:
+        json.dump(request_metrics(), f, indent=4)
+    get_ledger().write_report(f"{args.output_folder}/accounting.json")
+
 
 def post_process_raw_output(
     raw_output_text, file_contents, logger, file_loc_intervals, args
@@ -689,6 +806,17 @@ def post_process_repair(args):
                         line_locs, context_intervals = [], []  # default values.
 
                     file_loc_intervals[tmp_pred_file] = context_intervals
+
+                if "file_loc_intervals" in raw_output:
+                    # the context was packed into a token budget
+                    packed_intervals = raw_output["file_loc_intervals"]
+                    file_loc_intervals = {
+                        file_name: [
+                            tuple(interval)
+                            for interval in packed_intervals.get(file_name, [])
+                        ]
+                        for file_name in file_loc_intervals
+                    }
             except Exception as e:
                 logger.info(e)
                 print(e)
@@ -725,6 +853,11 @@ def main():
     parser.add_argument("--top_n", type=int, default=1)
     parser.add_argument("--loc_interval", action="store_true")
     parser.add_argument("--context_window", type=int, default=10)
+    parser.add_argument(
+        "--context_token_budget",
+        type=int,
+        help="Pack the located code into this many tokens, widening windows up to --context_window.",
+    )
     parser.add_argument("--gen_and_process", action="store_true")
     parser.add_argument("--max_samples", type=int, default=20, help="Sampling budget.")
     parser.add_argument(
@@ -765,6 +898,94 @@ def main():
         default=1,
         help="Number of threads to use for creating API requests",
     )
+    parser.add_argument(
+        "--rpm", type=float, help="Client-side limit of LLM requests per minute."
+    )
+    parser.add_argument(
+        "--tpm", type=float, help="Client-side limit of LLM tokens per minute."
+    )
+    parser.add_argument(
+        "--rate_limit_file",
+        type=str,
+        help="Share the rpm/tpm limits with other processes using this file.",
+    )
+    parser.add_argument(
+        "--hedge_requests",
+        action="store_true",
+        help="Duplicate requests slower than the p95 latency so far and keep the first reply.",
+    )
+    parser.add_argument(
+        "--max_hedge_rate",
+        type=float,
+        default=0.1,
+        help="Largest fraction of requests that may be hedged.",
+    )
+    parser.add_argument(
+        "--response_cache",
+        type=str,
+        help="SQLite file caching LLM responses by request content.",
+    )
+    parser.add_argument(
+        "--response_cache_size_mb",
+        type=float,
+        help="Evict least recently used cached responses above this size.",
+    )
+    parser.add_argument(
+        "--replay",
+        action="store_true",
+        help="Only serve responses from --response_cache, never call the API.",
+    )
+    parser.add_argument(
+        "--base_url",
+        type=str,
+        default=None,
+        help="Send requests to this endpoint instead, e.g. util/mock_llm_server.py.",
+    )
+    parser.add_argument(
+        "--async_requests",
+        action="store_true",
+        help="Run all instances on one event loop with the async API clients.",
+    )
+    parser.add_argument(
+        "--sample_parallelism",
+        type=int,
+        default=8,
+        help="Number of samples of one instance requested concurrently",
+    )
+    parser.add_argument(
+        "--stream_stop_blocks",
+        type=int,
+        help="Stream completions and stop once this many edit blocks are complete.",
+    )
+    parser.add_argument(
+        "--stream_quiet_chars",
+        type=int,
+        help="With --stream_stop_blocks, keep streaming after the blocks are complete until "
+        "this many characters arrive without a new block. Off by default: a long "
+        "explanation between two edits would cut off the second one.",
+    )
+    parser.add_argument(
+        "--plan_prompt_cache",
+        action="store_true",
+        help="Send the static prompt instructions as a separately cached prefix (anthropic), "
+        "when they are long enough to be cached.",
+    )
+    parser.add_argument(
+        "--max_instance_cost",
+        type=float,
+        help="Stop sampling an instance above this USD cost.",
+    )
+    parser.add_argument(
+        "--max_instance_tokens",
+        type=int,
+        help="Stop sampling an instance above this many tokens.",
+    )
+    parser.add_argument(
+        "--max_run_cost", type=float, help="Stop all sampling above this USD cost."
+    )
+    parser.add_argument(
+        "--max_run_tokens", type=int, help="Stop all sampling above this many tokens."
+    )
     parser.add_argument("--target_id", type=str)
     parser.add_argument(
         "--mock", action="store_true", help="Mock run to compute prompt tokens."
@@ -777,6 +998,18 @@ def main():
     )
 
     args = parser.parse_args()
+    configure_rate_limiter(args.rpm, args.tpm, args.rate_limit_file)
+    configure_hedging(args.hedge_requests, args.max_hedge_rate)
+    configure_accounting(
+        "repair",
+        args.max_instance_cost,
+        args.max_instance_tokens,
+        args.max_run_cost,
+        args.max_run_tokens,
+    )
+    configure_response_cache(
+        args.response_cache, args.response_cache_size_mb, args.replay
+    )
 
     assert (not "deepseek" in args.model) or (
         args.backend == "deepseek"
@@ -787,6 +1020,14 @@ def main():
         args.diff_format and args.str_replace_format
     ), "Cannot use both diff_format and str_replace_format"
 
+    # streaming early stop looks for edit blocks, which str_replace_format does not use
+    assert not (
+        args.stream_stop_blocks and args.str_replace_format
+    ), "stream_stop_blocks is not supported with str_replace_format"
+    assert (
+        args.stream_quiet_chars is None or args.stream_stop_blocks
+    ), "stream_quiet_chars requires stream_stop_blocks"
+
     # str_replace_format only supported with anthropic backend
     assert not (
         args.str_replace_format and args.backend != "anthropic"
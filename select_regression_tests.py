@@ -5,8 +5,11 @@ import os
 from datasets import load_dataset
 from tqdm import tqdm
 
+from agentless.util.accounting import configure_accounting, get_ledger
 from agentless.util.api_requests import num_tokens_from_messages
 from agentless.util.model import make_model
+from agentless.util.rate_limiter import configure_rate_limiter
+from agentless.util.response_cache import configure_response_cache
 from agentless.util.utils import load_jsonl, setup_logger
 
 MAX_CONTEXT_LENGTH = 128000
@@ -93,7 +96,9 @@ def select_test(instance_id, args, swe_bench_data, prev_o, passing_tests):
     model = make_model(
         model=args.model,
         logger=logger,
+        instance_id=instance_id,
         backend=args.backend,
+        base_url=args.base_url,
         max_tokens=1024,
         temperature=0,
         batch_size=1,
@@ -102,14 +107,35 @@ def select_test(instance_id, args, swe_bench_data, prev_o, passing_tests):
     def message_too_long(message):
         return num_tokens_from_messages(message, args.model) >= MAX_CONTEXT_LENGTH
 
-    while message_too_long(message):
-        # half it
+    original_passing_tests = passing_tests
+    while passing_tests and message_too_long(message):
+        # half it, stopping at the first candidate that fits
         # TODO: we can prompt the model multiple times to select from different subset of tests
         passing_tests = passing_tests[: len(passing_tests) // 2]
         message = prompt_template.format(
             problem_statement=problem_statement, passing_tests="\n".join(passing_tests)
         ).strip()
 
+    if not passing_tests:
+        # not even one test fits next to the problem statement, keep them all
+        logger.warning(
+            f"prompt for {instance_id} is too long even with a single test, skipping selection"
+        )
+        with open(args.output_file, "a") as f:
+            f.write(
+                json.dumps(
+                    {
+                        "instance_id": instance_id,
+                        "raw_output": "",
+                        "tests_passing_in_original_repo": original_passing_tests,
+                        "original_regressions": original_passing_tests,
+                        "traj": {},
+                    }
+                )
+                + "\n"
+            )
+        return
+
     greedy_traj = model.codegen(message, num_samples=1)[0]
     greedy_traj["prompt"] = message
     raw_output = greedy_traj["response"]
@@ -167,6 +193,8 @@ def select_tests(args):
         if result is not None:
             results.append(result)
 
+    get_ledger().write_report(f"{args.output_folder}/accounting.json")
+
 
 def main():
     parser = argparse.ArgumentParser()
@@ -188,6 +216,54 @@ def main():
         choices=["openai", "deepseek", "anthropic"],
     )
     parser.add_argument("--output_folder", type=str, required=True)
+    parser.add_argument(
+        "--rpm", type=float, help="Client-side limit of LLM requests per minute."
+    )
+    parser.add_argument(
+        "--tpm", type=float, help="Client-side limit of LLM tokens per minute."
+    )
+    parser.add_argument(
+        "--rate_limit_file",
+        type=str,
+        help="Share the rpm/tpm limits with other processes using this file.",
+    )
+    parser.add_argument(
+        "--response_cache",
+        type=str,
+        help="SQLite file caching LLM responses by request content.",
+    )
+    parser.add_argument(
+        "--response_cache_size_mb",
+        type=float,
+        help="Evict least recently used cached responses above this size.",
+    )
+    parser.add_argument(
+        "--replay",
+        action="store_true",
+        help="Only serve responses from --response_cache, never call the API.",
+    )
+    parser.add_argument(
+        "--base_url",
+        type=str,
+        default=None,
+        help="Send requests to this endpoint instead, e.g. util/mock_llm_server.py.",
+    )
+    parser.add_argument(
+        "--max_instance_cost",
+        type=float,
+        help="Stop sampling an instance above this USD cost.",
+    )
+    parser.add_argument(
+        "--max_instance_tokens",
+        type=int,
+        help="Stop sampling an instance above this many tokens.",
+    )
+    parser.add_argument(
+        "--max_run_cost", type=float, help="Stop all sampling above this USD cost."
+    )
+    parser.add_argument(
+        "--max_run_tokens", type=int, help="Stop all sampling above this many tokens."
+    )
     parser.add_argument("--target_id", type=str)
     parser.add_argument(
         "--mock", action="store_true", help="Mock run to compute prompt tokens."
@@ -207,6 +283,17 @@ def main():
     parser.add_argument("--passing_tests", type=str, required=True)
 
     args = parser.parse_args()
+    configure_rate_limiter(args.rpm, args.tpm, args.rate_limit_file)
+    configure_accounting(
+        "regression_test_selection",
+        args.max_instance_cost,
+        args.max_instance_tokens,
+        args.max_run_cost,
+        args.max_run_tokens,
+    )
+    configure_response_cache(
+        args.response_cache, args.response_cache_size_mb, args.replay
+    )
 
     assert (not "deepseek" in args.model) or (
         args.backend == "deepseek"
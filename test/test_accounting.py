@@ -0,0 +1,120 @@
+import logging
+import threading
+import time
+
+import pytest
+
+from agentless.util.accounting import Budget, Ledger, configure_accounting, usage_cost
+from agentless.util.model import CachedDecoder, DecoderBase
+from agentless.util.response_cache import ResponseCache
+
+MODEL = "claude-3-5-sonnet-20241022"
+
+def test_ledger_budgets_and_hedges():
+    # Arrange
+    ledger = Ledger("repair", instance_budget=Budget(max_tokens=100))
+    model = MODEL
+
+    # Act
+    ledger.record(model, "a", {"prompt_tokens": 60, "completion_tokens": 10}, latency=1.0)
+    ledger.record_hedge(model, "a", {"prompt_tokens": 60})
+    summary = ledger.summary()
+
+    # Assert
+    assert summary["instances"]["a"]["tokens"] == 130
+    assert summary["instances"]["a"]["requests"] == 1
+    assert summary["instances"]["a"]["hedges"] == 1
+    assert summary["run"]["mean_latency"] == 1.0
+    assert summary["run"]["cost"] == pytest.approx(usage_cost(model, {"prompt_tokens": 120, "completion_tokens": 10}))
+    assert ledger.exhausted("a")
+    assert not ledger.exhausted("b")
+
+def test_ledger_latencies_use_a_fixed_histogram():
+    # Arrange
+    ledger = Ledger("repair")
+
+    # Act
+    for i in range(1, 1001):
+        ledger.record(MODEL, "a", {"prompt_tokens": 1}, latency=i / 100)
+    report = ledger.summary()["run"]
+
+    # Assert
+    assert report["requests"] == 1000
+    assert report["mean_latency"] == pytest.approx(5.005)
+    assert 9.5 <= report["p95_latency"] <= 9.5 * 1.25
+    assert "latencies" not in report
+
+def test_ledger_reservations_hold_back_parallel_requests():
+    # Arrange
+    ledger = Ledger("repair", instance_budget=Budget(max_tokens=100))
+    estimate = {"prompt_tokens": 50, "completion_tokens": 20}
+
+    # Act
+    first = ledger.try_reserve(MODEL, "a", estimate)
+    second = ledger.try_reserve(MODEL, "a", estimate)
+    third = ledger.try_reserve(MODEL, "a", estimate)
+    other_instance = ledger.try_reserve(MODEL, "b", estimate)
+    for _ in range(2):
+        ledger.settle(MODEL, "a", estimate, {"prompt_tokens": 20, "completion_tokens": 10}, latency=1.0)
+    after_cheap_requests = ledger.try_reserve(MODEL, "a", estimate)
+    ledger.settle(MODEL, "a", estimate, {"prompt_tokens": 50, "completion_tokens": 20}, latency=1.0)
+    after_budget = ledger.try_reserve(MODEL, "a", estimate)
+
+    # Assert
+    assert first is True and second is True
+    # the requests in flight may use up the budget
+    assert third is None
+    assert other_instance is True
+    assert after_cheap_requests is True
+    assert after_budget is False
+    assert ledger.summary()["instances"]["a"]["tokens"] == 130
+
+class _Decoder(DecoderBase):
+    def __init__(self, **kwargs):
+        super().__init__("claude-3-5-sonnet-20241022", logging.getLogger("test_accounting"), **kwargs)
+        self.in_flight, self.peak = 0, 0
+        self._lock = threading.Lock()
+
+    def codegen(self, message, num_samples=1, prompt_cache=False):
+        def _sample():
+            with self._lock:
+                self.in_flight += 1
+                self.peak = max(self.peak, self.in_flight)
+            time.sleep(0.05)
+            with self._lock:
+                self.in_flight -= 1
+            return {"response": "ok", "usage": {"prompt_tokens": 40, "completion_tokens": 10}}
+
+        return self._fan_out(_sample, num_samples, warm_first=False, estimate={"prompt_tokens": 40, "completion_tokens": 10})
+
+    def is_direct_completion(self):
+        return False
+
+def test_fan_out_does_not_overshoot_the_instance_budget():
+    # Arrange
+    ledger = configure_accounting("repair", max_instance_tokens=120)
+    decoder = _Decoder(max_parallel_samples=8, instance_id="a")
+
+    # Act
+    trajs = decoder.codegen("message", num_samples=8)
+
+    # Assert
+    assert [traj["response"] for traj in trajs].count("ok") == 3
+    assert ledger.summary()["instances"]["a"]["tokens"] == 150
+    assert ledger.summary()["instances"]["a"]["skipped"] == 5
+    assert decoder.peak == 3
+    configure_accounting("default")
+
+def test_cache_hits_are_counted(tmp_path):
+    # Arrange
+    ledger = configure_accounting("repair")
+    decoder = CachedDecoder(_Decoder(max_parallel_samples=1, instance_id="a"), ResponseCache(str(tmp_path / "cache.sqlite")))
+
+    # Act
+    decoder.codegen("message", num_samples=1)
+    decoder.codegen("message", num_samples=1)
+
+    # Assert
+    assert ledger.summary()["instances"]["a"]["requests"] == 1
+    assert ledger.summary()["instances"]["a"]["cache_hits"] == 1
+    configure_accounting("default")
@@ -0,0 +1,20 @@
+from agentless.util.client_pool import close_clients, configure_client_pool, get_pooled_client
+
+def test_pooled_clients_are_shared_per_backend_and_url(monkeypatch):
+    # Arrange
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    configure_client_pool(max_connections=4)
+
+    # Act
+    pooled = get_pooled_client("openai", "http://localhost:1/v1")
+    with pooled.in_use():
+        with pooled.in_use():
+            peak = pooled.metrics()["peak_active"]
+
+    # Assert
+    assert get_pooled_client("openai", "http://localhost:1/v1") is pooled
+    assert get_pooled_client("openai", "http://localhost:2/v1") is not pooled
+    assert peak == 2
+    assert pooled.metrics()["active"] == 0
+    assert pooled.max_connections == 4
+    close_clients()
@@ -0,0 +1,75 @@
+from agentless.util.context_packer import ContextPacker
+
+def _content(n_lines):
+    return "\n".join(f"x = {i}" for i in range(n_lines))
+
+def test_pack_admits_fine_grained_locs_first():
+    # Arrange
+    packer = ContextPacker(token_budget=50, max_window=0, approximate=True)
+    packer.add_file("a.py", _content(100), [(20, 60), (10, 10)])
+
+    # Act
+    report = packer.pack()
+
+    # Assert
+    assert report["a.py"]["locs"] == 1
+    assert report["a.py"]["dropped_locs"] == 1
+    assert report["a.py"]["tokens"] <= 50
+    assert packer.intervals("a.py") == [(10, 10)]
+
+def test_pack_drops_locs_outside_the_file():
+    # Arrange
+    packer = ContextPacker(token_budget=1000, max_window=0, approximate=True)
+    packer.add_file("a.py", _content(10), [(20, 30), (2, 3)])
+
+    # Act
+    report = packer.pack()
+
+    # Assert
+    assert report["a.py"]["locs"] == 1
+    assert report["a.py"]["dropped_locs"] == 1
+    assert packer.intervals("a.py") == [(2, 3)]
+
+def test_pack_grows_windows_up_to_max_window():
+    # Arrange
+    packer = ContextPacker(token_budget=10000, max_window=6, approximate=True)
+    packer.add_file("a.py", _content(100), [(50, 50), (2, 2)])
+
+    # Act
+    report = packer.pack()
+
+    # Assert
+    assert report["a.py"]["window"] == 6
+    # an interval starting at the first line starts at 0, like transfer_arb_locs_to_locs
+    assert packer.intervals("a.py") == [(0, 8), (44, 56)]
+    assert report["a.py"]["lines"] == 8 + 13
+
+def test_pack_stops_growing_windows_at_the_budget():
+    # Arrange
+    unbounded = ContextPacker(token_budget=10000, max_window=64, approximate=True)
+    unbounded.add_file("a.py", _content(1000), [(500, 500)])
+    budget = unbounded.pack()["a.py"]["tokens"] // 2
+    packer = ContextPacker(token_budget=budget, max_window=64, approximate=True)
+    packer.add_file("a.py", _content(1000), [(500, 500)])
+
+    # Act
+    report = packer.pack()
+
+    # Assert
+    assert report["a.py"]["tokens"] <= budget
+    assert 0 < report["a.py"]["window"] < 64
+    assert report["a.py"]["budget_share"] <= 1.0
+
+def test_pack_counts_shared_lines_once():
+    # Arrange
+    packer = ContextPacker(token_budget=10000, max_window=0, approximate=True)
+    packer.add_file("a.py", _content(100), [(10, 20), (15, 25)])
+    single = ContextPacker(token_budget=10000, max_window=0, approximate=True)
+    single.add_file("a.py", _content(100), [(10, 25)])
+
+    # Act
+    report = packer.pack()
+
+    # Assert
+    assert report["a.py"]["tokens"] == single.pack()["a.py"]["tokens"]
+    assert packer.intervals("a.py") == [(10, 25)]
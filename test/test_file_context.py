@@ -0,0 +1,207 @@
+import ast
+import random
+
+from agentless.util.parse_global_var import parse_global_var_from_code
+from agentless.util.preprocess_data import (
+    line_wrap_content,
+    merge_intervals,
+    transfer_arb_locs_to_locs,
+)
+from agentless.util.repo_index import (
+    RepoIndex,
+    get_full_file_paths_and_classes_and_functions,
+)
+
+SAMPLE_CODE = """
+import os
+
+LIMIT = 10
+x, y = 1, 2
+
+class Base:
+    def run(self):
+        return 1
+
+    def stop(self):
+        return 2
+
+class Child(Base):
+    def run(self):
+        return 3
+
+    @property
+    def name(self):
+        return "child"
+
+def run():
+    return Child().run()
+
+def helper(a, b):
+    return a + b
+""".strip()
+
+def _structure(pred_file, code):
+    # the same layout as get_repo_structure's parse_python_file
+    classes, functions = [], []
+    for node in ast.parse(code).body:
+        if isinstance(node, ast.ClassDef):
+            methods = [{"name": f.name, "start_line": f.lineno, "end_line": f.end_lineno} for f in node.body if isinstance(f, ast.FunctionDef)]
+            classes.append({"name": node.name, "start_line": node.lineno, "end_line": node.end_lineno, "methods": methods})
+        elif isinstance(node, ast.FunctionDef):
+            functions.append({"name": node.name, "start_line": node.lineno, "end_line": node.end_lineno})
+    return {pred_file: {"classes": classes, "functions": functions, "text": code.split("\n")}}
+
+def _reference_line_locs(locs, structure, pred_file, file_content):
+    """The linear scans transfer_arb_locs_to_locs used before it was indexed."""
+    _, classes, functions = get_full_file_paths_and_classes_and_functions(structure)
+    file_classes = [clazz for clazz in classes if clazz["file"] == pred_file]
+    global_vars = parse_global_var_from_code(file_content)
+    line_loc = []
+    for model_pred_locs in locs:
+        current_class_name = ""
+        for loc in model_pred_locs.splitlines():
+            if loc.startswith("class: ") and "." not in loc:
+                loc = loc[len("class: "):].strip()
+                relevant_class = [clazz for clazz in file_classes if clazz["name"] == loc]
+                if relevant_class:
+                    line_loc.append((relevant_class[0]["start_line"], relevant_class[0]["end_line"]))
+                    current_class_name = loc
+            elif loc.startswith("function: ") or "." in loc:
+                loc = loc.split(":", 1)[-1].strip()
+                if "." in loc:
+                    class_name, method_name = loc.split(".")[0], loc.split(".")[1]
+                    relevant_class = [clazz for clazz in file_classes if clazz["name"] == class_name]
+                    methods = [m for m in relevant_class[0]["methods"] if m["name"] == method_name] if relevant_class else []
+                    if methods:
+                        line_loc.append((methods[0]["start_line"], methods[0]["end_line"]))
+                    continue
+                relevant_function = [f for f in functions if f["file"] == pred_file and f["name"] == loc]
+                if relevant_function:
+                    line_loc.append((relevant_function[0]["start_line"], relevant_function[0]["end_line"]))
+                elif current_class_name != "":
+                    relevant_class = [clazz for clazz in file_classes if clazz["name"] == current_class_name]
+                    methods = [m for m in relevant_class[0]["methods"] if m["name"] == loc]
+                    if methods:
+                        line_loc.append((methods[0]["start_line"], methods[0]["end_line"]))
+                else:
+                    methods = [m for clazz in file_classes for m in clazz["methods"] if m["name"] == loc]
+                    if len(methods) == 1:
+                        line_loc.append((methods[0]["start_line"], methods[0]["end_line"]))
+            elif loc.startswith("line: "):
+                try:
+                    line = int(loc[len("line: "):].strip().split()[0])
+                except ValueError:
+                    continue
+                line_loc.append((line, line))
+            elif loc.startswith("variable:"):
+                for v in loc[len("variable:"):].strip().split():
+                    if v in global_vars:
+                        line_loc.append((global_vars[v]["start_line"], global_vars[v]["end_line"]))
+    return line_loc
+
+def test_transfer_arb_locs_to_locs_matches_linear_scans():
+    # Arrange
+    pred_file = "pkg/sample.py"
+    structure = _structure(pred_file, SAMPLE_CODE)
+    names = ["Base", "Child", "run", "stop", "name", "helper", "nope"]
+    kinds = ["class: {}", "function: {}", "{}.{}", "class: {}.{}", "{}", "line: 7", "line: x", "variable: LIMIT y", "variable: nope", "junk"]
+    rng = random.Random(0)
+    cases = []
+    for _ in range(300):
+        n_locs = rng.randint(1, 5)
+        cases.append(["\n".join(rng.choice(kinds).format(rng.choice(names), rng.choice(names)) for _ in range(n_locs))])
+
+    for locs in cases:
+        for source, repo_index in ((structure, None), (structure, RepoIndex(structure)), (None, None)):
+            # Act
+            line_loc, _ = transfer_arb_locs_to_locs(locs, source, pred_file, loc_interval=True, file_content=SAMPLE_CODE, repo_index=repo_index)
+
+            # Assert
+            assert line_loc == _reference_line_locs(locs, structure, pred_file, SAMPLE_CODE), locs
+
+def _reference_line_wrap_content(content, context_intervals=None, add_space=False, no_line_number=False, sticky_scroll=False):
+    """line_wrap_content as it was before it rendered the intervals in one pass."""
+
+    def is_scope(line):
+        return line.startswith("class ") or line.strip().startswith("def ")
+
+    lines = content.split("\n")
+    new_lines = []
+    if context_intervals is None or context_intervals == []:
+        context_intervals = [(0, len(lines))]
+
+    prev_scopes = []
+    line_format = "{line}"
+    if not no_line_number:
+        line_format = "{line_number}|{line}" if not add_space else "{line_number}| {line} "
+    for interval in context_intervals:
+        min_line, max_line = interval
+
+        if min_line != 0:
+            new_lines.append("...")
+
+        scopes = []
+        for i, line in enumerate(lines):
+            if sticky_scroll:
+                if is_scope(line):
+                    indent_level = len(line) - len(line.lstrip())
+                    while scopes and scopes[-1]["indent_level"] >= indent_level:
+                        scopes.pop()
+                    scopes.append({"line": line, "line_number": i, "indent_level": indent_level})
+
+            if min_line != -1 and i < min_line - 1:
+                continue
+            if sticky_scroll and i == min_line - 1:
+                last_scope_line = None
+                for j, scope_line in enumerate(scopes):
+                    if len(prev_scopes) > j and prev_scopes[j]["line_number"] == scope_line["line_number"]:
+                        continue
+                    if i == scope_line["line_number"]:
+                        continue
+                    new_lines.append(line_format.format(line_number=scope_line["line_number"] + 1, line=scope_line["line"]))
+                    last_scope_line = scope_line["line_number"]
+                if last_scope_line is not None and last_scope_line < i - 1:
+                    new_lines.append("...")
+
+            new_lines.append(line_format.format(line_number=i + 1, line=line))
+            if max_line != -1 and i >= max_line - 1:
+                break
+        prev_scopes = scopes
+
+    if max_line != len(lines):
+        new_lines.append("...")
+
+    return "\n".join(new_lines)
+
+def _generated_code(n_classes=10, n_methods=5, n_body=6):
+    # no blank or top-level lines between scopes, where indentation and syntax disagree
+    lines = []
+    for c in range(n_classes):
+        lines.append(f"class Class{c}:")
+        for m in range(n_methods):
+            lines.append(f"    def method{m}(self):")
+            lines.extend(f"        value = {c * m + b}" for b in range(n_body))
+        lines.append(f"def function{c}():")
+        lines.extend(f"    return {c + b}" for b in range(n_body))
+    return "\n".join(lines)
+
+def test_line_wrap_content_matches_reference():
+    # Arrange
+    content = _generated_code()
+    n_lines = len(content.split("\n"))
+    rng = random.Random(0)
+    cases = [[], [(0, n_lines)], [(0, 5)], [(n_lines - 3, n_lines)]]
+    for _ in range(50):
+        intervals = []
+        for _ in range(rng.randint(1, 6)):
+            start = rng.randint(0, n_lines)
+            intervals.append((start, min(start + rng.randint(0, 15), n_lines)))
+        cases.append(merge_intervals(intervals))
+
+    for intervals in cases:
+        for options in ({}, {"add_space": True}, {"no_line_number": True}, {"sticky_scroll": True}):
+            # Act
+            wrapped = line_wrap_content(content, list(intervals), **options)
+
+            # Assert
+            assert wrapped == _reference_line_wrap_content(content, list(intervals), **options), (intervals, options)
@@ -0,0 +1,75 @@
+import asyncio
+import logging
+import time
+
+from agentless.util.hedging import HedgePolicy
+
+logger = logging.getLogger("test_hedging")
+
+def _slow_first_copy(calls):
+    def request(copy):
+        calls.append(copy)
+        copy.sent = True
+        if len(calls) == 1:
+            # streams until cancelled
+            while not copy.cancelled.is_set():
+                time.sleep(0.01)
+            return None
+        return "hedge"
+
+    return request
+
+def test_hedge_policy_cancels_the_losing_copy():
+    # Arrange
+    policy = HedgePolicy(enabled=True, max_hedge_rate=1.0, min_samples=1)
+    policy._record("model", 0.05, False)
+    calls, discarded = [], []
+
+    # Act
+    ret = policy.call(_slow_first_copy(calls), "model", logger, on_discard=discarded.append)
+    time.sleep(0.1)
+
+    # Assert
+    assert ret == "hedge"
+    assert calls[0].cancelled.is_set()
+    assert discarded == [None]
+    assert policy.metrics()["hedge_wins"] == 1
+
+def test_hedge_policy_respects_the_hedge_rate():
+    # Arrange
+    policy = HedgePolicy(enabled=True, max_hedge_rate=0.0, min_samples=1)
+    policy._record("model", 0.01, False)
+
+    # Act
+    ret = policy.call(lambda copy: time.sleep(0.05) or "primary", "model", logger)
+
+    # Assert
+    assert ret == "primary"
+    assert policy.metrics()["hedges"] == 0
+    assert policy.metrics()["capped"] == 1
+
+def test_hedge_policy_cancels_async_copies():
+    # Arrange
+    policy = HedgePolicy(enabled=True, max_hedge_rate=1.0, min_samples=1)
+    policy._record("model", 0.05, False)
+    calls, discarded = [], []
+
+    async def request(copy):
+        calls.append(copy)
+        copy.sent = True
+        if len(calls) == 1:
+            await asyncio.sleep(10)
+            return "primary"
+        return "hedge"
+
+    async def run():
+        ret = await policy.acall(request, "model", logger, on_discard=discarded.append)
+        await asyncio.sleep(0)
+        return ret
+
+    # Act
+    ret = asyncio.run(run())
+
+    # Assert
+    assert ret == "hedge"
+    assert discarded == [None]
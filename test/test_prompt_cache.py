@@ -0,0 +1,24 @@
+from agentless.util.prompt_cache import min_cacheable_tokens, plan_prompt
+
+def test_plan_prompt_moves_long_static_text_to_the_instructions():
+    # Arrange
+    template = "Issue:\n{problem_statement}\n\n{instruction}\nFile:\n{content}\n\nPlease fix it.\n\n{rules}"
+    fields = dict(problem_statement="bug", instruction="Files below.", content="code", rules="r" * 8000)
+
+    # Act
+    short = plan_prompt(template, static_fields=("instruction",), rules="", **{k: v for k, v in fields.items() if k != "rules"})
+    planned = plan_prompt(template, static_fields=("instruction", "rules"), **fields)
+
+    # Assert
+    assert short == template.format(rules="", **{k: v for k, v in fields.items() if k != "rules"}).strip()
+    assert short.instructions == "" and short.body == short
+    assert planned == template.format(**fields).strip()
+    assert planned.instructions.startswith("Files below.\n\n")
+    assert "Please fix it." in planned.instructions
+    assert "Files below." not in planned.body
+    assert planned.body.startswith("Issue:\nbug") and planned.body.endswith("code")
+
+def test_min_cacheable_tokens_depends_on_the_model():
+    # Act / Assert
+    assert min_cacheable_tokens("claude-3-5-sonnet-20241022") == 1024
+    assert min_cacheable_tokens("claude-3-haiku-20240307") == 2048
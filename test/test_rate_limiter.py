@@ -0,0 +1,47 @@
+import time
+
+from agentless.util.rate_limiter import RateLimiter, TokenBucket
+
+def test_token_bucket_refills_up_to_capacity():
+    # Arrange
+    bucket = TokenBucket(per_minute=60)
+
+    # Act
+    refilled = bucket.level(10, last=0.0, now=5.0)
+    full = bucket.level(10, last=0.0, now=600.0)
+
+    # Assert
+    assert refilled == 15
+    assert full == 60
+    assert bucket.wait_time(level=15, amount=20) == 5
+    # a request larger than the bucket only waits for a full bucket
+    assert bucket.wait_time(level=60, amount=1000) == 0
+
+def test_rate_limiter_waits_once_the_bucket_is_empty():
+    # Arrange
+    limiter = RateLimiter(rpm=600)
+    for _ in range(600):
+        limiter.acquire()
+
+    # Act
+    start_time = time.time()
+    waited = limiter.acquire()
+
+    # Assert
+    assert 0 < waited <= 0.1
+    assert time.time() - start_time >= waited
+    assert limiter.metrics()["throttled"] == 1
+    assert limiter.metrics()["acquired"] == 601
+
+def test_rate_limiter_shares_buckets_through_the_lock_file(tmp_path):
+    # Arrange
+    lock_file = str(tmp_path / "limits.json")
+    first = RateLimiter(rpm=60, tpm=1000, lock_file=lock_file)
+    second = RateLimiter(rpm=60, tpm=1000, lock_file=lock_file)
+
+    # Act
+    first.acquire(tokens=999)
+    wait = second._try_acquire({"requests": 1, "tokens": 500})
+
+    # Assert
+    assert wait > 20
@@ -0,0 +1,87 @@
+import json
+
+from agentless.util.preprocess_data import get_repo_files
+from agentless.util.repo_index import (
+    RepoIndex,
+    get_full_file_paths_and_classes_and_functions,
+)
+
+def _file(classes, functions, text):
+    return {"classes": classes, "functions": functions, "text": text}
+
+def _structure():
+    return {
+        "pkg": {
+            "calc.py": _file(
+                [
+                    {
+                        "name": "Calc",
+                        "start_line": 1,
+                        "end_line": 5,
+                        "methods": [
+                            {"name": "add", "start_line": 2, "end_line": 3},
+                            {"name": "sub", "start_line": 4, "end_line": 5},
+                        ],
+                    }
+                ],
+                [{"name": "helper", "start_line": 7, "end_line": 8}],
+                [
+                    "class Calc:",
+                    "    def add(self, a, b):",
+                    "        return a + b",
+                    "    def sub(self, a, b):",
+                    "        return a - b",
+                    "",
+                    "def helper():",
+                    "    return Calc()",
+                ],
+            ),
+            "test_calc.py": _file([], [], ["def test_add():", "    pass"]),
+        },
+        "setup.py": _file([], [{"name": "main", "start_line": 1, "end_line": 1}], ["main()"]),
+        "README.md": None,
+    }
+
+
+def test_repo_index_matches_linear_scans():
+    # Arrange
+    structure = _structure()
+    # a class defined twice in one file: the linear scans take the first definition
+    structure["pkg"]["other.py"] = _file(
+        [
+            {"name": "Calc", "start_line": 1, "end_line": 2, "methods": [{"name": "add", "start_line": 2, "end_line": 2}]},
+            {"name": "Calc", "start_line": 4, "end_line": 5, "methods": [{"name": "mul", "start_line": 5, "end_line": 5}]},
+        ],
+        [{"name": "helper", "start_line": 7, "end_line": 7}],
+        ["class Calc:", "    def add(self): pass", "", "class Calc:", "    def mul(self): pass", "", "def helper(): pass"],
+    )
+    files, classes, functions = get_full_file_paths_and_classes_and_functions(json.loads(json.dumps(structure)))
+
+    # Act
+    index = RepoIndex(structure)
+
+    # Assert
+    for clazz in classes:
+        first = next(c for c in classes if c["file"] == clazz["file"] and c["name"] == clazz["name"])
+        assert index.class_spans[(clazz["file"], clazz["name"])] == (first["start_line"], first["end_line"])
+        for method in first["methods"]:
+            assert index.method_spans[(clazz["file"], clazz["name"], method["name"])] == (method["start_line"], method["end_line"])
+    for function in functions:
+        assert index.function_spans[(function["file"], function["name"])] == (function["start_line"], function["end_line"])
+    for entry in files:
+        if isinstance(entry, tuple):
+            assert index.file_text(entry[0]) == "\n".join(entry[1])
+    assert index.file_text("README.md") is None
+
+
+def test_get_repo_files_uses_the_given_index():
+    # Arrange
+    structure = _structure()
+    index = RepoIndex(structure)
+
+    # Act
+    contents = get_repo_files(structure, ["pkg/calc.py", "setup.py"], repo_index=index)
+
+    # Assert
+    assert contents == get_repo_files(structure, ["pkg/calc.py", "setup.py"])
+    assert contents["setup.py"] == "main()"
@@ -0,0 +1,32 @@
+import pytest
+
+from agentless.util.response_cache import ReplayMissError, ResponseCache, request_key
+
+def test_response_cache_round_trip_and_eviction(tmp_path):
+    # Arrange
+    cache = ResponseCache(str(tmp_path / "cache.sqlite"), max_bytes=250)
+    request = {"model": "m", "messages": [{"role": "user", "content": "hi"}]}
+    key = request_key(request)
+
+    # Act
+    cache.put(key, [{"response": "hello"}])
+    hit = cache.get(key)
+    for i in range(10):
+        cache.put(f"filler-{i}", [{"response": "x" * 50}])
+
+    # Assert
+    assert key == request_key(dict(reversed(list(request.items()))))
+    assert hit == [{"response": "hello"}]
+    assert cache.get(key) is None
+    assert cache.stats()["size_bytes"] <= 250
+
+def test_response_cache_replay_raises_on_miss(tmp_path):
+    # Arrange
+    path = str(tmp_path / "cache.sqlite")
+    ResponseCache(path).put("recorded", [{"response": "hello"}])
+    replay = ResponseCache(path, replay=True)
+
+    # Act / Assert
+    assert replay.get("recorded") == [{"response": "hello"}]
+    with pytest.raises(ReplayMissError):
+        replay.get("missing")
@@ -0,0 +1,80 @@
+import logging
+import time
+
+import pytest
+
+from agentless.util.retry_policy import AttemptMetrics, RetryPolicy, call_with_retries, retry_after_seconds
+
+logger = logging.getLogger("test_retry_policy")
+
+def test_call_with_retries_retries_until_success(monkeypatch):
+    # Arrange
+    monkeypatch.setattr(time, "sleep", lambda seconds: None)
+    attempts = []
+
+    def request():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise ConnectionError("reset")
+        return "response"
+
+    # Act
+    ret = call_with_retries(request, logger, "test", RetryPolicy(max_retries=5))
+
+    # Assert
+    assert ret == "response"
+    assert len(attempts) == 3
+
+def test_call_with_retries_raises_fatal_errors():
+    # Arrange
+    def request():
+        raise ValueError("bad request")
+
+    # Act / Assert
+    with pytest.raises(ValueError):
+        call_with_retries(request, logger, "test", RetryPolicy(), is_fatal=lambda e: isinstance(e, ValueError))
+
+def test_call_with_retries_gives_up_at_the_deadline():
+    # Arrange
+    policy = RetryPolicy(base_delay=10, max_retries=5, deadline=1)
+
+    def request():
+        raise ConnectionError("reset")
+
+    # Act
+    ret = call_with_retries(request, logger, "test", policy)
+
+    # Assert
+    assert ret is None
+
+def test_retry_after_seconds_reads_rate_limit_headers():
+    # Arrange
+    class Response:
+        def __init__(self, headers):
+            self.headers = headers
+
+    class Error(Exception):
+        def __init__(self, headers):
+            self.response = Response(headers)
+
+    # Act / Assert
+    assert retry_after_seconds(Error({"retry-after-ms": "1500"})) == 1.5
+    assert retry_after_seconds(Error({"retry-after": "3"})) == 3
+    assert retry_after_seconds(Error({"x-ratelimit-reset-tokens": "6m0s"})) == 360
+    assert retry_after_seconds(Error({})) is None
+
+def test_attempt_metrics_percentiles_are_bucket_bounds():
+    # Arrange
+    metrics = AttemptMetrics()
+
+    # Act
+    for i in range(1, 101):
+        metrics.record("test", i / 10, "ok" if i % 10 else "RateLimitError")
+    summary = metrics.summary()["test"]
+
+    # Assert
+    assert summary["attempts"] == 100
+    assert summary["outcomes"] == {"ok": 90, "RateLimitError": 10}
+    assert summary["max_latency"] == 10.0
+    assert 5.0 <= summary["p50_latency"] <= 5.0 * 1.25
+    assert 9.5 <= summary["p95_latency"] <= 10.0
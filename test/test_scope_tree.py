@@ -0,0 +1,69 @@
+from agentless.util.scope_tree import ScopeTree, build_scope_tree, get_scope_tree
+
+SAMPLE_CODE = """
+import os
+
+LIMIT = 10
+x, y = 1, 2
+
+class Base:
+    def run(self):
+        return 1
+
+    def stop(self):
+        return 2
+
+class Child(Base):
+    def run(self):
+        return 3
+
+    @property
+    def name(self):
+        return "child"
+
+def run():
+    return Child().run()
+
+def helper(a, b):
+    return a + b
+""".strip()
+
+def test_scope_tree_enclosing_scopes():
+    # Arrange
+    tree = build_scope_tree(SAMPLE_CODE)
+
+    # Act
+    scopes = [tree.enclosing(line) for line in range(1, 26)]
+
+    # Assert
+    assert scopes[0] == ()
+    assert scopes[5] == (6,)
+    assert scopes[6] == (6, 7)
+    # a blank line after a scope closes it, and a decorated method starts at its def line
+    assert scopes[8] == (6,)
+    assert scopes[16] == (13,)
+    assert scopes[17] == (13, 18)
+    assert scopes[19] == ()
+    assert scopes[21] == (21,)
+
+def test_scope_tree_falls_back_to_indentation():
+    # Arrange
+    content = SAMPLE_CODE + "\n    )"
+    lines = content.split("\n")
+
+    # Act
+    tree = build_scope_tree(content)
+
+    # Assert
+    expected = ScopeTree.from_indentation(lines)
+    assert [tree.enclosing(i) for i in range(1, len(lines) + 1)] == [expected.enclosing(i) for i in range(1, len(lines) + 1)]
+    # the indentation guess keeps a scope open until the next scope line
+    assert tree.enclosing(9) == (6, 7)
+
+def test_get_scope_tree_is_shared_per_content():
+    # Act
+    tree = get_scope_tree(SAMPLE_CODE)
+
+    # Assert
+    assert get_scope_tree(SAMPLE_CODE) is tree
+    assert get_scope_tree(SAMPLE_CODE + "\n") is not tree
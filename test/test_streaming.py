@@ -0,0 +1,39 @@
+from agentless.util.streaming import EditBlockWatcher
+
+EDIT = "```python\n### a.py\n<<<<<<< SEARCH\nx\n=======\ny\n>>>>>>> REPLACE\n```"
+
+def test_edit_block_watcher_stops_at_the_last_block():
+    # Arrange
+    watcher = EditBlockWatcher(stop_after_blocks=2)
+
+    # Act
+    done_after_plain_code = watcher.feed("Reasoning\n```python\nprint(1)\n```\n")
+    done_after_first_edit = watcher.feed(EDIT)
+    watcher.feed("\n" + "a long explanation of the next edit " * 50)
+    done_before_second_edit = watcher.feed("\n```py")
+    done_after_second_edit = watcher.feed("thon\n" + EDIT[len("```python\n"):] + "\nDone.")
+
+    # Assert
+    assert not done_after_plain_code
+    assert not done_after_first_edit
+    assert not done_before_second_edit
+    assert done_after_second_edit
+    assert watcher.blocks == 2
+    assert watcher.result().endswith(">>>>>>> REPLACE\n```\nDone.")
+
+def test_edit_block_watcher_waits_for_a_quiet_window():
+    # Arrange
+    watcher = EditBlockWatcher(stop_after_blocks=1, quiet_chars=20)
+
+    # Act
+    done_after_edit = watcher.feed(EDIT)
+    done_with_next_fence = watcher.feed("\nand another ```py")
+    watcher.feed("thon\n" + EDIT[len("```python\n"):])
+    done_when_quiet = watcher.feed("\n" + "trailing text " * 5)
+
+    # Assert
+    assert not done_after_edit
+    assert not done_with_next_fence
+    assert done_when_quiet
+    assert watcher.blocks == 2
+    assert watcher.result().endswith("trailing text ")
@@ -0,0 +1,127 @@
+import json
+import os
+import time
+
+from agentless.util.repo_index import structure_digest
+from agentless.util.structure_store import (
+    LazyFile,
+    _view_cache,
+    open_structure,
+    write_structure_store,
+)
+
+def _file(classes, functions, text):
+    return {"classes": classes, "functions": functions, "text": text}
+
+def _structure():
+    return {
+        "pkg": {
+            "calc.py": _file(
+                [
+                    {
+                        "name": "Calc",
+                        "start_line": 1,
+                        "end_line": 5,
+                        "methods": [
+                            {"name": "add", "start_line": 2, "end_line": 3},
+                            {"name": "sub", "start_line": 4, "end_line": 5},
+                        ],
+                    }
+                ],
+                [{"name": "helper", "start_line": 7, "end_line": 8}],
+                [
+                    "class Calc:",
+                    "    def add(self, a, b):",
+                    "        return a + b",
+                    "    def sub(self, a, b):",
+                    "        return a - b",
+                    "",
+                    "def helper():",
+                    "    return Calc()",
+                ],
+            ),
+            "test_calc.py": _file([], [], ["def test_add():", "    pass"]),
+        },
+        "setup.py": _file([], [{"name": "main", "start_line": 1, "end_line": 1}], ["main()"]),
+        "README.md": None,
+    }
+
+def _plain(structure):
+    # the plain dicts behind a lazy structure
+    plain = {}
+    for name, content in structure.items():
+        if isinstance(content, LazyFile):
+            plain[name] = {**content, "text": list(content["text"])}
+        elif isinstance(content, dict):
+            plain[name] = _plain(content)
+        else:
+            plain[name] = content
+    return plain
+
+def test_structure_store_round_trip(tmp_path):
+    # Arrange
+    path = str(tmp_path / "instance.struct")
+    structure = _structure()
+
+    # Act
+    write_structure_store(structure, path)
+    lazy = open_structure(path)
+
+    # Assert
+    assert _plain(lazy) == structure
+    assert lazy.digest == structure_digest(structure)
+
+def test_structure_store_decodes_files_on_access(tmp_path):
+    # Arrange
+    path = str(tmp_path / "instance.struct")
+    write_structure_store(_structure(), path)
+    lazy = open_structure(path)
+    misses = _view_cache.stats()["misses"]
+
+    # Act
+    text = lazy["pkg"]["calc.py"]["text"]
+    n_lines = len(text)
+    misses_after_len = _view_cache.stats()["misses"]
+    first_line = text[0]
+
+    # Assert
+    assert n_lines == 8
+    assert misses_after_len == misses
+    assert first_line == "class Calc:"
+    assert _view_cache.stats()["misses"] == misses + 1
+
+def test_open_structure_returns_a_fresh_structure(tmp_path):
+    # Arrange
+    path = str(tmp_path / "instance.struct")
+    write_structure_store(_structure(), path)
+    filtered = open_structure(path)
+
+    # Act
+    del filtered["pkg"]["test_calc.py"]
+    del filtered["README.md"]
+    filtered["pkg"]["calc.py"]["classes"][0]["methods"].clear()
+    structure = open_structure(path)
+
+    # Assert
+    assert "test_calc.py" in structure["pkg"]
+    assert "README.md" in structure
+    assert len(structure["pkg"]["calc.py"]["classes"][0]["methods"]) == 2
+
+def test_stale_structure_store_is_skipped(tmp_path, monkeypatch):
+    # Arrange
+    from agentless.util import preprocess_data
+
+    structure = _structure()
+    write_structure_store(structure, str(tmp_path / "instance.struct"))
+    structure["pkg"]["new.py"] = _file([], [], ["x = 1"])
+    json_path = tmp_path / "instance.json"
+    json_path.write_text(json.dumps({"structure": structure}))
+    future = time.time() + 10
+    os.utime(json_path, (future, future))
+    monkeypatch.setattr(preprocess_data, "PROJECT_FILE_LOC", str(tmp_path))
+
+    # Act
+    loaded = preprocess_data.get_repo_structure("instance", "repo", "commit", "playground")
+
+    # Assert
+    assert "new.py" in loaded["pkg"]
@@ -1,4 +1,5 @@
 import networkx as nx
+from callgraph_analysis.change_journal import ChangeJournal
 from callgraph_analysis.synchronous_repair import SynchronousRepair
 
 def test_propagate_changes():
@@ -15,3 +16,60 @@ def test_propagate_changes():
 
     # Assert
     assert graph.nodes["file1.py:var1"]["parameters"] == "float"
+
+def test_change_journal_rollback():
+    # Arrange
+    graph = nx.DiGraph()
+    graph.add_node("file1.py:func1", type="function", parameters="a, b")
+    graph.add_node("file1.py:func2", type="function", parameters="a")
+    graph.add_edge("file1.py:func1", "file1.py:func2")
+    repair = SynchronousRepair(graph)
+    snapshot = repair.snapshot()
+
+    # Act
+    repair.propagate_changes("file1.py:func1")
+    log = repair.get_change_log("file1.py:func2")
+    repair.rollback(snapshot)
+
+    # Assert
+    assert [(e["field"], e["old"], e["new"]) for e in log] == [("parameters", "a", "a, b")]
+    assert "change_log" not in graph.nodes["file1.py:func2"]
+    assert graph.nodes["file1.py:func2"]["parameters"] == "a"
+    assert repair.get_change_log("file1.py:func2") == []
+
+def test_change_journal_rollback_restores_explicit_none():
+    # Arrange
+    graph = nx.DiGraph()
+    graph.add_node("file1.py:func1", parameters="a, b")
+    graph.add_node("file1.py:func2", parameters=None)
+    graph.add_node("file1.py:func3")
+    graph.add_edge("file1.py:func1", "file1.py:func2")
+    graph.add_edge("file1.py:func1", "file1.py:func3")
+    repair = SynchronousRepair(graph)
+    snapshot = repair.snapshot()
+
+    # Act
+    repair.propagate_changes("file1.py:func1")
+    repair.rollback(snapshot)
+
+    # Assert
+    assert "parameters" in graph.nodes["file1.py:func2"]
+    assert graph.nodes["file1.py:func2"]["parameters"] is None
+    assert "parameters" not in graph.nodes["file1.py:func3"]
+
+def test_change_journal_save_and_load(tmp_path):
+    # Arrange
+    graph = nx.DiGraph()
+    graph.add_node("file1.py:func1", parameters="x")
+    graph.add_node("file1.py:func2")
+    graph.add_edge("file1.py:func1", "file1.py:func2")
+    repair = SynchronousRepair(graph)
+    repair.propagate_changes("file1.py:func1")
+
+    # Act
+    repair.journal.save(tmp_path / "journal.json")
+    loaded = ChangeJournal.load(tmp_path / "journal.json")
+
+    # Assert
+    assert loaded.events() == repair.journal.events()
+    assert loaded.events_for("file1.py:func2")[0]["source"] == "file1.py:func1"
@@ -1,3 +1,7 @@
+import time
+
+from callgraph_analysis.callgraph import create_graph
+from callgraph_analysis.test_history import TestHistory
 from callgraph_analysis.validation import Validation
 
 def test_validation():
@@ -9,3 +13,209 @@ def test_validation():
 
     # Assert
     assert result is True or result is False
+
+def _write_project(project_dir):
+    project_dir.mkdir()
+    (project_dir / "calc.py").write_text("def add(a, b):\n    return a + b\n")
+    (project_dir / "other.py").write_text("def mul(a, b):\n    return a * b\n")
+    (project_dir / "test_calc.py").write_text("from calc import add\n\ndef test_add():\n    assert add(1, 2) == 3\n")
+    (project_dir / "test_other.py").write_text("from other import mul\n\ndef test_mul():\n    assert mul(2, 3) == 6\n")
+
+def test_validation_selects_affected_tests(tmp_path):
+    # Arrange
+    project_dir = tmp_path / "proj"
+    _write_project(project_dir)
+    graph = create_graph(str(project_dir))
+    validator = Validation(test_command="pytest", test_dir=str(project_dir), graph=graph)
+
+    # Act
+    selected, total = validator.select_tests(["proj/calc.py:add"])
+    result = validator.validate_changes(changed_nodes=["proj/calc.py:add"])
+
+    # Assert
+    assert selected == [str(project_dir / "test_calc.py") + "::test_add"]
+    assert total == 2
+    assert result is True
+    assert validator.last_report["fraction"] == 0.5
+
+def test_validation_selects_tests_using_module_imports(tmp_path):
+    # Arrange
+    project_dir = tmp_path / "proj"
+    _write_project(project_dir)
+    (project_dir / "test_calc.py").write_text("import calc\n\ndef test_add():\n    assert calc.add(1, 2) == 3\n")
+    (project_dir / "calc.py").write_text("def add(a, b):\n    return a - b\n")
+    graph = create_graph(str(project_dir))
+    validator = Validation(test_command="pytest", test_dir=str(project_dir), graph=graph)
+
+    # Act
+    selected, total = validator.select_tests(["proj/calc.py:add"])
+    result = validator.validate_changes(changed_nodes=["proj/calc.py:add"])
+
+    # Assert
+    assert selected == [str(project_dir / "test_calc.py") + "::test_add"]
+    assert result is False
+
+def test_validation_runs_full_suite_without_selection(tmp_path):
+    # Arrange
+    project_dir = tmp_path / "proj"
+    _write_project(project_dir)
+    (project_dir / "test_fail.py").write_text("def test_fail():\n    assert False\n")
+    graph = create_graph(str(project_dir))
+    validator = Validation(test_command="pytest", test_dir=str(project_dir), graph=graph)
+
+    # Act
+    result = validator.validate_changes(changed_nodes=["proj/unknown.py:f"])
+
+    # Assert
+    assert result is False
+    assert validator.last_report["fraction"] == 1.0
+
+def test_validation_sharded(tmp_path):
+    # Arrange
+    project_dir = tmp_path / "proj"
+    _write_project(project_dir)
+    validator = Validation(test_command="pytest", test_dir=str(project_dir), num_shards=2, log_dir=str(tmp_path / "logs"))
+
+    # Act
+    result = validator.validate_changes()
+
+    # Assert
+    assert result is True
+    assert sorted(outcome["outcome"] for outcome in validator.last_results.values()) == ["passed", "passed"]
+    assert (tmp_path / "logs" / "shard_0.log").exists()
+    assert (tmp_path / "logs" / "shard_1.log").exists()
+    assert (tmp_path / "logs" / "junit.xml").exists()
+
+def test_validation_records_history(tmp_path):
+    # Arrange
+    project_dir = tmp_path / "proj"
+    _write_project(project_dir)
+    history = TestHistory(str(tmp_path / "history.db"))
+    validator = Validation(test_command="pytest", test_dir=str(project_dir), log_dir=str(tmp_path / "logs"), history=history, repo="proj")
+    history.record("proj", "abc", {"test_other.py::test_mul": {"outcome": "failed", "duration": 0.1}})
+    history.record("proj", "abc", {"test_other.py::test_mul": {"outcome": "passed", "duration": 0.1}})
+
+    # Act
+    result = validator.validate_changes()
+
+    # Assert
+    assert result is True
+    assert set(history.durations("proj")) == {"test_calc.py::test_add", "test_other.py::test_mul"}
+    assert history.flaky_tests("proj") == {"test_other.py::test_mul"}
+    assert history.order("proj", ["test_calc.py::test_add", "test_other.py::test_mul"])[0] == "test_other.py::test_mul"
+
+def test_validation_warm_workers(tmp_path):
+    # Arrange
+    project_dir = tmp_path / "proj"
+    _write_project(project_dir)
+    (project_dir / "test_fail.py").write_text("def test_fail():\n    assert False\n")
+    validator = Validation(test_command="pytest", test_dir=str(project_dir), warm_workers=1)
+
+    # Act
+    passed = validator.validate_specific_test(str(project_dir / "test_calc.py"))
+    failed = validator.validate_specific_test(str(project_dir / "test_fail.py"))
+    validator.close()
+
+    # Assert
+    assert passed is True
+    assert failed is False
+    assert validator.last_report["startup_time_saved"] > 0.0
+
+def test_validation_warm_workers_timeout(tmp_path):
+    # Arrange
+    project_dir = tmp_path / "proj"
+    _write_project(project_dir)
+    (project_dir / "test_slow.py").write_text("import time\n\ndef test_slow():\n    time.sleep(60)\n")
+    validator = Validation(test_command="pytest", test_dir=str(project_dir), warm_workers=1, timeout=5)
+
+    # Act
+    start_time = time.time()
+    result = validator.validate_specific_test(str(project_dir / "test_slow.py"))
+    passed = validator.validate_specific_test(str(project_dir / "test_calc.py"))
+    validator.close()
+
+    # Assert
+    assert result is False
+    assert time.time() - start_time < 30
+    assert passed is True
+
+def test_validation_timeout_returns_partial_results(tmp_path):
+    # Arrange
+    project_dir = tmp_path / "proj"
+    _write_project(project_dir)
+    (project_dir / "test_slow.py").write_text("import time\n\ndef test_slow():\n    time.sleep(60)\n")
+    validator = Validation(test_command="pytest", test_dir=str(project_dir), timeout=5)
+
+    # Act
+    result = validator.validate_changes()
+
+    # Assert
+    assert result is False
+    assert [result["outcome"] for test_id, result in validator.last_results.items() if test_id.endswith("test_calc.py::test_add")] == ["passed"]
+
+def test_validation_maxfail_stops_early(tmp_path):
+    # Arrange
+    project_dir = tmp_path / "proj"
+    _write_project(project_dir)
+    (project_dir / "test_a_fail.py").write_text("def test_fail():\n    assert False\n")
+    (project_dir / "test_z_slow.py").write_text("import time\n\ndef test_slow():\n    time.sleep(60)\n")
+    validator = Validation(test_command="pytest", test_dir=str(project_dir), num_shards=2, log_dir=str(tmp_path / "logs"), maxfail=1, timeout=30)
+
+    # Act
+    start_time = time.time()
+    result = validator.validate_changes()
+
+    # Assert
+    assert result is False
+    assert time.time() - start_time < 20
+    assert validator.last_results["test_a_fail.py::test_fail"]["outcome"] == "failed"
+
+def test_validation_collection_timeout(tmp_path):
+    # Arrange
+    project_dir = tmp_path / "proj"
+    _write_project(project_dir)
+    (project_dir / "conftest.py").write_text("import time\n\ntime.sleep(60)\n")
+    validator = Validation(test_command="pytest", test_dir=str(project_dir), num_shards=2, log_dir=str(tmp_path / "logs"), timeout=3)
+
+    # Act
+    start_time = time.time()
+    result = validator.validate_changes()
+
+    # Assert
+    assert result is False
+    assert time.time() - start_time < 20
+
+def test_validation_per_test_timeout_excludes_collection(tmp_path):
+    # Arrange
+    project_dir = tmp_path / "proj"
+    _write_project(project_dir)
+    (project_dir / "conftest.py").write_text("import time\n\ntime.sleep(3)\n")
+    (project_dir / "test_slow.py").write_text("import time\n\ndef test_slow():\n    time.sleep(60)\n")
+
+    for warm_workers in (0, 1):
+        validator = Validation(test_command="pytest", test_dir=str(project_dir), warm_workers=warm_workers, per_test_timeout=2)
+
+        # Act
+        start_time = time.time()
+        passed = validator.validate_specific_test(str(project_dir / "test_calc.py"))
+        stalled = validator.validate_specific_test(str(project_dir / "test_slow.py"))
+        validator.close()
+
+        # Assert
+        assert passed is True
+        assert stalled is False
+        assert time.time() - start_time < 30
+
+def test_validation_memory_limit(tmp_path):
+    # Arrange
+    project_dir = tmp_path / "proj"
+    _write_project(project_dir)
+    (project_dir / "test_memory.py").write_text("def test_memory():\n    data = bytearray(2 * 1024 ** 3)\n    assert data\n")
+    validator = Validation(test_command="pytest", test_dir=str(project_dir), memory_limit_mb=1024)
+
+    # Act
+    result = validator.validate_changes()
+
+    # Assert
+    assert result is False
+    assert [result["outcome"] for test_id, result in validator.last_results.items() if test_id.endswith("test_memory.py::test_memory")] == ["failed"]
@@ -0,0 +1,291 @@
+import json
+import threading
+from typing import Dict, Optional
+
+from agentless.util.retry_policy import LatencyHistogram
+
+# USD per million tokens: (input, output, cache write, cache read)
+MODEL_PRICES = {
+    "gpt-4o-2024-05-13": (5.0, 15.0, 5.0, 5.0),
+    "gpt-4o-mini-2024-07-18": (0.15, 0.6, 0.15, 0.15),
+    "claude-3-5-sonnet-20241022": (3.0, 15.0, 3.75, 0.3),
+    "deepseek-coder": (0.14, 0.28, 0.14, 0.014),
+}
+
+USAGE_FIELDS = (
+    "prompt_tokens",
+    "completion_tokens",
+    "cache_creation_token",
+    "cache_read_input_tokens",
+)
+
+
+def usage_cost(model: str, usage: Dict) -> float:
+    """Cost in USD of one usage dict as written into the trajs; 0 for unknown models."""
+    if model not in MODEL_PRICES:
+        return 0.0
+    prices = MODEL_PRICES[model]
+    return (
+        sum(usage.get(field, 0) * price for field, price in zip(USAGE_FIELDS, prices))
+        / 1e6
+    )
+
+
+def _total_tokens(usage: Dict) -> int:
+    return sum(usage.get(field, 0) for field in USAGE_FIELDS)
+
+
+def _plus(totals: Dict, reserved: Dict) -> Dict:
+    return {
+        "tokens": totals["tokens"] + reserved["tokens"],
+        "cost": totals["cost"] + reserved["cost"],
+    }
+
+
+class Budget:
+    """Optional ceilings on cost (USD) and tokens."""
+
+    def __init__(self, max_cost: Optional[float] = None, max_tokens: Optional[int] = None):
+        self.max_cost = max_cost
+        self.max_tokens = max_tokens
+
+    def exceeded(self, totals: Dict) -> bool:
+        if self.max_cost is not None and totals["cost"] >= self.max_cost:
+            return True
+        if self.max_tokens is not None and totals["tokens"] >= self.max_tokens:
+            return True
+        return False
+
+    def to_dict(self) -> Dict:
+        return {"max_cost": self.max_cost, "max_tokens": self.max_tokens}
+
+
+class Ledger:
+    """Thread-safe record of every model call, aggregated per (model, stage) and per instance.
+
+    Requests that run in parallel reserve their estimated usage before they are
+    sent (see reserve), so concurrent samples cannot overshoot a budget that
+    each of them checked before any of them finished.
+    """
+
+    def __init__(
+        self,
+        stage: str = "default",
+        instance_budget: Optional[Budget] = None,
+        run_budget: Optional[Budget] = None,
+    ) -> None:
+        self.stage = stage
+        self.instance_budget = instance_budget or Budget()
+        self.run_budget = run_budget or Budget()
+        self._by_model: Dict[tuple, Dict] = {}
+        self._by_instance: Dict[str, Dict] = {}
+        self._run = self._empty()
+        self._reserved_run = {"tokens": 0, "cost": 0.0}
+        self._reserved_by_instance: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+        self._settled = threading.Condition(self._lock)
+
+    @staticmethod
+    def _empty() -> Dict:
+        totals = {field: 0 for field in USAGE_FIELDS}
+        totals.update(
+            {
+                "requests": 0,
+                "hedges": 0,
+                "cache_hits": 0,
+                "skipped": 0,
+                "tokens": 0,
+                "cost": 0.0,
+                "latencies": LatencyHistogram(),
+            }
+        )
+        return totals
+
+    def _add(
+        self,
+        model: str,
+        instance_id: Optional[str],
+        usage: Dict,
+        counter: str,
+        latency: Optional[float],
+    ) -> None:
+        with self._lock:
+            self._add_locked(model, instance_id, usage, counter, latency)
+
+    def _groups(self, model: str, instance_id: Optional[str]):
+        groups = [self._run, self._by_model.setdefault((model, self.stage), self._empty())]
+        if instance_id is not None:
+            groups.append(self._by_instance.setdefault(instance_id, self._empty()))
+        return groups
+
+    def _add_locked(
+        self,
+        model: str,
+        instance_id: Optional[str],
+        usage: Dict,
+        counter: str,
+        latency: Optional[float],
+    ) -> None:
+        cost = usage_cost(model, usage)
+        for totals in self._groups(model, instance_id):
+            for field in USAGE_FIELDS:
+                totals[field] += usage.get(field, 0)
+            totals[counter] += 1
+            totals["tokens"] += _total_tokens(usage)
+            totals["cost"] += cost
+            if latency is not None:
+                totals["latencies"].record(latency)
+
+    def record(self, model: str, instance_id: Optional[str], usage: Dict, latency: float):
+        self._add(model, instance_id, usage, "requests", latency)
+
+    def record_hedge(self, model: str, instance_id: Optional[str], usage: Dict) -> None:
+        """Records the usage of a hedged duplicate request whose response was dropped."""
+        self._add(model, instance_id, usage, "hedges", None)
+
+    def _count(self, model: str, instance_id: Optional[str], counter: str) -> None:
+        with self._lock:
+            for totals in self._groups(model, instance_id):
+                totals[counter] += 1
+
+    def record_skip(self, model: str, instance_id: Optional[str]) -> None:
+        self._count(model, instance_id, "skipped")
+
+    def record_cache_hit(self, model: str, instance_id: Optional[str]) -> None:
+        """Counts a call served from the response cache, which costs nothing."""
+        self._count(model, instance_id, "cache_hits")
+
+    def _reservation(self, model: str, estimate: Dict) -> Dict:
+        return {"tokens": _total_tokens(estimate), "cost": usage_cost(model, estimate)}
+
+    def _try_reserve_locked(
+        self, model: str, instance_id: Optional[str], estimate: Dict
+    ) -> Optional[bool]:
+        instance_totals = self._by_instance.get(instance_id)
+        if self.run_budget.exceeded(self._run) or (
+            instance_totals is not None and self.instance_budget.exceeded(instance_totals)
+        ):
+            return False
+        # the requests in flight count as their estimates until they are settled
+        no_reservation = {"tokens": 0, "cost": 0.0}
+        reserved = self._reserved_by_instance.get(instance_id, no_reservation)
+        if self.run_budget.exceeded(_plus(self._run, self._reserved_run)) or (
+            instance_id is not None
+            and self.instance_budget.exceeded(
+                _plus(instance_totals or no_reservation, reserved)
+            )
+        ):
+            return None
+        amount = self._reservation(model, estimate)
+        groups = [self._reserved_run]
+        if instance_id is not None:
+            groups.append(self._reserved_by_instance.setdefault(instance_id, dict(no_reservation)))
+        for group in groups:
+            group["tokens"] += amount["tokens"]
+            group["cost"] += amount["cost"]
+        return True
+
+    def try_reserve(
+        self, model: str, instance_id: Optional[str], estimate: Dict
+    ) -> Optional[bool]:
+        """Reserves the estimated usage of a request about to be sent.
+
+        Returns True once reserved, False if the budget is used up, and None if
+        only the requests in flight could use it up; try again once one of them
+        is settled.
+        """
+        with self._lock:
+            return self._try_reserve_locked(model, instance_id, estimate)
+
+    def reserve(self, model: str, instance_id: Optional[str], estimate: Dict) -> bool:
+        """Blocking try_reserve: waits for requests in flight to settle instead of returning None."""
+        with self._settled:
+            while True:
+                reserved = self._try_reserve_locked(model, instance_id, estimate)
+                if reserved is not None:
+                    return reserved
+                self._settled.wait()
+
+    def settle(
+        self,
+        model: str,
+        instance_id: Optional[str],
+        estimate: Dict,
+        usage: Optional[Dict],
+        latency: float,
+    ) -> None:
+        """Releases a reservation and records the request's usage in one step."""
+        amount = self._reservation(model, estimate)
+        with self._settled:
+            groups = [self._reserved_run]
+            if instance_id is not None:
+                groups.append(self._reserved_by_instance[instance_id])
+            for group in groups:
+                group["tokens"] -= amount["tokens"]
+                group["cost"] -= amount["cost"]
+            if usage is not None:
+                self._add_locked(model, instance_id, usage, "requests", latency)
+            self._settled.notify_all()
+
+    def exhausted(self, instance_id: Optional[str]) -> bool:
+        """Whether the run budget or the instance's budget is used up."""
+        with self._lock:
+            if self.run_budget.exceeded(self._run):
+                return True
+            totals = self._by_instance.get(instance_id)
+            return totals is not None and self.instance_budget.exceeded(totals)
+
+    @staticmethod
+    def _report(totals: Dict) -> Dict:
+        report = {key: value for key, value in totals.items() if key != "latencies"}
+        report["mean_latency"] = totals["latencies"].mean()
+        # the upper bound of its histogram bucket
+        report["p95_latency"] = totals["latencies"].percentile(0.95)
+        return report
+
+    def summary(self) -> Dict:
+        with self._lock:
+            return {
+                "stage": self.stage,
+                "budgets": {
+                    "instance": self.instance_budget.to_dict(),
+                    "run": self.run_budget.to_dict(),
+                },
+                "run": self._report(self._run),
+                "models": [
+                    {"model": model, "stage": stage, **self._report(totals)}
+                    for (model, stage), totals in self._by_model.items()
+                ],
+                "instances": {
+                    instance_id: self._report(totals)
+                    for instance_id, totals in self._by_instance.items()
+                },
+            }
+
+    def write_report(self, path: str) -> None:
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=4)
+
+
+_ledger = Ledger()
+
+
+def configure_accounting(
+    stage: str,
+    max_instance_cost: Optional[float] = None,
+    max_instance_tokens: Optional[int] = None,
+    max_run_cost: Optional[float] = None,
+    max_run_tokens: Optional[int] = None,
+) -> Ledger:
+    """Install the process-wide ledger for a pipeline stage and its budgets."""
+    global _ledger
+    _ledger = Ledger(
+        stage,
+        Budget(max_instance_cost, max_instance_tokens),
+        Budget(max_run_cost, max_run_tokens),
+    )
+    return _ledger
+
+
+def get_ledger() -> Ledger:
+    return _ledger
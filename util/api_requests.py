@@ -1,10 +1,26 @@
+import asyncio
 import time
-from typing import Dict, Union
+from functools import lru_cache
+from typing import Dict, List, Union
 
 import anthropic
 import openai
 import tiktoken
 
+from agentless.util.accounting import get_ledger
+from agentless.util.client_pool import client_pool_metrics, get_pooled_client
+from agentless.util.hedging import get_hedge_policy
+from agentless.util.rate_limiter import get_rate_limiter
+from agentless.util.response_cache import get_response_cache
+from agentless.util.retry_policy import (
+    DEFAULT_DEADLINE,
+    RetryPolicy,
+    acall_with_retries,
+    attempt_metrics,
+    call_with_retries,
+)
+from agentless.util.streaming import EditBlockWatcher
+
 def gpt_query(prompt, api_key, model="gpt-3.5-turbo", max_tokens=300):
     """
     Queries OpenAI's GPT API with the given prompt.
@@ -28,18 +44,43 @@ def gpt_query(prompt, api_key, model="gpt-3.5-turbo", max_tokens=300):
         return None
     
 
-def num_tokens_from_messages(message, model="gpt-3.5-turbo-0301"):
-    """Returns the number of tokens used by a list of messages."""
+# Rough characters-per-token ratio of the BPE encodings, for approximate counts
+APPROX_CHARS_PER_TOKEN = 4
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str) -> tiktoken.Encoding:
+    """Returns the tiktoken encoding of a model, loading it only once per process."""
     try:
-        encoding = tiktoken.encoding_for_model(model)
+        return tiktoken.encoding_for_model(model)
     except KeyError:
-        encoding = tiktoken.get_encoding("cl100k_base")
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def _message_text(message) -> str:
     if isinstance(message, list):
         # use last message.
-        num_tokens = len(encoding.encode(message[0]["content"]))
-    else:
-        num_tokens = len(encoding.encode(message))
-    return num_tokens
+        return message[0]["content"]
+    return message
+
+
+def num_tokens_from_messages(message, model="gpt-3.5-turbo-0301", approximate=False):
+    """Returns the number of tokens used by a list of messages.
+
+    With `approximate`, the count is estimated from the text length without encoding.
+    """
+    text = _message_text(message)
+    if approximate:
+        return -(-len(text) // APPROX_CHARS_PER_TOKEN)
+    return len(get_encoding(model).encode(text))
+
+
+def num_tokens_batch(messages, model="gpt-3.5-turbo-0301", approximate=False) -> List[int]:
+    """Returns the token count of every message, encoding them all in one batch."""
+    texts = [_message_text(message) for message in messages]
+    if approximate:
+        return [-(-len(text) // APPROX_CHARS_PER_TOKEN) for text in texts]
+    return [len(tokens) for tokens in get_encoding(model).encode_batch(texts)]
 
 
 def create_chatgpt_config(
@@ -72,50 +113,289 @@ def create_chatgpt_config(
     return config
 
 
+def _prompt_text(config) -> str:
+    system = config.get("system") or []
+    texts = [system] if isinstance(system, str) else [block["text"] for block in system]
+    for message in config["messages"]:
+        content = message.get("content") or ""
+        if isinstance(content, str):
+            texts.append(content)
+        else:
+            texts.extend(block.get("text", "") for block in content if isinstance(block, dict))
+    return "\n".join(texts)
+
+
+def estimate_request_tokens(config) -> int:
+    """Rough estimate of the tokens a request consumes: its prompt plus the completions."""
+    prompt_tokens = num_tokens_from_messages(
+        _prompt_text(config), config["model"], approximate=True
+    )
+    return prompt_tokens + config.get("max_tokens", 0) * config.get("n", 1)
+
+
+def request_metrics() -> Dict:
+    """Pool, rate limiter, response cache, hedging and per-attempt latency metrics so far."""
+    cache = get_response_cache()
+    return {
+        "client_pools": client_pool_metrics(),
+        "rate_limiter": get_rate_limiter().metrics(),
+        "response_cache": cache.stats() if cache is not None else None,
+        "hedging": get_hedge_policy().metrics(),
+        "attempts": attempt_metrics.summary(),
+    }
+
+
 def handler(signum, frame):
     # swallow signum and frame
     raise Exception("end of time")
 
 
-def request_chatgpt_engine(config, logger, base_url=None, max_retries=40, timeout=100):
-    ret = None
-    retries = 0
+def _openai_usage(ret) -> Dict:
+    return {
+        "prompt_tokens": ret.usage.prompt_tokens,
+        "completion_tokens": ret.usage.completion_tokens,
+    }
 
-    client = openai.OpenAI(base_url=base_url)
 
-    while ret is None and retries < max_retries:
-        try:
-            # Attempt to get the completion
-            logger.info("Creating API request")
-
-            ret = client.chat.completions.create(**config)
-
-        except openai.OpenAIError as e:
-            if isinstance(e, openai.BadRequestError):
-                logger.info("Request invalid")
-                print(e)
-                logger.info(e)
-                raise Exception("Invalid API Request")
-            elif isinstance(e, openai.RateLimitError):
-                print("Rate limit exceeded. Waiting...")
-                logger.info("Rate limit exceeded. Waiting...")
-                print(e)
-                logger.info(e)
-                time.sleep(5)
-            elif isinstance(e, openai.APIConnectionError):
-                print("API connection error. Waiting...")
-                logger.info("API connection error. Waiting...")
-                print(e)
-                logger.info(e)
-                time.sleep(5)
-            else:
-                print("Unknown error. Waiting...")
-                logger.info("Unknown error. Waiting...")
-                print(e)
-                logger.info(e)
-                time.sleep(1)
-
-        retries += 1
+def _anthropic_usage(ret) -> Dict:
+    return {
+        "prompt_tokens": ret.usage.input_tokens,
+        "completion_tokens": ret.usage.output_tokens,
+        "cache_creation_token": getattr(ret.usage, "cache_creation_input_tokens", 0)
+        or 0,
+        "cache_read_input_tokens": getattr(ret.usage, "cache_read_input_tokens", 0)
+        or 0,
+    }
+
+
+def _charge_hedge(config, instance_id, usage_fn):
+    """The on_discard hook charging a losing hedged copy to the ledger.
+
+    A copy stopped before its response is charged its estimated prompt alone,
+    a lower bound on what it spent.
+    """
+
+    def _discard(ret):
+        if ret is not None and ret.usage is not None:
+            usage = usage_fn(ret)
+        else:
+            usage = {
+                "prompt_tokens": num_tokens_from_messages(
+                    _prompt_text(config), config["model"], approximate=True
+                )
+            }
+        get_ledger().record_hedge(config["model"], instance_id, usage)
+
+    return _discard
+
+
+def _until_cancelled(stream_manager, copy, final):
+    """Streams a hedged copy's response, closing the stream once the copy is cancelled.
+
+    Returns final(stream), the complete response, or None if it was cancelled.
+    """
+    copy.sent = True
+    with stream_manager as stream:
+        for _ in stream:
+            if copy.cancelled.is_set():
+                return None
+        return final(stream)
+
+
+def request_chatgpt_engine(
+    config,
+    logger,
+    base_url=None,
+    max_retries=40,
+    timeout=100,
+    *,
+    deadline=DEFAULT_DEADLINE,
+    instance_id=None,
+):
+    pooled = get_pooled_client("openai", base_url)
+    policy = RetryPolicy(max_retries=max_retries, deadline=deadline)
+    limiter = get_rate_limiter()
+    hedging = get_hedge_policy()
+    on_discard = _charge_hedge(config, instance_id, _openai_usage)
+    estimated_tokens = estimate_request_tokens(config) if limiter.limits_tokens else 0
+
+    def _request(copy):
+        waited = limiter.acquire(estimated_tokens)
+        if waited:
+            logger.info(f"Rate limiter delayed request by {waited:.1f}s")
+        if copy is not None and copy.cancelled.is_set():
+            return None
+        # Attempt to get the completion
+        logger.info("Creating API request")
+        with pooled.in_use() as client:
+            if copy is None:
+                return client.chat.completions.create(**config)
+            return _until_cancelled(
+                client.chat.completions.stream(
+                    **config, stream_options={"include_usage": True}
+                ),
+                copy,
+                lambda stream: stream.get_final_completion(),
+            )
+
+    try:
+        ret = call_with_retries(
+            lambda: hedging.call(_request, config["model"], logger, on_discard),
+            logger,
+            "openai",
+            policy,
+            is_fatal=lambda e: isinstance(e, openai.BadRequestError),
+        )
+    except openai.BadRequestError as e:
+        logger.info("Request invalid")
+        print(e)
+        logger.info(e)
+        raise Exception("Invalid API Request")
+
+    logger.info(f"API response {ret}")
+    return ret
+
+
+async def arequest_chatgpt_engine(
+    config,
+    logger,
+    base_url=None,
+    max_retries=40,
+    *,
+    deadline=DEFAULT_DEADLINE,
+    instance_id=None,
+):
+    """Async variant of request_chatgpt_engine running on the caller's event loop."""
+    pooled = get_pooled_client("openai", base_url)
+    policy = RetryPolicy(max_retries=max_retries, deadline=deadline)
+    limiter = get_rate_limiter()
+    hedging = get_hedge_policy()
+    on_discard = _charge_hedge(config, instance_id, _openai_usage)
+    estimated_tokens = estimate_request_tokens(config) if limiter.limits_tokens else 0
+
+    async def _request(copy):
+        if limiter.buckets:
+            waited = await asyncio.to_thread(limiter.acquire, estimated_tokens)
+            if waited:
+                logger.info(f"Rate limiter delayed request by {waited:.1f}s")
+        logger.info("Creating API request")
+        async with pooled.async_in_use() as client:
+            if copy is not None:
+                copy.sent = True
+            return await client.chat.completions.create(**config)
+
+    try:
+        ret = await acall_with_retries(
+            lambda: hedging.acall(_request, config["model"], logger, on_discard),
+            logger,
+            "openai",
+            policy,
+            is_fatal=lambda e: isinstance(e, openai.BadRequestError),
+        )
+    except openai.BadRequestError as e:
+        logger.info("Request invalid")
+        print(e)
+        logger.info(e)
+        raise Exception("Invalid API Request")
+
+    logger.info(f"API response {ret}")
+    return ret
+
+
+def _stream_result(config, watchers, usage, start_time, first_token_time):
+    """Collects a streamed completion; usage cut off by an early stop is estimated."""
+    texts = [watcher.result() for watcher in watchers]
+    stopped_early = all(watcher.done for watcher in watchers)
+    if usage is None:
+        usage = {
+            "prompt_tokens": num_tokens_from_messages(
+                _prompt_text(config), config["model"], approximate=True
+            ),
+            "completion_tokens": sum(
+                num_tokens_batch(texts, config["model"], approximate=True)
+            ),
+        }
+    return {
+        "texts": texts,
+        "usage": usage,
+        "time_to_first_token": None
+        if first_token_time is None
+        else first_token_time - start_time,
+        "stopped_early": stopped_early,
+        # an upper bound: the completions would not necessarily have used all of max_tokens
+        "tokens_saved_upper_bound": max(
+            config["max_tokens"] * len(watchers) - usage["completion_tokens"], 0
+        )
+        if stopped_early
+        else 0,
+    }
+
+
+def request_chatgpt_stream(
+    config,
+    logger,
+    stop_after_blocks,
+    base_url=None,
+    max_retries=40,
+    *,
+    deadline=DEFAULT_DEADLINE,
+    quiet_chars=None,
+):
+    """Streams a chat completion and stops it once the edit blocks of every choice are
+    over (see EditBlockWatcher). Returns the dict built by _stream_result, or None on
+    failure.
+    """
+    pooled = get_pooled_client("openai", base_url)
+    policy = RetryPolicy(max_retries=max_retries, deadline=deadline)
+    limiter = get_rate_limiter()
+    estimated_tokens = estimate_request_tokens(config) if limiter.limits_tokens else 0
+
+    def _request():
+        waited = limiter.acquire(estimated_tokens)
+        if waited:
+            logger.info(f"Rate limiter delayed request by {waited:.1f}s")
+        logger.info("Creating streaming API request")
+        watchers = [
+            EditBlockWatcher(stop_after_blocks, quiet_chars)
+            for _ in range(config.get("n", 1))
+        ]
+        start_time, first_token_time, usage = time.time(), None, None
+        with pooled.in_use() as client:
+            stream = client.chat.completions.create(
+                **config, stream=True, stream_options={"include_usage": True}
+            )
+            try:
+                for chunk in stream:
+                    if chunk.usage:
+                        usage = {
+                            "prompt_tokens": chunk.usage.prompt_tokens,
+                            "completion_tokens": chunk.usage.completion_tokens,
+                        }
+                    for choice in chunk.choices:
+                        if choice.delta.content:
+                            if first_token_time is None:
+                                first_token_time = time.time()
+                            watchers[choice.index].feed(choice.delta.content)
+                    if all(watcher.done for watcher in watchers):
+                        break
+            finally:
+                # closing the connection stops the generation on the server
+                stream.close()
+        return _stream_result(config, watchers, usage, start_time, first_token_time)
+
+    try:
+        ret = call_with_retries(
+            _request,
+            logger,
+            "openai",
+            policy,
+            is_fatal=lambda e: isinstance(e, openai.BadRequestError),
+        )
+    except openai.BadRequestError as e:
+        logger.info("Request invalid")
+        print(e)
+        logger.info(e)
+        raise Exception("Invalid API Request")
 
     logger.info(f"API response {ret}")
     return ret
@@ -129,6 +409,7 @@ def create_anthropic_config(
     system_message: str = "You are a helpful assistant.",
     model: str = "claude-2.1",
     tools: list = None,
+    system: list = None,
 ) -> Dict:
     if isinstance(message, list):
         config = {
@@ -149,38 +430,193 @@ def create_anthropic_config(
 
     if tools:
         config["tools"] = tools
+    if system:
+        config["system"] = system
 
     return config
 
 
+def _mark_cache_breakpoint(config):
+    # following best practice to cache mainly the reused content at the beginning
+    # this includes any tools, system messages (which is already handled since we try to cache the first message)
+    config["messages"][0]["content"][0]["cache_control"] = {"type": "ephemeral"}
+
+
 def request_anthropic_engine(
-    config, logger, max_retries=40, timeout=500, prompt_cache=False
+    config,
+    logger,
+    max_retries=40,
+    timeout=500,
+    prompt_cache=False,
+    *,
+    base_url=None,
+    deadline=DEFAULT_DEADLINE,
+    instance_id=None,
 ):
-    ret = None
-    retries = 0
+    pooled = get_pooled_client("anthropic", base_url)
+    policy = RetryPolicy(max_retries=max_retries, deadline=deadline)
 
-    client = anthropic.Anthropic()
+    if prompt_cache:
+        _mark_cache_breakpoint(config)
+    limiter = get_rate_limiter()
+    hedging = get_hedge_policy()
+    on_discard = _charge_hedge(config, instance_id, _anthropic_usage)
+    estimated_tokens = estimate_request_tokens(config) if limiter.limits_tokens else 0
 
-    while ret is None and retries < max_retries:
+    def _request(copy):
+        waited = limiter.acquire(estimated_tokens)
+        if waited:
+            logger.info(f"Rate limiter delayed request by {waited:.1f}s")
+        if copy is not None and copy.cancelled.is_set():
+            return None
+        start_time = time.time()
         try:
-            start_time = time.time()
-            if prompt_cache:
-                # following best practice to cache mainly the reused content at the beginning
-                # this includes any tools, system messages (which is already handled since we try to cache the first message)
-                config["messages"][0]["content"][0]["cache_control"] = {
-                    "type": "ephemeral"
-                }
-                ret = client.beta.prompt_caching.messages.create(**config)
-            else:
-                ret = client.messages.create(**config)
-        except Exception as e:
-            logger.error("Unknown error. Waiting...", exc_info=True)
-            # Check if the timeout has been exceeded
+            with pooled.in_use() as client:
+                if prompt_cache:
+                    messages = client.beta.prompt_caching.messages
+                else:
+                    messages = client.messages
+                if copy is None:
+                    return messages.create(**config)
+                return _until_cancelled(
+                    messages.stream(**config),
+                    copy,
+                    lambda stream: stream.get_final_message(),
+                )
+        except Exception:
             if time.time() - start_time >= timeout:
-                logger.warning("Request timed out. Retrying...")
-            else:
-                logger.warning("Retrying after an unknown error...")
-            time.sleep(10 * retries)
-        retries += 1
+                logger.warning("Request timed out.")
+            raise
 
-    return ret
+    try:
+        return call_with_retries(
+            lambda: hedging.call(_request, config["model"], logger, on_discard),
+            logger,
+            "anthropic",
+            policy,
+            is_fatal=lambda e: isinstance(e, anthropic.BadRequestError),
+        )
+    except anthropic.BadRequestError:
+        logger.error("Request invalid", exc_info=True)
+        return None
+
+
+async def arequest_anthropic_engine(
+    config,
+    logger,
+    max_retries=40,
+    prompt_cache=False,
+    *,
+    base_url=None,
+    deadline=DEFAULT_DEADLINE,
+    instance_id=None,
+):
+    """Async variant of request_anthropic_engine running on the caller's event loop."""
+    pooled = get_pooled_client("anthropic", base_url)
+    policy = RetryPolicy(max_retries=max_retries, deadline=deadline)
+
+    if prompt_cache:
+        _mark_cache_breakpoint(config)
+    limiter = get_rate_limiter()
+    hedging = get_hedge_policy()
+    on_discard = _charge_hedge(config, instance_id, _anthropic_usage)
+    estimated_tokens = estimate_request_tokens(config) if limiter.limits_tokens else 0
+
+    async def _request(copy):
+        if limiter.buckets:
+            waited = await asyncio.to_thread(limiter.acquire, estimated_tokens)
+            if waited:
+                logger.info(f"Rate limiter delayed request by {waited:.1f}s")
+        async with pooled.async_in_use() as client:
+            if copy is not None:
+                copy.sent = True
+            if prompt_cache:
+                return await client.beta.prompt_caching.messages.create(**config)
+            return await client.messages.create(**config)
+
+    try:
+        return await acall_with_retries(
+            lambda: hedging.acall(_request, config["model"], logger, on_discard),
+            logger,
+            "anthropic",
+            policy,
+            is_fatal=lambda e: isinstance(e, anthropic.BadRequestError),
+        )
+    except anthropic.BadRequestError:
+        logger.error("Request invalid", exc_info=True)
+        return None
+
+
+def request_anthropic_stream(
+    config,
+    logger,
+    stop_after_blocks,
+    max_retries=40,
+    prompt_cache=False,
+    *,
+    base_url=None,
+    deadline=DEFAULT_DEADLINE,
+    quiet_chars=None,
+):
+    """Streams a message and stops it once its edit blocks are over (see EditBlockWatcher).
+
+    Returns the dict built by _stream_result, with the cache token counts added
+    to its usage, or None on failure.
+    """
+    pooled = get_pooled_client("anthropic", base_url)
+    policy = RetryPolicy(max_retries=max_retries, deadline=deadline)
+
+    if prompt_cache:
+        _mark_cache_breakpoint(config)
+    limiter = get_rate_limiter()
+    estimated_tokens = estimate_request_tokens(config) if limiter.limits_tokens else 0
+
+    def _request():
+        waited = limiter.acquire(estimated_tokens)
+        if waited:
+            logger.info(f"Rate limiter delayed request by {waited:.1f}s")
+        watcher = EditBlockWatcher(stop_after_blocks, quiet_chars)
+        start_time, first_token_time = time.time(), None
+        input_usage, output_tokens = None, None
+        with pooled.in_use() as client:
+            messages = client.beta.prompt_caching.messages if prompt_cache else client.messages
+            stream = messages.create(**config, stream=True)
+            try:
+                for event in stream:
+                    if event.type == "message_start":
+                        input_usage = event.message.usage
+                    elif event.type == "content_block_delta" and event.delta.type == "text_delta":
+                        if first_token_time is None:
+                            first_token_time = time.time()
+                        if watcher.feed(event.delta.text):
+                            break
+                    elif event.type == "message_delta":
+                        output_tokens = event.usage.output_tokens
+            finally:
+                stream.close()
+
+        usage = None
+        if input_usage is not None and output_tokens is not None:
+            usage = {"prompt_tokens": input_usage.input_tokens, "completion_tokens": output_tokens}
+        result = _stream_result(config, [watcher], usage, start_time, first_token_time)
+        result["usage"]["cache_creation_token"] = getattr(
+            input_usage, "cache_creation_input_tokens", 0
+        ) or 0
+        result["usage"]["cache_read_input_tokens"] = getattr(
+            input_usage, "cache_read_input_tokens", 0
+        ) or 0
+        if input_usage is not None:
+            result["usage"]["prompt_tokens"] = input_usage.input_tokens
+        return result
+
+    try:
+        return call_with_retries(
+            _request,
+            logger,
+            "anthropic",
+            policy,
+            is_fatal=lambda e: isinstance(e, anthropic.BadRequestError),
+        )
+    except anthropic.BadRequestError:
+        logger.error("Request invalid", exc_info=True)
+        return None
@@ -0,0 +1,183 @@
+import asyncio
+import threading
+from contextlib import asynccontextmanager, contextmanager
+from typing import Dict, Optional, Tuple
+
+import anthropic
+import httpx
+import openai
+
+# Defaults for the shared keep-alive connection pool of every client
+MAX_CONNECTIONS = 100
+MAX_KEEPALIVE_CONNECTIONS = 20
+KEEPALIVE_EXPIRY = 30.0
+
+
+class PooledClient:
+    """An SDK client together with its keep-alive HTTP pool and usage counters."""
+
+    def __init__(self, backend: str, base_url: Optional[str], max_connections: int):
+        self.backend = backend
+        self.base_url = base_url
+        self.max_connections = max_connections
+        self.requests = 0
+        self.active = 0
+        self.peak_active = 0
+        self.connections_opened = 0
+        self._lock = threading.Lock()
+        self._async_client = None
+        self._async_http_client = None
+        self._semaphore = None
+
+        self.http_client = httpx.Client(
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=min(MAX_KEEPALIVE_CONNECTIONS, max_connections),
+                keepalive_expiry=KEEPALIVE_EXPIRY,
+            ),
+            event_hooks={"request": [self._on_request]},
+        )
+        # retries are handled by the request engines' RetryPolicy, not by the SDK
+        if backend == "anthropic":
+            kwargs = {"base_url": base_url} if base_url else {}
+            self.client = anthropic.Anthropic(
+                http_client=self.http_client, max_retries=0, **kwargs
+            )
+        else:
+            self.client = openai.OpenAI(
+                base_url=base_url, http_client=self.http_client, max_retries=0
+            )
+
+    def _on_request(self, request):
+        # httpcore reports new TCP connections through the trace extension
+        request.extensions["trace"] = self._trace
+
+    def _trace(self, event_name, info):
+        if event_name == "connection.connect_tcp.complete":
+            with self._lock:
+                self.connections_opened += 1
+
+    async def _on_async_request(self, request):
+        request.extensions["trace"] = self._async_trace
+
+    async def _async_trace(self, event_name, info):
+        self._trace(event_name, info)
+
+    def _make_async_client(self):
+        self._async_http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=min(
+                    MAX_KEEPALIVE_CONNECTIONS, self.max_connections
+                ),
+                keepalive_expiry=KEEPALIVE_EXPIRY,
+            ),
+            event_hooks={"request": [self._on_async_request]},
+        )
+        if self.backend == "anthropic":
+            kwargs = {"base_url": self.base_url} if self.base_url else {}
+            self._async_client = anthropic.AsyncAnthropic(
+                http_client=self._async_http_client, max_retries=0, **kwargs
+            )
+        else:
+            self._async_client = openai.AsyncOpenAI(
+                base_url=self.base_url,
+                http_client=self._async_http_client,
+                max_retries=0,
+            )
+        # bounds the in-flight requests of the event loop to the pool size
+        self._semaphore = asyncio.Semaphore(self.max_connections)
+
+    @contextmanager
+    def in_use(self):
+        with self._lock:
+            self.requests += 1
+            self.active += 1
+            self.peak_active = max(self.peak_active, self.active)
+        try:
+            yield self.client
+        finally:
+            with self._lock:
+                self.active -= 1
+
+    @asynccontextmanager
+    async def async_in_use(self):
+        """Like in_use, but yields the async SDK client once a concurrency slot is free.
+
+        The async client is bound to the event loop it is first used on.
+        """
+        if self._async_client is None:
+            self._make_async_client()
+        async with self._semaphore:
+            with self.in_use():
+                yield self._async_client
+
+    async def aclose(self):
+        if self._async_http_client is not None:
+            await self._async_http_client.aclose()
+        self._async_client = self._async_http_client = self._semaphore = None
+
+    def metrics(self) -> Dict:
+        with self._lock:
+            reused = max(self.requests - self.connections_opened, 0)
+            return {
+                "backend": self.backend,
+                "base_url": self.base_url,
+                "requests": self.requests,
+                "active": self.active,
+                "peak_active": self.peak_active,
+                "max_connections": self.max_connections,
+                "utilization": self.active / self.max_connections,
+                "peak_utilization": self.peak_active / self.max_connections,
+                "connections_opened": self.connections_opened,
+                "connections_reused": reused,
+                "reuse_rate": reused / self.requests if self.requests else 0.0,
+            }
+
+
+_clients: Dict[Tuple[str, Optional[str]], PooledClient] = {}
+_clients_lock = threading.Lock()
+_max_connections = MAX_CONNECTIONS
+
+
+def configure_client_pool(max_connections: int = MAX_CONNECTIONS) -> None:
+    """Set the pool size used by clients created from now on (e.g. to match --num_threads)."""
+    global _max_connections
+    _max_connections = max_connections
+
+
+def get_pooled_client(backend: str, base_url: Optional[str] = None) -> PooledClient:
+    """Return the process-wide client for (backend, base_url), creating it on first use."""
+    key = (backend, base_url)
+    pooled = _clients.get(key)
+    if pooled is None:
+        with _clients_lock:
+            pooled = _clients.get(key)
+            if pooled is None:
+                pooled = PooledClient(backend, base_url, _max_connections)
+                _clients[key] = pooled
+    return pooled
+
+
+def client_pool_metrics() -> list:
+    """Pool utilization and connection reuse of every registered client."""
+    with _clients_lock:
+        pooled_clients = list(_clients.values())
+    return [pooled.metrics() for pooled in pooled_clients]
+
+
+def close_clients() -> None:
+    """Close every registered client and its connections."""
+    with _clients_lock:
+        pooled_clients = list(_clients.values())
+        _clients.clear()
+    for pooled in pooled_clients:
+        pooled.http_client.close()
+
+
+async def aclose_async_clients() -> None:
+    """Close the async clients, which must happen on the event loop that used them."""
+    with _clients_lock:
+        pooled_clients = list(_clients.values())
+    for pooled in pooled_clients:
+        await pooled.aclose()
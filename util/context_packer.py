@@ -0,0 +1,155 @@
+from typing import Dict, List, Tuple
+
+from agentless.util.api_requests import num_tokens_batch
+
+
+class ContextPacker:
+    """Packs the located lines of several files into a token budget.
+
+    Locs are admitted from the most fine-grained (fewest lines) to the
+    coarsest, each only if its lines not yet in the context fit in the
+    remaining budget. The windows around the admitted locs are then widened
+    together, doubling every round up to `max_window` lines, and a loc stops
+    widening once its next window no longer fits.
+
+    Tokens are counted per rendered line and only for lines not yet in the
+    context, so every line is encoded at most once. The "..." separators and
+    sticky scroll lines added by line_wrap_content are not counted.
+    """
+
+    def __init__(
+        self,
+        token_budget: int,
+        max_window: int,
+        model: str = "gpt-4o-2024-05-13",
+        add_space: bool = False,
+        no_line_number: bool = False,
+        approximate: bool = False,
+    ) -> None:
+        self.token_budget = token_budget
+        self.max_window = max_window
+        self.model = model
+        self.add_space = add_space
+        self.no_line_number = no_line_number
+        self.approximate = approximate
+        self.used = 0
+        self._files: Dict[str, dict] = {}
+        # [file, start line, end line, file rank], 1-indexed and inclusive
+        self._locs: List[list] = []
+
+    def _render(self, line_number: int, line: str) -> str:
+        # same format as line_wrap_content
+        if self.no_line_number:
+            return line + "\n"
+        if self.add_space:
+            return f"{line_number}| {line} \n"
+        return f"{line_number}|{line}\n"
+
+    def add_file(
+        self, pred_file: str, content: str, line_locs: List[Tuple[int, int]]
+    ) -> None:
+        lines = content.split("\n")
+        self._files[pred_file] = {
+            "lines": lines,
+            "covered": bytearray(len(lines) + 1),
+            "line_tokens": {},
+            "tokens": 0,
+            "locs": 0,
+            "dropped_locs": 0,
+            "window": 0,
+        }
+        rank = len(self._files)
+        for start, end in line_locs:
+            start, end = max(start, 1), min(end, len(lines))
+            if start > end:
+                self._files[pred_file]["dropped_locs"] += 1
+                continue
+            self._locs.append([pred_file, start, end, rank])
+
+    def _cost(self, pred_file: str, new_lines: List[int]) -> int:
+        file = self._files[pred_file]
+        line_tokens = file["line_tokens"]
+        uncounted = [i for i in new_lines if i not in line_tokens]
+        if uncounted:
+            texts = [self._render(i, file["lines"][i - 1]) for i in uncounted]
+            counts = num_tokens_batch(texts, self.model, approximate=self.approximate)
+            line_tokens.update(zip(uncounted, counts))
+        cost = sum(line_tokens[i] for i in new_lines)
+        if file["tokens"] == 0 and new_lines:
+            # "### <file>" header and the blank lines that follow the file
+            header = f"### {pred_file}\n\n\n\n"
+            cost += num_tokens_batch(
+                [header], self.model, approximate=self.approximate
+            )[0]
+        return cost
+
+    def _extend(self, pred_file: str, start: int, end: int) -> bool:
+        """Adds lines `start` to `end` to the context if they fit in the budget."""
+        file = self._files[pred_file]
+        covered = file["covered"]
+        start, end = max(start, 1), min(end, len(file["lines"]))
+        new_lines = [i for i in range(start, end + 1) if not covered[i]]
+        cost = self._cost(pred_file, new_lines)
+        if self.used + cost > self.token_budget:
+            return False
+        for i in new_lines:
+            covered[i] = 1
+        file["tokens"] += cost
+        self.used += cost
+        return True
+
+    def pack(self) -> Dict[str, dict]:
+        """Packs the added locs and returns the budget spent on each file."""
+        # fine-grained locs first, then by file rank and position
+        self._locs.sort(key=lambda loc: (loc[2] - loc[1], loc[3], loc[1]))
+        admitted = []
+        for pred_file, start, end, _ in self._locs:
+            if self._extend(pred_file, start, end):
+                self._files[pred_file]["locs"] += 1
+                admitted.append((pred_file, start, end))
+            else:
+                self._files[pred_file]["dropped_locs"] += 1
+
+        window, growing = 0, admitted
+        while growing and window < self.max_window:
+            window = min(max(window * 2, 1), self.max_window)
+            still_growing = []
+            for pred_file, start, end in growing:
+                if self._extend(pred_file, start - window, end + window):
+                    file = self._files[pred_file]
+                    file["window"] = max(file["window"], window)
+                    still_growing.append((pred_file, start, end))
+            growing = still_growing
+
+        return self.report()
+
+    def intervals(self, pred_file: str) -> List[Tuple[int, int]]:
+        """The packed context intervals of a file, as taken by line_wrap_content."""
+        covered = self._files[pred_file]["covered"]
+        intervals = []
+        start = None
+        for i in range(1, len(covered) + 1):
+            if i < len(covered) and covered[i]:
+                if start is None:
+                    start = i
+            elif start is not None:
+                # like transfer_arb_locs_to_locs, an interval from the first line
+                # starts at 0
+                intervals.append((0 if start == 1 else start, i - 1))
+                start = None
+        return intervals
+
+    def report(self) -> Dict[str, dict]:
+        return {
+            pred_file: {
+                "tokens": file["tokens"],
+                "budget_share": file["tokens"] / self.token_budget
+                if self.token_budget
+                else 0.0,
+                "lines": sum(file["covered"]),
+                "locs": file["locs"],
+                "dropped_locs": file["dropped_locs"],
+                "window": file["window"],
+            }
+            for pred_file, file in self._files.items()
+        }
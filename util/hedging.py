@@ -0,0 +1,227 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import partial
+from typing import Callable, Dict, Optional
+
+# Threads shared by the sync copies of every hedged request in the process
+HEDGE_WORKERS = 256
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=HEDGE_WORKERS, thread_name_prefix="hedge"
+            )
+        return _executor
+
+
+class HedgedCopy:
+    """One copy of a hedged request, handed to the request function.
+
+    The request function sets `sent` right before the request goes out and,
+    in sync calls, stops and returns None once `cancelled` is set.
+    """
+
+    def __init__(self) -> None:
+        self.cancelled = threading.Event()
+        self.sent = False
+
+
+class HedgePolicy:
+    """Sends a duplicate of a request that runs past the p95 latency observed so far.
+
+    Whichever copy returns first wins; the other is cancelled. Async copies
+    are cancelled on the event loop. Sync copies run on a shared thread pool
+    and are cancelled through their HedgedCopy, so the request function
+    should stream its response and close the stream once cancelled. At most
+    `max_hedge_rate` of the requests are hedged, and only after `min_samples`
+    latencies of the same model have been observed.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = False,
+        max_hedge_rate: float = 0.1,
+        min_samples: int = 20,
+        window: int = 200,
+    ) -> None:
+        self.enabled = enabled
+        self.max_hedge_rate = max_hedge_rate
+        self.min_samples = min_samples
+        self.window = window
+        self._latencies: Dict[str, deque] = {}
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.capped = 0
+        self._lock = threading.Lock()
+
+    def hedge_delay(self, key: str) -> Optional[float]:
+        """The p95 latency of `key`, or None while too few requests finished."""
+        with self._lock:
+            latencies = sorted(self._latencies.get(key, ()))
+        if len(latencies) < self.min_samples:
+            return None
+        return latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)]
+
+    def _record(self, key: str, latency: float, hedge_won: bool) -> None:
+        with self._lock:
+            self._latencies.setdefault(key, deque(maxlen=self.window)).append(latency)
+            if hedge_won:
+                self.hedge_wins += 1
+
+    def _start(self, key: str) -> Optional[float]:
+        with self._lock:
+            self.requests += 1
+        return self.hedge_delay(key)
+
+    def _try_hedge(self, key: str, delay: float, logger) -> bool:
+        with self._lock:
+            if self.hedges + 1 > self.max_hedge_rate * self.requests:
+                self.capped += 1
+                return False
+            self.hedges += 1
+        logger.info(f"{key} request slower than p95 ({delay:.1f}s), sending a hedge")
+        return True
+
+    @staticmethod
+    def _discard(copy: HedgedCopy, on_discard: Optional[Callable], future) -> None:
+        """Reports a losing copy that was sent: its response, or None if it was stopped."""
+        if on_discard is None or not copy.sent:
+            return
+        if future.cancelled():
+            on_discard(None)
+        elif future.exception() is None:
+            on_discard(future.result())
+
+    def call(
+        self,
+        request_fn: Callable,
+        key: str,
+        logger,
+        on_discard: Optional[Callable] = None,
+    ):
+        """Calls `request_fn`, hedging it once if it outlives the p95 latency of `key`.
+
+        `request_fn` takes the HedgedCopy it runs as, or None when the call is
+        not hedged. `on_discard` is called with the response of every losing
+        copy that was sent, or with None if the copy was stopped first.
+        Raises the first error if every copy fails.
+        """
+        if not self.enabled:
+            return request_fn(None)
+        delay = self._start(key)
+        start_time = time.time()
+        if delay is None:
+            ret = request_fn(None)
+            self._record(key, time.time() - start_time, False)
+            return ret
+
+        executor = _get_executor()
+        copies = [HedgedCopy()]
+        futures = [executor.submit(request_fn, copies[0])]
+        winner = None
+        try:
+            done, _ = wait(futures, timeout=delay)
+            if not done and self._try_hedge(key, delay, logger):
+                copies.append(HedgedCopy())
+                futures.append(executor.submit(request_fn, copies[-1]))
+            pending, error = set(futures), None
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future.exception() is None:
+                        winner = future
+                        hedge_won = future is not futures[0]
+                        self._record(key, time.time() - start_time, hedge_won)
+                        return future.result()
+                    error = error or future.exception()
+            raise error
+        finally:
+            for future, copy in zip(futures, copies):
+                if future is not winner:
+                    copy.cancelled.set()
+                    future.cancel()
+                    future.add_done_callback(partial(self._discard, copy, on_discard))
+
+    async def acall(
+        self,
+        request_fn: Callable,
+        key: str,
+        logger,
+        on_discard: Optional[Callable] = None,
+    ):
+        """Async variant of call; `request_fn` returns an awaitable."""
+        if not self.enabled:
+            return await request_fn(None)
+        delay = self._start(key)
+        start_time = time.time()
+        if delay is None:
+            ret = await request_fn(None)
+            self._record(key, time.time() - start_time, False)
+            return ret
+
+        copies = [HedgedCopy()]
+        tasks = [asyncio.ensure_future(request_fn(copies[0]))]
+        winner = None
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done and self._try_hedge(key, delay, logger):
+                copies.append(HedgedCopy())
+                tasks.append(asyncio.ensure_future(request_fn(copies[-1])))
+            pending, error = set(tasks), None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner = task
+                        hedge_won = task is not tasks[0]
+                        self._record(key, time.time() - start_time, hedge_won)
+                        return task.result()
+                    error = error or task.exception()
+            raise error
+        finally:
+            for task, copy in zip(tasks, copies):
+                if task is not winner:
+                    copy.cancelled.set()
+                    task.cancel()
+                    task.add_done_callback(partial(self._discard, copy, on_discard))
+
+    def metrics(self) -> Dict:
+        with self._lock:
+            keys = list(self._latencies)
+            metrics = {
+                "enabled": self.enabled,
+                "max_hedge_rate": self.max_hedge_rate,
+                "requests": self.requests,
+                "hedges": self.hedges,
+                "hedge_rate": self.hedges / self.requests if self.requests else 0.0,
+                "hedge_wins": self.hedge_wins,
+                "capped": self.capped,
+            }
+        metrics["p95_latency"] = {key: self.hedge_delay(key) for key in keys}
+        return metrics
+
+
+_hedge_policy = HedgePolicy()
+
+
+def configure_hedging(
+    enabled: bool = False, max_hedge_rate: float = 0.1
+) -> HedgePolicy:
+    """Install the process-wide hedge policy of the non-streaming request engines."""
+    global _hedge_policy
+    _hedge_policy = HedgePolicy(enabled, max_hedge_rate)
+    return _hedge_policy
+
+
+def get_hedge_policy() -> HedgePolicy:
+    return _hedge_policy
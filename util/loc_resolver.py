@@ -0,0 +1,166 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import List, Tuple
+
+from agentless.util.parse_global_var import parse_global_var_from_code
+from agentless.util.repo_index import RepoIndex
+from get_repo_structure.get_repo_structure import parse_python_file
+
+# Number of file symbol tables kept in memory
+MAX_CACHED_FILES = 512
+
+
+class FileSymbols:
+    """Symbol table of one file content.
+
+    The global variables (a libcst parse) and the class and function
+    definitions are each parsed on first use, so a file pays for a parse
+    only if one of its locs needs it.
+    """
+
+    def __init__(self, content: str) -> None:
+        self.content = content
+        self._global_vars = None
+        self._definitions = None
+        self._lock = threading.Lock()
+
+    @property
+    def global_vars(self) -> dict:
+        with self._lock:
+            if self._global_vars is None:
+                global_vars = parse_global_var_from_code(self.content)
+                # the parser returns the content itself when it cannot parse it
+                self._global_vars = global_vars if isinstance(global_vars, dict) else {}
+            return self._global_vars
+
+    def repo_index(self, pred_file: str) -> RepoIndex:
+        """An index of this content alone, as if it were the file at `pred_file`."""
+        with self._lock:
+            if self._definitions is None:
+                self._definitions = parse_python_file("", self.content)
+        class_info, function_names, file_lines = self._definitions
+        return RepoIndex(
+            {
+                pred_file: {
+                    "classes": class_info,
+                    "functions": function_names,
+                    "text": file_lines,
+                }
+            }
+        )
+
+
+_symbols: "OrderedDict[str, FileSymbols]" = OrderedDict()
+_symbols_lock = threading.Lock()
+
+
+def get_file_symbols(content: str) -> FileSymbols:
+    """The FileSymbols of `content`, shared per content hash across the process."""
+    key = hashlib.sha256(content.encode("utf-8")).hexdigest()
+    with _symbols_lock:
+        symbols = _symbols.get(key)
+        if symbols is None:
+            symbols = _symbols[key] = FileSymbols(content)
+            while len(_symbols) > MAX_CACHED_FILES:
+                _symbols.popitem(last=False)
+        else:
+            _symbols.move_to_end(key)
+    return symbols
+
+
+class LocResolver:
+    """Resolves the loc strings predicted for one file to line spans.
+
+    Classes, methods and functions are looked up in the RepoIndex and
+    variables in the file's FileSymbols.
+    """
+
+    def __init__(self, repo_index: RepoIndex, symbols: FileSymbols, pred_file: str):
+        self.repo_index = repo_index
+        self.symbols = symbols
+        self.pred_file = pred_file
+
+    def resolve(
+        self, locs: List[str], remove_line: bool = False
+    ) -> Tuple[List[tuple], List[str]]:
+        """Resolves every loc of every string in `locs` in one pass.
+
+        Returns the line spans and the locs that matched nothing.
+        """
+        repo_index, pred_file = self.repo_index, self.pred_file
+        line_loc = []
+        unrecognized_locs = []
+
+        for model_pred_locs in locs:
+            current_class_name = ""
+            for loc in model_pred_locs.splitlines():
+                # handle cases like "class: MyClass.my_method"
+                if loc.startswith("class: ") and "." not in loc:
+                    loc = loc[len("class: ") :].strip()
+                    class_span = repo_index.class_spans.get((pred_file, loc))
+
+                    if class_span is None:
+                        unrecognized_locs.append(loc)
+                    else:
+                        line_loc.append(class_span)
+                        current_class_name = loc
+
+                elif loc.startswith("function: ") or "." in loc:
+                    loc = loc.split(":", 1)[-1].strip()
+
+                    if "." in loc:
+                        # assume its a method within a class
+                        method_name = loc.split(".")[1]
+                        class_name = loc.split(".")[0]
+
+                        method_span = repo_index.method_spans.get(
+                            (pred_file, class_name, method_name)
+                        )
+                        if method_span is None:
+                            unrecognized_locs.append(loc)
+                        else:
+                            line_loc.append(method_span)
+
+                    else:
+                        function_span = repo_index.function_spans.get((pred_file, loc))
+                        if function_span is None:
+                            if current_class_name != "":
+                                # check if its a method
+                                method_span = repo_index.method_spans.get(
+                                    (pred_file, current_class_name, loc)
+                                )
+                                if method_span is None:
+                                    unrecognized_locs.append(loc)
+                                else:
+                                    line_loc.append(method_span)
+                            else:
+                                # look for it in any class
+                                method_spans = repo_index.file_method_spans.get(
+                                    (pred_file, loc), []
+                                )
+                                if len(method_spans) == 1:
+                                    line_loc.append(method_spans[0])
+                        else:
+                            line_loc.append(function_span)
+                elif loc.startswith("line: "):
+                    if remove_line:
+                        # TODO: can recover the corresponding function instead of throwing it away
+                        continue
+                    loc = loc[len("line: ") :].strip().split()[0]
+                    try:
+                        line_loc.append((int(loc), int(loc)))
+                    except:
+                        continue
+                elif loc.startswith("variable:"):
+                    global_vars = self.symbols.global_vars
+                    for v in loc[len("variable:") :].strip().split():
+                        if v in global_vars:
+                            line_loc.append(
+                                (global_vars[v]["start_line"], global_vars[v]["end_line"])
+                            )
+                else:
+                    if loc.strip():
+                        unrecognized_locs.append(loc)
+
+        return line_loc, unrecognized_locs
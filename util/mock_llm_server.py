@@ -0,0 +1,469 @@
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+import uuid
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+from agentless.util.api_requests import APPROX_CHARS_PER_TOKEN
+
+# Returned when no recorded trajectories are loaded; parses as one SEARCH/REPLACE edit
+DEFAULT_RESPONSE = """```python
+### mock.py
+<<<<<<< SEARCH
+pass
+=======
+pass
+>>>>>>> REPLACE
+```"""
+
+# characters per streamed delta
+STREAM_CHUNK_CHARS = 16
+
+
+def approx_tokens(text: str) -> int:
+    return max(1, -(-len(text) // APPROX_CHARS_PER_TOKEN))
+
+
+class ResponseBank:
+    """Canned responses replayed from the trajs of earlier runs' output.jsonl files.
+
+    Plain completions are handed out in rotation, so the samples of one
+    request differ like real ones. A tool-use conversation always replays the
+    same recorded traj (picked from its first message), one recorded round
+    per request, and ends with a text reply once that traj is exhausted.
+    """
+
+    def __init__(self, paths: Optional[List[str]] = None) -> None:
+        self.texts = []
+        self.tool_trajs = []
+        for path in paths or []:
+            self.load(path)
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def load(self, path: str) -> None:
+        with open(path) as f:
+            for line in f:
+                trajs = json.loads(line).get("traj")
+                if isinstance(trajs, dict):
+                    trajs = [trajs]
+                for traj in trajs or []:
+                    response = traj.get("response")
+                    if isinstance(response, list) and response:
+                        self.tool_trajs.append(response)
+                    elif isinstance(response, str) and response:
+                        self.texts.append(response)
+
+    def next_text(self) -> str:
+        if not self.texts:
+            return DEFAULT_RESPONSE
+        with self._lock:
+            text = self.texts[self._next % len(self.texts)]
+            self._next += 1
+        return text
+
+    def tool_round(self, messages: List[dict]) -> List[dict]:
+        """The content blocks answering a tool-use conversation at its current round."""
+        if not self.tool_trajs:
+            return [{"type": "text", "text": self.next_text()}]
+        first = json.dumps(messages[0]["content"], sort_keys=True)
+        traj = self.tool_trajs[zlib.crc32(first.encode("utf-8")) % len(self.tool_trajs)]
+        rounds = sum(1 for msg in messages if msg["role"] == "assistant")
+        if rounds >= len(traj):
+            return [{"type": "text", "text": "The issue is fixed."}]
+        content = [dict(block) for block in traj[rounds]]
+        for block in content:
+            if block["type"] == "tool_use":
+                # ids must be unique within the conversation
+                block["id"] = f"toolu_mock_{uuid.uuid4().hex[:20]}"
+        return content
+
+
+class MockLLMServer(ThreadingHTTPServer):
+    """Local stand-in for the OpenAI chat completions and Anthropic messages APIs.
+
+    Every request waits `latency` seconds (+/- `jitter`) plus `token_latency`
+    per completion token, and fails with `error_status` with probability
+    `error_rate`. Anthropic prompt caching is simulated: a cached prefix seen
+    before is reported as read, otherwise as written.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address,
+        bank: ResponseBank,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        token_latency: float = 0.0,
+        error_rate: float = 0.0,
+        error_status: int = 429,
+        retry_after: float = 1.0,
+        seed: Optional[int] = None,
+    ) -> None:
+        super().__init__(address, MockLLMHandler)
+        self.bank = bank
+        self.latency = latency
+        self.jitter = jitter
+        self.token_latency = token_latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.cached_prefixes = set()
+        self.counters = {
+            "requests": 0,
+            "errors_injected": 0,
+            "streams": 0,
+            "streams_cancelled": 0,
+            "completion_tokens": 0,
+        }
+        self._lock = threading.Lock()
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        # the OpenAI SDK appends /chat/completions and the Anthropic SDK /v1/messages
+        return f"http://{host}:{port}/v1"
+
+    def count(self, counter: str, amount: int = 1) -> None:
+        with self._lock:
+            self.counters[counter] += amount
+
+    def inject_error(self) -> bool:
+        with self._lock:
+            return self.random.random() < self.error_rate
+
+    def delay(self, completion_tokens: int) -> float:
+        with self._lock:
+            jitter = self.random.uniform(-self.jitter, self.jitter)
+        return max(self.latency + jitter, 0.0) + self.token_latency * completion_tokens
+
+    def cache_tokens(self, prefix: str) -> Dict[str, int]:
+        key = hashlib.sha256(prefix.encode("utf-8")).hexdigest()
+        with self._lock:
+            hit = key in self.cached_prefixes
+            self.cached_prefixes.add(key)
+        tokens = approx_tokens(prefix)
+        return {
+            "cache_creation_input_tokens": 0 if hit else tokens,
+            "cache_read_input_tokens": tokens if hit else 0,
+        }
+
+    def metrics(self) -> Dict:
+        with self._lock:
+            return dict(self.counters, cached_prefixes=len(self.cached_prefixes))
+
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, body: Dict, headers: Dict = None) -> None:
+        encoded = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(encoded)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(encoded)
+
+    def _send_events(self, events, delay: float) -> None:
+        """Sends (event name, data) pairs as server-sent events spread over `delay`."""
+        self.server.count("streams")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        pause = delay / max(len(events), 1)
+        try:
+            for event, data in events:
+                time.sleep(pause)
+                if event is not None:
+                    self.wfile.write(f"event: {event}\n".encode("utf-8"))
+                payload = data if isinstance(data, str) else json.dumps(data)
+                self.wfile.write(f"data: {payload}\n\n".encode("utf-8"))
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # the client stopped the stream early
+            self.server.count("streams_cancelled")
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/metrics"):
+            self._send_json(200, self.server.metrics())
+        else:
+            self._send_json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        path = self.path.split("?")[0]
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.count("requests")
+
+        if self.server.inject_error():
+            self.server.count("errors_injected")
+            time.sleep(self.server.delay(0))
+            self._send_json(
+                self.server.error_status,
+                {
+                    "type": "error",
+                    "error": {"type": "mock_error", "message": "Injected error"},
+                },
+                {"retry-after-ms": str(int(self.server.retry_after * 1000))},
+            )
+        elif path.endswith("/chat/completions"):
+            self._chat_completions(request)
+        elif path.endswith("/messages"):
+            self._messages(request)
+        else:
+            self._send_json(404, {"error": {"message": f"unknown endpoint {path}"}})
+
+    def _chat_completions(self, request: Dict) -> None:
+        texts = [self.server.bank.next_text() for _ in range(request.get("n", 1))]
+        prompt_tokens = approx_tokens(
+            "".join(str(msg["content"]) for msg in request["messages"])
+        )
+        completion_tokens = sum(approx_tokens(text) for text in texts)
+        self.server.count("completion_tokens", completion_tokens)
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+        delay = self.server.delay(completion_tokens)
+        common = {
+            "id": f"chatcmpl-mock-{uuid.uuid4().hex}",
+            "created": int(time.time()),
+            "model": request["model"],
+        }
+
+        if not request.get("stream"):
+            time.sleep(delay)
+            self._send_json(
+                200,
+                {
+                    **common,
+                    "object": "chat.completion",
+                    "choices": [
+                        {
+                            "index": i,
+                            "message": {"role": "assistant", "content": text},
+                            "finish_reason": "stop",
+                            "logprobs": None,
+                        }
+                        for i, text in enumerate(texts)
+                    ],
+                    "usage": usage,
+                },
+            )
+            return
+
+        common["object"] = "chat.completion.chunk"
+        events = []
+        for i, text in enumerate(texts):
+            for start in range(0, len(text), STREAM_CHUNK_CHARS):
+                delta = {"content": text[start : start + STREAM_CHUNK_CHARS]}
+                choice = {"index": i, "delta": delta, "finish_reason": None}
+                events.append((None, {**common, "choices": [choice]}))
+        if request.get("stream_options", {}).get("include_usage"):
+            events.append((None, {**common, "choices": [], "usage": usage}))
+        events.append((None, "[DONE]"))
+        self._send_events(events, delay)
+
+    def _messages(self, request: Dict) -> None:
+        if request.get("tools"):
+            content = self.server.bank.tool_round(request["messages"])
+        else:
+            content = [{"type": "text", "text": self.server.bank.next_text()}]
+
+        # everything up to the last cache breakpoint is the cached prefix
+        blocks = list(request.get("system") or [])
+        for msg in request["messages"]:
+            msg_content = msg["content"]
+            blocks.extend(
+                msg_content
+                if isinstance(msg_content, list)
+                else [{"type": "text", "text": msg_content}]
+            )
+        prompt = [json.dumps(block, sort_keys=True) for block in blocks]
+        marked = [i for i, block in enumerate(blocks) if "cache_control" in block]
+        cached = "".join(prompt[: marked[-1] + 1]) if marked else ""
+        prompt_tokens = approx_tokens("".join(prompt))
+        usage = {
+            "input_tokens": max(prompt_tokens - approx_tokens(cached), 1)
+            if cached
+            else prompt_tokens,
+            "output_tokens": sum(
+                approx_tokens(json.dumps(block, sort_keys=True)) for block in content
+            ),
+            "cache_creation_input_tokens": 0,
+            "cache_read_input_tokens": 0,
+        }
+        if cached:
+            usage.update(self.server.cache_tokens(cached))
+        self.server.count("completion_tokens", usage["output_tokens"])
+        delay = self.server.delay(usage["output_tokens"])
+        stop_reason = (
+            "tool_use"
+            if any(block["type"] == "tool_use" for block in content)
+            else "end_turn"
+        )
+        message = {
+            "id": f"msg_mock_{uuid.uuid4().hex[:24]}",
+            "type": "message",
+            "role": "assistant",
+            "model": request["model"],
+            "stop_sequence": None,
+        }
+
+        if not request.get("stream"):
+            time.sleep(delay)
+            message.update(content=content, stop_reason=stop_reason, usage=usage)
+            self._send_json(200, message)
+            return
+
+        events = [
+            (
+                "message_start",
+                {
+                    "type": "message_start",
+                    "message": {
+                        **message,
+                        "content": [],
+                        "stop_reason": None,
+                        "usage": dict(usage, output_tokens=1),
+                    },
+                },
+            )
+        ]
+        for index, block in enumerate(content):
+            if block["type"] != "text":
+                # tool use is never streamed by the pipeline
+                continue
+            events.append(
+                (
+                    "content_block_start",
+                    {
+                        "type": "content_block_start",
+                        "index": index,
+                        "content_block": {"type": "text", "text": ""},
+                    },
+                )
+            )
+            text = block["text"]
+            for start in range(0, len(text), STREAM_CHUNK_CHARS):
+                events.append(
+                    (
+                        "content_block_delta",
+                        {
+                            "type": "content_block_delta",
+                            "index": index,
+                            "delta": {
+                                "type": "text_delta",
+                                "text": text[start : start + STREAM_CHUNK_CHARS],
+                            },
+                        },
+                    )
+                )
+            events.append(
+                ("content_block_stop", {"type": "content_block_stop", "index": index})
+            )
+        events.append(
+            (
+                "message_delta",
+                {
+                    "type": "message_delta",
+                    "delta": {"stop_reason": stop_reason, "stop_sequence": None},
+                    "usage": {"output_tokens": usage["output_tokens"]},
+                },
+            )
+        )
+        events.append(("message_stop", {"type": "message_stop"}))
+        self._send_events(events, delay)
+
+
+def start_mock_server(
+    host: str = "127.0.0.1",
+    port: int = 0,
+    trajectories: Optional[List[str]] = None,
+    **kwargs,
+) -> MockLLMServer:
+    """Starts a MockLLMServer in a daemon thread; pass its base_url to make_model.
+
+    Port 0 picks a free port. Stop it with server.shutdown().
+    """
+    server = MockLLMServer((host, port), ResponseBank(trajectories), **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--trajectories",
+        type=str,
+        nargs="*",
+        default=[],
+        help="output.jsonl files whose trajs are replayed as responses.",
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="Seconds before each response."
+    )
+    parser.add_argument(
+        "--jitter", type=float, default=0.0, help="Uniform +/- spread of the latency."
+    )
+    parser.add_argument(
+        "--token_latency",
+        type=float,
+        default=0.0,
+        help="Additional seconds per completion token.",
+    )
+    parser.add_argument(
+        "--error_rate", type=float, default=0.0, help="Fraction of failed requests."
+    )
+    parser.add_argument("--error_status", type=int, default=429)
+    parser.add_argument(
+        "--retry_after",
+        type=float,
+        default=1.0,
+        help="Retry-after seconds advertised by failed requests.",
+    )
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    bank = ResponseBank(args.trajectories)
+    server = MockLLMServer(
+        (args.host, args.port),
+        bank,
+        latency=args.latency,
+        jitter=args.jitter,
+        token_latency=args.token_latency,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        retry_after=args.retry_after,
+        seed=args.seed,
+    )
+    print(
+        f"Serving {len(bank.texts)} completions and {len(bank.tool_trajs)} tool "
+        f"trajectories, run the pipeline with --base_url {server.base_url}"
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(json.dumps(server.metrics(), indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,31 @@
+import asyncio
 import json
+import time
 from abc import ABC, abstractmethod
-from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
 
+from agentless.util.accounting import get_ledger
 from agentless.util.api_requests import (
+    arequest_anthropic_engine,
+    arequest_chatgpt_engine,
     create_anthropic_config,
     create_chatgpt_config,
+    num_tokens_batch,
+    num_tokens_from_messages,
     request_anthropic_engine,
+    request_anthropic_stream,
     request_chatgpt_engine,
+    request_chatgpt_stream,
 )
+from agentless.util.prompt_cache import PlannedPrompt
+from agentless.util.response_cache import get_response_cache, request_key
 
 
 class DecoderBase(ABC):
+    # seconds between budget reservation attempts of async samples
+    RESERVE_POLL_INTERVAL = 0.05
+
     def __init__(
         self,
         name: str,
@@ -18,6 +33,11 @@ class DecoderBase(ABC):
         batch_size: int = 1,
         temperature: float = 0.8,
         max_new_tokens: int = 1024,
+        max_parallel_samples: int = 8,
+        stream_stop_blocks: int = None,
+        instance_id: str = None,
+        base_url: str = None,
+        stream_quiet_chars: int = None,
     ) -> None:
         logger.info("Initializing a decoder model: {} ...".format(name))
         self.name = name
@@ -25,6 +45,143 @@ class DecoderBase(ABC):
         self.batch_size = batch_size
         self.temperature = temperature
         self.max_new_tokens = max_new_tokens
+        self.max_parallel_samples = max_parallel_samples
+        # when set, completions are streamed and cut once this many edit blocks are closed
+        self.stream_stop_blocks = stream_stop_blocks
+        # when set, streams wait this many characters after the last block for another one
+        self.stream_quiet_chars = stream_quiet_chars
+        # the instance whose usage and budget the ledger charges these calls to
+        self.instance_id = instance_id
+        # overrides the API endpoint, e.g. to point at util/mock_llm_server.py
+        self.base_url = base_url
+
+    @staticmethod
+    def _empty_traj() -> dict:
+        return {
+            "response": "",
+            "usage": {
+                "completion_tokens": 0,
+                "prompt_tokens": 0,
+            },
+        }
+
+    def _estimate(self, message, num_samples: int = 1) -> dict:
+        """The usage reserved against the budgets while a request is in flight."""
+        return {
+            "prompt_tokens": num_tokens_from_messages(message, self.name, approximate=True),
+            "completion_tokens": self.max_new_tokens * num_samples,
+        }
+
+    def _record_skip(self) -> None:
+        get_ledger().record_skip(self.name, self.instance_id)
+        self.logger.info("Budget exhausted, skipping sample")
+
+    def _reserve(self, estimate: dict) -> bool:
+        """Reserves a request's estimate, waiting for the requests in flight if needed."""
+        if get_ledger().reserve(self.name, self.instance_id, estimate):
+            return True
+        self._record_skip()
+        return False
+
+    async def _areserve(self, estimate: dict) -> bool:
+        ledger = get_ledger()
+        reserved = ledger.try_reserve(self.name, self.instance_id, estimate)
+        while reserved is None:
+            await asyncio.sleep(self.RESERVE_POLL_INTERVAL)
+            reserved = ledger.try_reserve(self.name, self.instance_id, estimate)
+        if not reserved:
+            self._record_skip()
+        return reserved
+
+    def _settle(self, estimate: dict, trajs: List[dict], latency: float) -> None:
+        usage = None
+        if trajs is not None:
+            usage = {}
+            for traj in trajs:
+                for field, count in traj["usage"].items():
+                    usage[field] = usage.get(field, 0) + count
+        get_ledger().settle(self.name, self.instance_id, estimate, usage, latency)
+
+    def _accounted(self, sample_fn, estimate: dict):
+        """Wraps a one-sample function with the budget reservation and usage recording."""
+
+        def _sample():
+            if not self._reserve(estimate):
+                return self._empty_traj()
+            start_time, traj = time.time(), None
+            try:
+                traj = sample_fn()
+            finally:
+                self._settle(
+                    estimate, None if traj is None else [traj], time.time() - start_time
+                )
+            return traj
+
+        return _sample
+
+    def _aaccounted(self, sample_fn, estimate: dict):
+        async def _sample():
+            if not await self._areserve(estimate):
+                return self._empty_traj()
+            start_time, traj = time.time(), None
+            try:
+                traj = await sample_fn()
+            finally:
+                self._settle(
+                    estimate, None if traj is None else [traj], time.time() - start_time
+                )
+            return traj
+
+        return _sample
+
+    @staticmethod
+    def _stream_info(ret) -> dict:
+        return {
+            "time_to_first_token": ret["time_to_first_token"],
+            "stopped_early": ret["stopped_early"],
+            "tokens_saved_upper_bound": ret["tokens_saved_upper_bound"],
+        }
+
+    def _fan_out(
+        self, sample_fn, num_samples: int, warm_first: bool, estimate: dict
+    ) -> List[dict]:
+        """Runs `sample_fn` num_samples times with at most max_parallel_samples in flight.
+
+        Results keep the sample order. With `warm_first`, the first sample runs
+        alone so the later ones read the prompt cache it writes. Every sample
+        reserves `estimate` against the budgets before it starts.
+        """
+        sample_fn = self._accounted(sample_fn, estimate)
+        trajs = []
+        if warm_first and num_samples > 1:
+            trajs.append(sample_fn())
+        remaining = num_samples - len(trajs)
+        workers = min(self.max_parallel_samples, remaining)
+        if workers <= 1:
+            trajs.extend(sample_fn() for _ in range(remaining))
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                trajs.extend(executor.map(lambda _: sample_fn(), range(remaining)))
+        return trajs
+
+    async def _afan_out(
+        self, sample_fn, num_samples: int, warm_first: bool, estimate: dict
+    ) -> List[dict]:
+        """Async variant of _fan_out; `sample_fn` returns a coroutine."""
+        sample_fn = self._aaccounted(sample_fn, estimate)
+        trajs = []
+        if warm_first and num_samples > 1:
+            trajs.append(await sample_fn())
+        slots = asyncio.Semaphore(max(self.max_parallel_samples, 1))
+
+        async def _bounded():
+            async with slots:
+                return await sample_fn()
+
+        trajs.extend(
+            await asyncio.gather(*[_bounded() for _ in range(num_samples - len(trajs))])
+        )
+        return trajs
 
     @abstractmethod
     def codegen(
@@ -32,6 +189,19 @@ class DecoderBase(ABC):
     ) -> List[dict]:
         pass
 
+    async def acodegen(
+        self, message: str, num_samples: int = 1, prompt_cache: bool = False
+    ) -> List[dict]:
+        """Async codegen; decoders without a native async client run codegen in a thread."""
+        return await asyncio.to_thread(self.codegen, message, num_samples, prompt_cache)
+
+    async def acodegen_w_tool(
+        self, message: str, num_samples: int = 1, prompt_cache: bool = False
+    ) -> List[dict]:
+        return await asyncio.to_thread(
+            self.codegen_w_tool, message, num_samples, prompt_cache
+        )
+
     @abstractmethod
     def is_direct_completion(self) -> bool:
         pass
@@ -47,21 +217,20 @@ class OpenAIChatDecoder(DecoderBase):
     def __init__(self, name: str, logger, **kwargs) -> None:
         super().__init__(name, logger, **kwargs)
 
-    def codegen(
-        self, message: str, num_samples: int = 1, prompt_cache: bool = False
-    ) -> List[dict]:
+    def _config(self, message: str, num_samples: int) -> dict:
         if self.temperature == 0:
             assert num_samples == 1
         batch_size = min(self.batch_size, num_samples)
 
-        config = create_chatgpt_config(
+        return create_chatgpt_config(
             message=message,
             max_tokens=self.max_new_tokens,
             temperature=self.temperature,
             batch_size=batch_size,
             model=self.name,
         )
-        ret = request_chatgpt_engine(config, self.logger)
+
+    def _trajs(self, ret) -> List[dict]:
         if ret:
             responses = [choice.message.content for choice in ret.choices]
             completion_tokens = ret.usage.completion_tokens
@@ -98,6 +267,80 @@ class OpenAIChatDecoder(DecoderBase):
             )
         return trajs
 
+    def _stream_trajs(self, ret) -> List[dict]:
+        if not ret:
+            return self._trajs(ret)
+        # as in _trajs, the whole request is charged to the first sample
+        trajs = [
+            {
+                "response": text,
+                "usage": {"completion_tokens": 0, "prompt_tokens": 0},
+                "stream": self._stream_info(ret),
+            }
+            for text in ret["texts"]
+        ]
+        trajs[0]["usage"] = {
+            "completion_tokens": ret["usage"]["completion_tokens"],
+            "prompt_tokens": ret["usage"]["prompt_tokens"],
+        }
+        return trajs
+
+    def codegen(
+        self, message: str, num_samples: int = 1, prompt_cache: bool = False
+    ) -> List[dict]:
+        config = self._config(message, num_samples)
+        estimate = self._estimate(message, num_samples)
+        if not self._reserve(estimate):
+            return [self._empty_traj() for _ in range(num_samples)]
+        start_time, trajs = time.time(), None
+        try:
+            trajs = self._request_trajs(config)
+        finally:
+            self._settle(estimate, trajs, time.time() - start_time)
+        return trajs
+
+    def _request_trajs(self, config) -> List[dict]:
+        if self.stream_stop_blocks:
+            ret = request_chatgpt_stream(
+                config,
+                self.logger,
+                self.stream_stop_blocks,
+                base_url=self.base_url,
+                quiet_chars=self.stream_quiet_chars,
+            )
+            trajs = self._stream_trajs(ret)
+        else:
+            ret = request_chatgpt_engine(
+                config,
+                self.logger,
+                base_url=self.base_url,
+                instance_id=self.instance_id,
+            )
+            trajs = self._trajs(ret)
+        return trajs
+
+    async def acodegen(
+        self, message: str, num_samples: int = 1, prompt_cache: bool = False
+    ) -> List[dict]:
+        if self.stream_stop_blocks:
+            return await super().acodegen(message, num_samples, prompt_cache)
+        config = self._config(message, num_samples)
+        estimate = self._estimate(message, num_samples)
+        if not await self._areserve(estimate):
+            return [self._empty_traj() for _ in range(num_samples)]
+        start_time, trajs = time.time(), None
+        try:
+            ret = await arequest_chatgpt_engine(
+                config,
+                self.logger,
+                base_url=self.base_url,
+                instance_id=self.instance_id,
+            )
+            trajs = self._trajs(ret)
+        finally:
+            self._settle(estimate, trajs, time.time() - start_time)
+        return trajs
+
     def is_direct_completion(self) -> bool:
         return False
 
@@ -143,145 +386,366 @@ Notes for using the `str_replace` command:
     ]
 
     MAX_CODEGEN_ITERATIONS = 10
+    # once a request's prompt passes this many tokens, old rounds are pruned
+    TOOL_HISTORY_PRUNE_TOKENS = 16000
+    # the most recent tool rounds that are never pruned
+    TOOL_ROUNDS_KEPT = 2
+    # price of cache writes and cache reads relative to uncached input tokens
+    CACHE_WRITE_COST = 1.25
+    CACHE_READ_COST = 0.1
 
-    # specialized codegen with tool
-    def codegen_w_tool(
-        self, message: str, num_samples: int = 1, prompt_cache: bool = False
-    ) -> List[dict]:
-        def _build_response_and_extract(response, messages, iter):
-            json_response = response.to_dict()
-
-            contains_tool = False
-            # formulate the messages
-            json_response.pop("id")
-            json_response.pop("model")
-            json_response.pop("stop_reason")
-            json_response.pop("stop_sequence")
-            json_response.pop("type")
-            json_response.pop("usage")
-
-            messages.append(json_response)
-
-            response_content = []
-
-            for json_message in json_response["content"]:
-                if json_message["type"] == "tool_use":
-                    contains_tool = True
-                    # each tool use requires a response
-                    response_content.append(
-                        {
-                            "type": "tool_result",
-                            "tool_use_id": json_message["id"],
-                            "content": self._USER_REPLY_EDIT_MESSAGE,
-                        }
-                    )
+    def _build_response_and_extract(self, content, messages, iter):
+        contains_tool = False
+        # formulate the messages
+        messages.append({"role": "assistant", "content": content})
+
+        response_content = []
 
-            if contains_tool:
+        for json_message in content:
+            if json_message["type"] == "tool_use":
+                contains_tool = True
+                # each tool use requires a response
+                response_content.append(
+                    {
+                        "type": "tool_result",
+                        "tool_use_id": json_message["id"],
+                        "content": self._USER_REPLY_EDIT_MESSAGE,
+                    }
+                )
+
+        if contains_tool:
+            messages.append(
+                {
+                    "role": "user",
+                    "content": response_content,
+                }
+            )
+        else:
+            if iter == 0:
+                # if the first iteration does not contain the tool, likely the model is doing some CoT for debugging
+                # append encouraging message
                 messages.append(
                     {
                         "role": "user",
-                        "content": response_content,
+                        "content": [
+                            {
+                                "type": "text",
+                                "text": "Please generate editing commands to fix the issue",
+                            }
+                        ],
                     }
                 )
-            else:
-                if iter == 0:
-                    # if the first iteration does not contain the tool, likely the model is doing some CoT for debugging
-                    # append encouraging message
-                    messages.append(
-                        {
-                            "role": "user",
-                            "content": [
-                                {
-                                    "type": "text",
-                                    "text": "Please generate editing commands to fix the issue",
-                                }
-                            ],
-                        }
-                    )
-                    contains_tool = True
+                contains_tool = True
 
-            return messages, contains_tool
+        return messages, contains_tool
 
-        if self.temperature == 0:
-            assert num_samples == 1
+    @staticmethod
+    def _move_cache_breakpoint(messages, pruned_until: int = 0) -> None:
+        """Marks the end of the history as the cached prefix for the next round trip.
 
-        trajs = []
-        for _ in range(num_samples):
-            self.logger.info(f" === Generating ====")
-            # initialized the traj
-            traj = {
-                "response": [],
-                "usage": {
-                    "completion_tokens": 0,
-                    "prompt_tokens": 0,
-                    "cache_creation_token": 0,
-                    "cache_read_input_tokens": 0,
-                },
+        The first message keeps its own breakpoint (set by the engine). Once
+        the history has been pruned, the user turn at `pruned_until` that ends
+        the pruned rounds keeps one too, so a later pruning only invalidates
+        the cache after it. With the system block at most four breakpoints are
+        in use.
+        """
+        for msg in messages[1:]:
+            if msg["role"] == "user":
+                for block in msg["content"]:
+                    block.pop("cache_control", None)
+        if 0 < pruned_until < len(messages) - 1:
+            messages[pruned_until]["content"][-1]["cache_control"] = {
+                "type": "ephemeral"
             }
+        if len(messages) > 1:
+            messages[-1]["content"][-1]["cache_control"] = {"type": "ephemeral"}
 
-            # create the initial config and messages
-            messages = [
-                {"role": "user", "content": [{"type": "text", "text": message}]}
+    def _block_tokens(self, blocks) -> List[int]:
+        return num_tokens_batch(
+            [json.dumps(block) for block in blocks], self.name, approximate=True
+        )
+
+    def _prune_history(
+        self, messages, pruned_until: int, remaining_rounds: int
+    ) -> Tuple[int, int, int]:
+        """Drops the reasoning text of acknowledged tool rounds after `pruned_until`.
+
+        A round is acknowledged once the model has answered its tool results.
+        Its tool_use blocks stay, so every tool result keeps its tool use and
+        the model still sees which edits were made.
+
+        Pruning changes the cached history, so the next round trip writes the
+        cache again from the first pruned round on. The rounds are only pruned
+        if reading the dropped text from the cache in the remaining round trips
+        would cost more than that rewrite. Returns the blocks dropped, the index
+        of the user turn ending the pruned rounds and the tokens to rewrite.
+        """
+        # messages alternate user / assistant, starting with the prompt
+        last = len(messages) - 1 - 2 * self.TOOL_ROUNDS_KEPT
+        rounds = [
+            i
+            for i in range(max(pruned_until + 1, 1), last, 2)
+            if any(block["type"] == "tool_use" for block in messages[i]["content"])
+            and any(block["type"] == "text" for block in messages[i]["content"])
+        ]
+        if not rounds:
+            return 0, pruned_until, 0
+        dropped = sum(
+            self._block_tokens(
+                [
+                    block
+                    for i in rounds
+                    for block in messages[i]["content"]
+                    if block["type"] == "text"
+                ]
+            )
+        )
+        suffix = sum(
+            self._block_tokens(
+                [block for msg in messages[rounds[0] :] for block in msg["content"]]
+            )
+        )
+        rewrite = suffix - dropped
+        saved = dropped * self.CACHE_READ_COST * remaining_rounds
+        if saved <= rewrite * (self.CACHE_WRITE_COST - self.CACHE_READ_COST):
+            return 0, pruned_until, 0
+
+        pruned = 0
+        for i in rounds:
+            content = [
+                block for block in messages[i]["content"] if block["type"] != "text"
             ]
+            pruned += len(messages[i]["content"]) - len(content)
+            # copied so the traj keeps the full response
+            messages[i] = {"role": "assistant", "content": content}
+        return pruned, rounds[-1] + 1, rewrite
+
+    @staticmethod
+    def _edit_keys(content) -> set:
+        return {
+            json.dumps(block["input"], sort_keys=True)
+            for block in content
+            if block["type"] == "tool_use"
+        }
+
+    def _tool_sample(self, message: str):
+        """Generates one tool-use trajectory.
+
+        Yields the config of every request and expects the engine's response to
+        be sent back, so the same loop serves the sync and the async engine.
+        Returns the finished traj, with per-iteration stats under "tool_loop".
+        """
+        self.logger.info(f" === Generating ====")
+        # initialized the traj
+        traj = {
+            "response": [],
+            "usage": {
+                "completion_tokens": 0,
+                "prompt_tokens": 0,
+                "cache_creation_token": 0,
+                "cache_read_input_tokens": 0,
+            },
+        }
+        loop_stats = {
+            "iterations": 0,
+            "stop_reason": "max_iterations",
+            # full prompt size (cached or not) of each round trip
+            "prompt_tokens": [],
+            "pruned_blocks": 0,
+            # estimated history tokens written to the cache again after pruning
+            "cache_rewrite_tokens": 0,
+        }
 
-            for iteration in range(self.MAX_CODEGEN_ITERATIONS):
-                config = create_anthropic_config(
-                    message=messages,
-                    max_tokens=self.max_new_tokens,
-                    temperature=self.temperature,
-                    batch_size=1,
-                    model=self.name,
-                    tools=self.tools,
+        # create the initial config and messages
+        messages = [
+            {"role": "user", "content": [{"type": "text", "text": self._body(message)}]}
+        ]
+        seen_edits = set()
+        pruned_until = 0
+
+        for iteration in range(self.MAX_CODEGEN_ITERATIONS):
+            self._move_cache_breakpoint(messages, pruned_until)
+            config = create_anthropic_config(
+                message=messages,
+                max_tokens=self.max_new_tokens,
+                temperature=self.temperature,
+                batch_size=1,
+                model=self.name,
+                tools=self.tools,
+                system=self._system(message, prompt_cache=True),
+            )
+            ret = yield config
+
+            if ret:
+                # serialized once, shared by the traj, the log and the history
+                content = [reply.to_dict() for reply in ret.content]
+                traj["response"].append(content)
+
+                # pretty dump the response
+                self.logger.info(json.dumps(content, indent=2))
+
+                # update the usage
+                traj["usage"]["completion_tokens"] += ret.usage.output_tokens
+                traj["usage"]["prompt_tokens"] += ret.usage.input_tokens
+                traj["usage"][
+                    "cache_creation_token"
+                ] += ret.usage.cache_creation_input_tokens
+                traj["usage"][
+                    "cache_read_input_tokens"
+                ] += ret.usage.cache_read_input_tokens
+                prompt_tokens = (
+                    ret.usage.input_tokens
+                    + ret.usage.cache_creation_input_tokens
+                    + ret.usage.cache_read_input_tokens
                 )
-                ret = request_anthropic_engine(
-                    config,
-                    self.logger,
-                    prompt_cache=True,  # prompt cache should be always true as we at least should query twice
+                loop_stats["iterations"] += 1
+                loop_stats["prompt_tokens"].append(prompt_tokens)
+
+                edits = self._edit_keys(content)
+                if edits and edits <= seen_edits:
+                    # the model only repeats edits it already made
+                    loop_stats["stop_reason"] = "converged"
+                    break
+                seen_edits |= edits
+
+                messages, contains_tool = self._build_response_and_extract(
+                    content, messages, iteration
                 )
 
-                if ret:
-                    # add the response to the traj
-                    traj["response"].append([reply.to_dict() for reply in ret.content])
-
-                    # pretty dump the response
-                    for reply in ret.content:
-                        self.logger.info(json.dumps(reply.to_dict(), indent=2))
-
-                    # update the usage
-                    traj["usage"]["completion_tokens"] += ret.usage.output_tokens
-                    traj["usage"]["prompt_tokens"] += ret.usage.input_tokens
-                    traj["usage"][
-                        "cache_creation_token"
-                    ] += ret.usage.cache_creation_input_tokens
-                    traj["usage"][
-                        "cache_read_input_tokens"
-                    ] += ret.usage.cache_read_input_tokens
-
-                    messages, contains_tool = _build_response_and_extract(
-                        ret, messages, iteration
+                if not contains_tool:
+                    loop_stats["stop_reason"] = "no_tool"
+                    break
+                if prompt_tokens > self.TOOL_HISTORY_PRUNE_TOKENS:
+                    pruned, pruned_until, rewrite = self._prune_history(
+                        messages,
+                        pruned_until,
+                        self.MAX_CODEGEN_ITERATIONS - iteration - 1,
                     )
+                    loop_stats["pruned_blocks"] += pruned
+                    loop_stats["cache_rewrite_tokens"] += rewrite
+            else:
+                assert False, "No response from the engine"  # this should not happen
 
-                    if not contains_tool:
-                        break
-                else:
-                    assert (
-                        False
-                    ), "No response from the engine"  # this should not happen
+        if ret:
+            traj["tool_loop"] = loop_stats
+            return traj
+        return self._empty_traj()
 
-            if ret:
-                trajs.append(traj)
-            else:
-                trajs.append(
-                    {
-                        "response": "",
-                        "usage": {
-                            "completion_tokens": 0,
-                            "prompt_tokens": 0,
-                        },
-                    }
+    # specialized codegen with tool
+    def codegen_w_tool(
+        self, message: str, num_samples: int = 1, prompt_cache: bool = False
+    ) -> List[dict]:
+        if self.temperature == 0:
+            assert num_samples == 1
+
+        def _sample():
+            sample = self._tool_sample(message)
+            config = next(sample)
+            try:
+                while True:
+                    ret = request_anthropic_engine(
+                        config,
+                        self.logger,
+                        base_url=self.base_url,
+                        instance_id=self.instance_id,
+                        prompt_cache=True,  # prompt cache should be always true as we at least should query twice
+                    )
+                    config = sample.send(ret)
+            except StopIteration as done:
+                return done.value
+
+        return self._fan_out(
+            _sample, num_samples, warm_first=True, estimate=self._estimate(message)
+        )
+
+    async def _atool_sample(self, message: str) -> dict:
+        sample = self._tool_sample(message)
+        config = next(sample)
+        try:
+            while True:
+                ret = await arequest_anthropic_engine(
+                    config,
+                    self.logger,
+                    base_url=self.base_url,
+                    prompt_cache=True,
+                    instance_id=self.instance_id,
                 )
+                config = sample.send(ret)
+        except StopIteration as done:
+            return done.value
 
-        return trajs
+    async def acodegen_w_tool(
+        self, message: str, num_samples: int = 1, prompt_cache: bool = False
+    ) -> List[dict]:
+        if self.temperature == 0:
+            assert num_samples == 1
+
+        return await self._afan_out(
+            lambda: self._atool_sample(message),
+            num_samples,
+            warm_first=True,
+            estimate=self._estimate(message),
+        )
+
+    @staticmethod
+    def _body(message: str) -> str:
+        return message.body if isinstance(message, PlannedPrompt) else message
+
+    @staticmethod
+    def _system(message: str, prompt_cache: bool):
+        """The planned prompt's static instructions as a system block, cached across instances."""
+        if not isinstance(message, PlannedPrompt) or not message.instructions:
+            return None
+        block = {"type": "text", "text": message.instructions}
+        if prompt_cache:
+            block["cache_control"] = {"type": "ephemeral"}
+        return [block]
+
+    def _config(self, message: str, prompt_cache: bool = False) -> dict:
+        return create_anthropic_config(
+            message=self._body(message),
+            max_tokens=self.max_new_tokens,
+            temperature=self.temperature,
+            batch_size=1,
+            model=self.name,
+            system=self._system(message, prompt_cache),
+        )
+
+    def _traj(self, ret, prompt_cache: bool) -> dict:
+        if ret:
+            return {
+                "response": ret.content[0].text,
+                "usage": {
+                    "completion_tokens": ret.usage.output_tokens,
+                    "prompt_tokens": ret.usage.input_tokens,
+                    "cache_creation_token": 0
+                    if not prompt_cache
+                    else ret.usage.cache_creation_input_tokens,
+                    "cache_read_input_tokens": 0
+                    if not prompt_cache
+                    else ret.usage.cache_read_input_tokens,
+                },
+            }
+        return {
+            "response": "",
+            "usage": {
+                "completion_tokens": 0,
+                "prompt_tokens": 0,
+            },
+        }
+
+    def _stream_traj(self, ret, prompt_cache: bool) -> dict:
+        if not ret:
+            return self._traj(ret, prompt_cache)
+        usage = dict(ret["usage"])
+        if not prompt_cache:
+            usage["cache_creation_token"] = 0
+            usage["cache_read_input_tokens"] = 0
+        return {
+            "response": ret["texts"][0],
+            "usage": usage,
+            "stream": self._stream_info(ret),
+        }
 
     def codegen(
         self, message: str, num_samples: int = 1, prompt_cache: bool = False
@@ -289,55 +753,94 @@ Notes for using the `str_replace` command:
         if self.temperature == 0:
             assert num_samples == 1
 
-        trajs = []
-        for _ in range(num_samples):
-            config = create_anthropic_config(
-                message=message,
-                max_tokens=self.max_new_tokens,
-                temperature=self.temperature,
-                batch_size=1,
-                model=self.name,
-            )
+        def _sample():
+            if self.stream_stop_blocks:
+                ret = request_anthropic_stream(
+                    self._config(message, prompt_cache),
+                    self.logger,
+                    self.stream_stop_blocks,
+                    base_url=self.base_url,
+                    prompt_cache=prompt_cache,
+                    quiet_chars=self.stream_quiet_chars,
+                )
+                return self._stream_traj(ret, prompt_cache)
             ret = request_anthropic_engine(
-                config, self.logger, prompt_cache=prompt_cache
+                self._config(message, prompt_cache),
+                self.logger,
+                base_url=self.base_url,
+                instance_id=self.instance_id,
+                prompt_cache=prompt_cache,
             )
+            return self._traj(ret, prompt_cache)
 
-            if ret:
-                trajs.append(
-                    {
-                        "response": ret.content[0].text,
-                        "usage": {
-                            "completion_tokens": ret.usage.output_tokens,
-                            "prompt_tokens": ret.usage.input_tokens,
-                            "cache_creation_token": 0
-                            if not prompt_cache
-                            else ret.usage.cache_creation_input_tokens,
-                            "cache_read_input_tokens": 0
-                            if not prompt_cache
-                            else ret.usage.cache_read_input_tokens,
-                        },
-                    }
-                )
-            else:
-                trajs.append(
-                    {
-                        "response": "",
-                        "usage": {
-                            "completion_tokens": 0,
-                            "prompt_tokens": 0,
-                        },
-                    }
-                )
+        return self._fan_out(
+            _sample,
+            num_samples,
+            warm_first=prompt_cache,
+            estimate=self._estimate(message),
+        )
 
-        return trajs
+    async def acodegen(
+        self, message: str, num_samples: int = 1, prompt_cache: bool = False
+    ) -> List[dict]:
+        if self.stream_stop_blocks:
+            return await super().acodegen(message, num_samples, prompt_cache)
+        if self.temperature == 0:
+            assert num_samples == 1
+
+        async def _sample():
+            ret = await arequest_anthropic_engine(
+                self._config(message, prompt_cache),
+                self.logger,
+                base_url=self.base_url,
+                instance_id=self.instance_id,
+                prompt_cache=prompt_cache,
+            )
+            return self._traj(ret, prompt_cache)
+
+        return await self._afan_out(
+            _sample,
+            num_samples,
+            warm_first=prompt_cache,
+            estimate=self._estimate(message),
+        )
 
     def is_direct_completion(self) -> bool:
         return False
 
 
 class DeepSeekChatDecoder(DecoderBase):
+    BASE_URL = "https://api.deepseek.com"
+
     def __init__(self, name: str, logger, **kwargs) -> None:
         super().__init__(name, logger, **kwargs)
+        self.base_url = self.base_url or self.BASE_URL
+
+    def _config(self, message: str) -> dict:
+        return create_chatgpt_config(
+            message=message,
+            max_tokens=self.max_new_tokens,
+            temperature=self.temperature,
+            batch_size=1,
+            model=self.name,
+        )
+
+    def _traj(self, ret) -> dict:
+        if ret:
+            return {
+                "response": ret.choices[0].message.content,
+                "usage": {
+                    "completion_tokens": ret.usage.completion_tokens,
+                    "prompt_tokens": ret.usage.prompt_tokens,
+                },
+            }
+        return {
+            "response": "",
+            "usage": {
+                "completion_tokens": 0,
+                "prompt_tokens": 0,
+            },
+        }
 
     def codegen(
         self, message: str, num_samples: int = 1, prompt_cache: bool = False
@@ -345,45 +848,202 @@ class DeepSeekChatDecoder(DecoderBase):
         if self.temperature == 0:
             assert num_samples == 1
 
-        trajs = []
-        for _ in range(num_samples):
-            config = create_chatgpt_config(
-                message=message,
-                max_tokens=self.max_new_tokens,
-                temperature=self.temperature,
-                batch_size=1,
-                model=self.name,
-            )
+        def _sample():
+            if self.stream_stop_blocks:
+                ret = request_chatgpt_stream(
+                    self._config(message),
+                    self.logger,
+                    self.stream_stop_blocks,
+                    base_url=self.base_url,
+                    quiet_chars=self.stream_quiet_chars,
+                )
+                if not ret:
+                    return self._traj(ret)
+                return {
+                    "response": ret["texts"][0],
+                    "usage": dict(ret["usage"]),
+                    "stream": self._stream_info(ret),
+                }
             ret = request_chatgpt_engine(
-                config, self.logger, base_url="https://api.deepseek.com"
+                self._config(message),
+                self.logger,
+                base_url=self.base_url,
+                instance_id=self.instance_id,
             )
-            if ret:
-                trajs.append(
-                    {
-                        "response": ret.choices[0].message.content,
-                        "usage": {
-                            "completion_tokens": ret.usage.completion_tokens,
-                            "prompt_tokens": ret.usage.prompt_tokens,
-                        },
-                    }
-                )
-            else:
-                trajs.append(
-                    {
-                        "response": "",
-                        "usage": {
-                            "completion_tokens": 0,
-                            "prompt_tokens": 0,
-                        },
-                    }
-                )
+            return self._traj(ret)
 
-        return trajs
+        # DeepSeek caches shared prompt prefixes on its own, so warm it the same way
+        return self._fan_out(
+            _sample,
+            num_samples,
+            warm_first=prompt_cache,
+            estimate=self._estimate(message),
+        )
+
+    async def acodegen(
+        self, message: str, num_samples: int = 1, prompt_cache: bool = False
+    ) -> List[dict]:
+        if self.stream_stop_blocks:
+            return await super().acodegen(message, num_samples, prompt_cache)
+        if self.temperature == 0:
+            assert num_samples == 1
+
+        async def _sample():
+            ret = await arequest_chatgpt_engine(
+                self._config(message),
+                self.logger,
+                base_url=self.base_url,
+                instance_id=self.instance_id,
+            )
+            return self._traj(ret)
+
+        return await self._afan_out(
+            _sample,
+            num_samples,
+            warm_first=prompt_cache,
+            estimate=self._estimate(message),
+        )
 
     def is_direct_completion(self) -> bool:
         return False
 
 
+class CachedDecoder(DecoderBase):
+    """Serves codegen results from the response cache, falling back to the wrapped decoder."""
+
+    def __init__(self, decoder: DecoderBase, cache) -> None:
+        self.decoder = decoder
+        self.cache = cache
+        self.name = decoder.name
+        self.logger = decoder.logger
+        self.batch_size = decoder.batch_size
+        self.temperature = decoder.temperature
+        self.max_new_tokens = decoder.max_new_tokens
+
+    def __getattr__(self, attr):
+        return getattr(self.decoder, attr)
+
+    def _key(self, method: str, message, num_samples: int, prompt_cache: bool) -> str:
+        return request_key(
+            {
+                "decoder": type(self.decoder).__name__,
+                "method": method,
+                "model": self.name,
+                # responses of a mock server must not be replayed against the real API
+                "base_url": self.decoder.base_url,
+                "temperature": self.temperature,
+                "max_new_tokens": self.max_new_tokens,
+                "batch_size": self.batch_size,
+                "num_samples": num_samples,
+                "prompt_cache": prompt_cache,
+                "stream_stop_blocks": getattr(self.decoder, "stream_stop_blocks", None),
+                "stream_quiet_chars": getattr(self.decoder, "stream_quiet_chars", None),
+                "tools": getattr(self.decoder, "tools", None)
+                if method == "codegen_w_tool"
+                else None,
+                "message": message,
+                "prompt_plan": getattr(message, "instructions", None),
+            }
+        )
+
+    def _cached(self, method: str, message, num_samples: int, prompt_cache: bool):
+        key = self._key(method, message, num_samples, prompt_cache)
+        trajs = self.cache.get(key)
+        if trajs is not None:
+            self.logger.info(f"Response cache hit {key}")
+            get_ledger().record_cache_hit(self.name, self.decoder.instance_id)
+            return trajs
+
+        trajs = getattr(self.decoder, method)(
+            message, num_samples=num_samples, prompt_cache=prompt_cache
+        )
+        self._store(key, trajs)
+        return trajs
+
+    async def _acached(self, method: str, message, num_samples: int, prompt_cache: bool):
+        key = self._key(method, message, num_samples, prompt_cache)
+        trajs = self.cache.get(key)
+        if trajs is not None:
+            self.logger.info(f"Response cache hit {key}")
+            get_ledger().record_cache_hit(self.name, self.decoder.instance_id)
+            return trajs
+
+        trajs = await getattr(self.decoder, "a" + method)(
+            message, num_samples=num_samples, prompt_cache=prompt_cache
+        )
+        self._store(key, trajs)
+        return trajs
+
+    def _store(self, key: str, trajs: List[dict]) -> None:
+        # failed requests come back as empty responses and must be retried next time
+        if all(traj["response"] for traj in trajs):
+            self.cache.put(key, trajs)
+
+    def codegen(
+        self, message: str, num_samples: int = 1, prompt_cache: bool = False
+    ) -> List[dict]:
+        return self._cached("codegen", message, num_samples, prompt_cache)
+
+    def codegen_w_tool(
+        self, message: str, num_samples: int = 1, prompt_cache: bool = False
+    ) -> List[dict]:
+        return self._cached("codegen_w_tool", message, num_samples, prompt_cache)
+
+    async def acodegen(
+        self, message: str, num_samples: int = 1, prompt_cache: bool = False
+    ) -> List[dict]:
+        return await self._acached("codegen", message, num_samples, prompt_cache)
+
+    async def acodegen_w_tool(
+        self, message: str, num_samples: int = 1, prompt_cache: bool = False
+    ) -> List[dict]:
+        return await self._acached("codegen_w_tool", message, num_samples, prompt_cache)
+
+    def is_direct_completion(self) -> bool:
+        return self.decoder.is_direct_completion()
+
+
+def run_codegen_calls(calls):
+    """Drives a generator that yields (model, method, message, num_samples, prompt_cache)
+    codegen calls and receives their trajs. Returns the generator's return value.
+    """
+    try:
+        call = next(calls)
+        while True:
+            model, method, message, num_samples, prompt_cache = call
+            call = calls.send(
+                getattr(model, method)(
+                    message, num_samples=num_samples, prompt_cache=prompt_cache
+                )
+            )
+    except StopIteration as done:
+        return done.value
+
+
+def _step(calls, trajs):
+    # StopIteration cannot cross a thread future, so report the return value instead
+    try:
+        return False, calls.send(trajs)
+    except StopIteration as done:
+        return True, done.value
+
+
+async def arun_codegen_calls(calls):
+    """Async variant of run_codegen_calls.
+
+    The codegen calls run on the event loop through the async decoder methods,
+    while the generator's own work between calls runs in worker threads.
+    """
+    finished, call = await asyncio.to_thread(_step, calls, None)
+    while not finished:
+        model, method, message, num_samples, prompt_cache = call
+        trajs = await getattr(model, "a" + method)(
+            message, num_samples=num_samples, prompt_cache=prompt_cache
+        )
+        finished, call = await asyncio.to_thread(_step, calls, trajs)
+    return call
+
+
 def make_model(
     model: str,
     backend: str,
@@ -391,6 +1051,42 @@ def make_model(
     batch_size: int = 1,
     max_tokens: int = 1024,
     temperature: float = 0.0,
+    max_parallel_samples: int = 8,
+    stream_stop_blocks: int = None,
+    instance_id: str = None,
+    base_url: str = None,
+    stream_quiet_chars: int = None,
+):
+    decoder = _make_decoder(
+        model,
+        backend,
+        logger,
+        batch_size,
+        max_tokens,
+        temperature,
+        max_parallel_samples,
+        stream_stop_blocks,
+        base_url,
+        stream_quiet_chars,
+    )
+    decoder.instance_id = instance_id
+    cache = get_response_cache()
+    if cache is not None:
+        return CachedDecoder(decoder, cache)
+    return decoder
+
+
+def _make_decoder(
+    model,
+    backend,
+    logger,
+    batch_size,
+    max_tokens,
+    temperature,
+    max_parallel_samples,
+    stream_stop_blocks,
+    base_url,
+    stream_quiet_chars,
 ):
     if backend == "openai":
         return OpenAIChatDecoder(
@@ -399,6 +1095,10 @@ def make_model(
             batch_size=batch_size,
             max_new_tokens=max_tokens,
             temperature=temperature,
+            max_parallel_samples=max_parallel_samples,
+            stream_stop_blocks=stream_stop_blocks,
+            base_url=base_url,
+            stream_quiet_chars=stream_quiet_chars,
         )
     elif backend == "anthropic":
         return AnthropicChatDecoder(
@@ -407,6 +1107,10 @@ def make_model(
             batch_size=batch_size,
             max_new_tokens=max_tokens,
             temperature=temperature,
+            max_parallel_samples=max_parallel_samples,
+            stream_stop_blocks=stream_stop_blocks,
+            base_url=base_url,
+            stream_quiet_chars=stream_quiet_chars,
         )
     elif backend == "deepseek":
         return DeepSeekChatDecoder(
@@ -415,6 +1119,10 @@ def make_model(
             batch_size=batch_size,
             max_new_tokens=max_tokens,
             temperature=temperature,
+            max_parallel_samples=max_parallel_samples,
+            stream_stop_blocks=stream_stop_blocks,
+            base_url=base_url,
+            stream_quiet_chars=stream_quiet_chars,
         )
     else:
         raise NotImplementedError
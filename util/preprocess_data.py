@@ -1,11 +1,14 @@
 import json
 import os
 
-from agentless.util.parse_global_var import parse_global_var_from_code
-from get_repo_structure.get_repo_structure import (
-    get_project_structure_from_scratch,
-    parse_python_file,
+from agentless.util.loc_resolver import LocResolver, get_file_symbols
+from agentless.util.repo_index import (
+    RepoIndex,
+    get_full_file_paths_and_classes_and_functions,
 )
+from agentless.util.scope_tree import get_scope_tree
+from agentless.util.structure_store import open_structure, store_path
+from get_repo_structure.get_repo_structure import get_project_structure_from_scratch
 
 def clean_text(text):
     """
@@ -34,72 +37,60 @@ def line_wrap_content(
     no_line_number=False,
     sticky_scroll=False,
 ):
-    """add n| to each line, where n increases"""
+    """add n| to each line, where n increases
 
-    def is_scope(line):
-        # TODO: this might not be precise, can improve with syntax parsing
-        return line.startswith("class ") or line.strip().startswith("def ")
+    The intervals are rendered in a single walk over the lines. With
+    `sticky_scroll`, the header lines of the scopes enclosing the first line of
+    each interval are shown before it, looked up in the cached scope tree of
+    the content.
+    """
 
     lines = content.split("\n")
-    new_lines = []
+    n_lines = len(lines)
     if context_intervals is None or context_intervals == []:
-        context_intervals = [(0, len(lines))]
+        context_intervals = [(0, n_lines)]
 
-    prev_scopes = []
-    line_format = "{line}"
-    if not no_line_number:
-        line_format = (
-            "{line_number}|{line}" if not add_space else "{line_number}| {line} "
-        )
-    for interval in context_intervals:
-        min_line, max_line = interval
+    def render(start, end):
+        if no_line_number:
+            return lines[start:end]
+        if add_space:
+            return [f"{i + 1}| {lines[i]} " for i in range(start, end)]
+        return [f"{i + 1}|{lines[i]}" for i in range(start, end)]
 
+    scope_tree = get_scope_tree(content) if sticky_scroll else None
+
+    new_lines = []
+    prev_scopes = ()
+    for min_line, max_line in context_intervals:
         if min_line != 0:
             new_lines.append("...")
 
-        scopes = []
-        for i, line in enumerate(lines):
-            if sticky_scroll:
-                # add current line to scope if necessary
-                if is_scope(line):
-                    indent_level = len(line) - len(line.lstrip())
-                    while scopes and scopes[-1]["indent_level"] >= indent_level:
-                        scopes.pop()
-                    scopes.append(
-                        {"line": line, "line_number": i, "indent_level": indent_level}
-                    )
-
-            if min_line != -1 and i < min_line - 1:
-                continue
-            if sticky_scroll and i == min_line - 1:
-                # add scope lines
-                last_scope_line = None
-                for j, scope_line in enumerate(scopes):
-                    # don't repeat previous scopes
-                    if (
-                        len(prev_scopes) > j
-                        and prev_scopes[j]["line_number"] == scope_line["line_number"]
-                    ):
-                        continue
-                    # don't repeat current line
-                    if i == scope_line["line_number"]:
-                        continue
-                    new_lines.append(
-                        line_format.format(
-                            line_number=scope_line["line_number"] + 1,
-                            line=scope_line["line"],
-                        )
-                    )
-                    last_scope_line = scope_line["line_number"]
-                if last_scope_line is not None and last_scope_line < i - 1:
-                    new_lines.append("...")
+        start = max(min_line - 1, 0)
+        if max_line == -1:
+            end = n_lines
+        else:
+            end = min(max(start, max_line - 1) + 1, n_lines)
+
+        if sticky_scroll and 0 <= min_line - 1 < n_lines:
+            # add scope lines
+            last_scope_line = None
+            for j, scope_line in enumerate(scope_tree.enclosing(min_line)):
+                # don't repeat previous scopes
+                if len(prev_scopes) > j and prev_scopes[j] == scope_line:
+                    continue
+                # don't repeat current line
+                if scope_line == min_line:
+                    continue
+                new_lines.extend(render(scope_line - 1, scope_line))
+                last_scope_line = scope_line
+            if last_scope_line is not None and last_scope_line < min_line - 1:
+                new_lines.append("...")
 
-            new_lines.append(line_format.format(line_number=i + 1, line=line))
-            if max_line != -1 and i >= max_line - 1:
-                break
-        prev_scopes = scopes
+        new_lines.extend(render(start, end))
+        if sticky_scroll:
+            prev_scopes = scope_tree.enclosing(end)
 
-    if max_line != len(lines):
+    if max_line != n_lines:
         new_lines.append("...")
 
     return "\n".join(new_lines)
@@ -139,155 +130,21 @@ def transfer_arb_locs_to_locs(
     remove_line=False,
     file_content="",
     verbose=False,
+    repo_index=None,
 ) -> tuple[list, list]:
-    if structure is None:
-        class_info, function_names, file_lines = parse_python_file("", file_content)
-        structure = {}
-        structure[pred_file] = {
-            "classes": class_info,
-            "functions": function_names,
-            "text": file_lines,
-        }
-
-    files, classes, functions = get_full_file_paths_and_classes_and_functions(structure)
-
-    line_loc = []
+    symbols = get_file_symbols(file_content)
+    if repo_index is None:
+        if structure is None:
+            repo_index = symbols.repo_index(pred_file)
+        else:
+            repo_index = RepoIndex(structure)
+
     if isinstance(locs, str):
         # if its a single loc
         locs = [locs]
-    # TODO: parse it in advance
-    global_vars = parse_global_var_from_code(file_content)
-    unrecognized_locs = []
-
-    for model_pred_locs in locs:
-        current_class_name = ""
-        for loc in model_pred_locs.splitlines():
-            # handle cases like "class: MyClass.my_method"
-            if loc.startswith("class: ") and "." not in loc:
-                loc = loc[len("class: ") :].strip()
-                relevant_class = [
-                    clazz
-                    for clazz in classes
-                    if clazz["file"] == pred_file and clazz["name"] == loc
-                ]
-
-                if len(relevant_class) == 0:
-                    unrecognized_locs.append(loc)
-                else:
-                    line_loc.append(
-                        (relevant_class[0]["start_line"], relevant_class[0]["end_line"])
-                    )
-                    current_class_name = loc
-
-            elif loc.startswith("function: ") or "." in loc:
-                full_loc = loc
-                loc = loc.split(":", 1)[-1].strip()
-
-                if "." in loc:
-                    # assume its a method within a class
-                    method_name = loc.split(".")[1]
-                    class_name = loc.split(".")[0]
-
-                    relevant_class = [
-                        clazz
-                        for clazz in classes
-                        if clazz["file"] == pred_file and clazz["name"] == class_name
-                    ]
-                    if len(relevant_class) == 0:
-                        unrecognized_locs.append(loc)
-                    else:
-                        relevant_method = [
-                            method
-                            for method in relevant_class[0]["methods"]
-                            if method["name"] == method_name
-                        ]
-                        if len(relevant_method) == 0:
-                            unrecognized_locs.append(loc)
-                        else:
-                            line_loc.append(
-                                (
-                                    relevant_method[0]["start_line"],
-                                    relevant_method[0]["end_line"],
-                                )
-                            )
-
-                else:
-                    relevant_function = [
-                        function
-                        for function in functions
-                        if function["file"] == pred_file and function["name"] == loc
-                    ]
-                    if len(relevant_function) == 0:
-                        if current_class_name != "":
-                            # check if its a method
-                            relevant_class = [
-                                clazz
-                                for clazz in classes
-                                if clazz["file"] == pred_file
-                                and clazz["name"] == current_class_name
-                            ]
-                            relevant_method = [
-                                method
-                                for method in relevant_class[0]["methods"]
-                                if method["name"] == loc
-                            ]
-                            if len(relevant_method) == 0:
-                                unrecognized_locs.append(loc)
-                            else:
-                                line_loc.append(
-                                    (
-                                        relevant_method[0]["start_line"],
-                                        relevant_method[0]["end_line"],
-                                    )
-                                )
-                        else:
-                            # look for it in any class
-                            relevant_method = []
-                            for clazz in classes:
-                                if clazz["file"] == pred_file:
-                                    relevant_method.extend(
-                                        [
-                                            method
-                                            for method in clazz["methods"]
-                                            if method["name"] == loc
-                                        ]
-                                    )
-
-                            if len(relevant_method) == 1:
-                                line_loc.append(
-                                    (
-                                        relevant_method[0]["start_line"],
-                                        relevant_method[0]["end_line"],
-                                    )
-                                )
-                    else:
-                        line_loc.append(
-                            (
-                                relevant_function[0]["start_line"],
-                                relevant_function[0]["end_line"],
-                            )
-                        )
-            elif loc.startswith("line: "):
-                if remove_line:
-                    # TODO: can recover the corresponding function instead of throwing it away
-                    continue
-                loc = loc[len("line: ") :].strip().split()[0]
-                try:
-                    # line_loc.append(int(loc))
-                    line_loc.append((int(loc), int(loc)))
-                except:
-                    continue
-            elif loc.startswith("variable:"):
-                vars = loc[len("variable:") :].strip().split()
-                for v in vars:
-                    if v in global_vars:
-                        line_loc.append(
-                            (global_vars[v]["start_line"], global_vars[v]["end_line"])
-                        )
-            else:
-                if loc.strip():
-                    unrecognized_locs.append(loc)
-                # assert False
+    line_loc, unrecognized_locs = LocResolver(repo_index, symbols, pred_file).resolve(
+        locs, remove_line
+    )
 
     # Fine-grained-only loc: Remove intervals that are supersets of another.
     if fine_grain_only:
@@ -305,10 +162,7 @@ def transfer_arb_locs_to_locs(
     # TODO: think of strategies to do bunched up lines
     # TODO: e.g., we can have multiple code segments (right now, its just one)
 
-    for file_content in files:
-        if file_content[0] == pred_file:
-            content = file_content[1]
-            break
+    content = repo_index.file_lines.get(pred_file)
 
     if len(line_loc) == 0:
         return [], []
@@ -344,7 +198,10 @@ def transfer_arb_locs_to_locs(
 def check_contains_valid_loc(file_to_locs, structure):
     """checks if the llm generated locations have at least one location valid"""
 
-    file_contents = get_repo_files(structure, list(file_to_locs.keys()))
+    repo_index = RepoIndex(structure)
+    file_contents = get_repo_files(
+        structure, list(file_to_locs.keys()), repo_index=repo_index
+    )
 
     for pred_file, locs in file_to_locs.items():
         line_locs, _ = transfer_arb_locs_to_locs(
@@ -355,6 +212,7 @@ def check_contains_valid_loc(file_to_locs, structure):
             True,  # these parameters do not matter for checking purposes
             False,  # these parameters do not matter for checking purposes
             file_content=file_contents[pred_file] if pred_file in file_contents else "",
+            repo_index=repo_index,
         )
 
         if len(line_locs) > 0:
@@ -462,15 +320,10 @@ def filter_proposed_files(proposed_files, repo_structure):
     filtered_files = []
     for instance_id, files in instance_to_files.items():
         if instance_id in instance_to_structure:
-            repo_files, _, _ = get_full_file_paths_and_classes_and_functions(
-                instance_to_structure[instance_id]
-            )
-            repo_files_set = set(repo_files)
+            repo_index = RepoIndex(instance_to_structure[instance_id])
             valid_files = []
-            for repo_file in repo_files_set:
-                for proposed_file in files:
-                    if proposed_file == repo_file.split("/")[-1]:
-                        valid_files.append(repo_file)
+            for proposed_file in files:
+                valid_files.extend(repo_index.paths_by_basename.get(proposed_file, []))
             if valid_files:
                 filtered_files.append(
                     {"instance_id": instance_id, "files": valid_files}
@@ -498,17 +351,14 @@ def filter_proposed_classes(proposed_classes, repo_structure):
     filtered_classes = []
     for instance_id, classes in instance_to_classes.items():
         if instance_id in instance_to_structure:
-            _, repo_classes, _ = get_full_file_paths_and_classes_and_functions(
-                instance_to_structure[instance_id]
-            )
-            repo_classes_set = {clazz["name"]: clazz["file"] for clazz in repo_classes}
+            repo_index = RepoIndex(instance_to_structure[instance_id])
             valid_classes = []
             for proposed_class in classes:
-                if proposed_class in repo_classes_set:
+                if proposed_class in repo_index.class_files:
                     valid_classes.append(
                         {
                             "name": proposed_class,
-                            "file": repo_classes_set[proposed_class],
+                            "file": repo_index.class_files[proposed_class],
                         }
                     )
             if valid_classes:
@@ -538,20 +388,13 @@ def filter_proposed_methods(proposed_methods, repo_structure):
     filtered_methods = []
     for instance_id, methods in instance_to_methods.items():
         if instance_id in instance_to_structure:
-            _, repo_classes, _ = get_full_file_paths_and_classes_and_functions(
-                instance_to_structure[instance_id]
-            )
+            repo_index = RepoIndex(instance_to_structure[instance_id])
             valid_methods = []
-            for repo_class in repo_classes:
-                for method in methods:
-                    if method in repo_class["methods"]:
-                        valid_methods.append(
-                            {
-                                "class": repo_class["name"],
-                                "method": method,
-                                "file": repo_class["file"],
-                            }
-                        )
+            for method in methods:
+                for file, class_name in repo_index.method_classes.get(method, []):
+                    valid_methods.append(
+                        {"class": class_name, "method": method, "file": file}
+                    )
             if valid_methods:
                 filtered_methods.append(
                     {"instance_id": instance_id, "methods": valid_methods}
@@ -579,19 +422,11 @@ def filter_proposed_functions(proposed_functions, repo_structure):
     filtered_functions = []
     for instance_id, functions in instance_to_functions.items():
         if instance_id in instance_to_structure:
-            _, _, repo_functions = get_full_file_paths_and_classes_and_functions(
-                instance_to_structure[instance_id]
-            )
+            repo_index = RepoIndex(instance_to_structure[instance_id])
             valid_functions = []
-            for repo_function in repo_functions:
-                for function in functions:
-                    if isinstance(
-                        repo_function["name"], dict
-                    ):  # Why are there cases where this is not a dict?
-                        if function == repo_function["name"].get("name", []):
-                            valid_functions.append(
-                                {"function": function, "file": repo_function["file"]}
-                            )
+            for function in functions:
+                for file in repo_index.function_files.get(function, []):
+                    valid_functions.append({"function": function, "file": file})
             if valid_functions:
                 filtered_functions.append(
                     {"instance_id": instance_id, "functions": valid_functions}
@@ -599,78 +434,31 @@ def filter_proposed_functions(proposed_functions, repo_structure):
     return filtered_functions
 
 
-def get_full_file_paths_and_classes_and_functions(structure, current_path=""):
-    """
-    Recursively retrieve all file paths, classes, and functions within a directory structure.
-
-    Arguments:
-    structure -- a dictionary representing the directory structure
-    current_path -- the path accumulated so far, used during recursion (default="")
-
-    Returns:
-    A tuple containing:
-    - files: list of full file paths
-    - classes: list of class details with file paths
-    - functions: list of function details with file paths
-    """
-    files = []
-    classes = []
-    functions = []
-    for name, content in structure.items():
-        if isinstance(content, dict):
-            if (
-                not "functions" in content.keys()
-                and not "classes" in content.keys()
-                and not "text" in content.keys()
-            ) or not len(content.keys()) == 3:
-                # or guards against case where functions and classes are somehow part of the structure.
-                next_path = f"{current_path}/{name}" if current_path else name
-                (
-                    sub_files,
-                    sub_classes,
-                    sub_functions,
-                ) = get_full_file_paths_and_classes_and_functions(content, next_path)
-                files.extend(sub_files)
-                classes.extend(sub_classes)
-                functions.extend(sub_functions)
-            else:
-                next_path = f"{current_path}/{name}" if current_path else name
-                files.append((next_path, content["text"]))
-                if "classes" in content:
-                    for clazz in content["classes"]:
-                        classes.append(
-                            {
-                                "file": next_path,
-                                "name": clazz["name"],
-                                "start_line": clazz["start_line"],
-                                "end_line": clazz["end_line"],
-                                "methods": [
-                                    {
-                                        "name": method["name"],
-                                        "start_line": method["start_line"],
-                                        "end_line": method["end_line"],
-                                    }
-                                    for method in clazz.get("methods", [])
-                                ],
-                            }
-                        )
-                if "functions" in content:
-                    for function in content["functions"]:
-                        function["file"] = next_path
-                        functions.append(function)
-        else:
-            next_path = f"{current_path}/{name}" if current_path else name
-            files.append(next_path)
-    return files, classes, functions
-
-
 PROJECT_FILE_LOC = os.environ.get("PROJECT_FILE_LOC", None)
 
 
-def get_repo_structure(instance_id: str, repo_name, base_commit, playground):
+def get_repo_structure(
+    instance_id: str, repo_name, base_commit, playground, logger=None
+):
 
     if PROJECT_FILE_LOC is not None:
-        with open(PROJECT_FILE_LOC + "/" + instance_id + ".json") as f:
+        path = store_path(PROJECT_FILE_LOC, instance_id)
+        json_path = PROJECT_FILE_LOC + "/" + instance_id + ".json"
+        if os.path.exists(path):
+            # converted with python -m agentless.util.structure_store
+            if not os.path.exists(json_path) or os.path.getmtime(
+                path
+            ) >= os.path.getmtime(json_path):
+                if logger is not None:
+                    logger.info(f"Loading the structure of {instance_id} from {path}")
+                return open_structure(path)
+            if logger is not None:
+                logger.warning(
+                    f"{path} is older than {json_path}, loading the structure from the json"
+                )
+        elif logger is not None:
+            logger.info(f"Loading the structure of {instance_id} from {json_path}")
+        with open(json_path) as f:
             d = json.load(f)
         repo_structure = d["structure"]
     else:
@@ -682,19 +470,14 @@ def get_repo_structure(instance_id: str, repo_name, base_commit, playground):
     return repo_structure
 
 
-def get_repo_files(structure, filepaths: list[str]):
-    files, classes, functions = get_full_file_paths_and_classes_and_functions(structure)
+def get_repo_files(structure, filepaths: list[str], repo_index=None):
+    if repo_index is None:
+        repo_index = RepoIndex(structure)
     file_contents = dict()
     for filepath in filepaths:
-        content = None
-
-        for file_content in files:
-            if file_content[0] == filepath:
-                content = "\n".join(file_content[1])
-                file_contents[filepath] = content
-                break
-
+        content = repo_index.file_text(filepath)
         assert content is not None, "file not found"
+        file_contents[filepath] = content
     return file_contents
 
 
@@ -836,7 +619,62 @@ eight
     print(x)
 
 
+def test_sticky_scroll():
+    content = """
+class A:
+    @property
+    def p(self):
+        return 1
+
+    async def run(
+        self,
+    ):
+        return 2
+""".strip()
+
+    x = line_wrap_content(content, [(9, 9)], sticky_scroll=True)
+    assert x == "...\n1|class A:\n6|    async def run(\n...\n9|        return 2", x
+
+    # files that do not parse fall back to the indentation of their scopes
+    x = line_wrap_content(content + "\n  )", [(9, 9)], sticky_scroll=True)
+    assert x == "...\n1|class A:\n3|    def p(self):\n...\n9|        return 2\n...", x
+
+
+def benchmark_line_wrap_content(n_lines=10000, n_intervals=200, repeat=5):
+    import random
+    import time
+
+    lines = []
+    for i in range(n_lines):
+        if i % 200 == 0:
+            lines.append(f"class Class{i}:")
+        elif i % 20 == 0:
+            lines.append(f"    def method{i}(self):")
+        else:
+            lines.append(f"        value = {i}")
+    content = "\n".join(lines)
+
+    rng = random.Random(0)
+    intervals = []
+    for _ in range(n_intervals):
+        start = rng.randint(1, n_lines)
+        intervals.append((start, min(start + 10, n_lines)))
+    intervals = merge_intervals(intervals)
+
+    for sticky_scroll in [False, True]:
+        start_time = time.time()
+        for _ in range(repeat):
+            line_wrap_content(content, intervals, sticky_scroll=sticky_scroll)
+        elapsed = (time.time() - start_time) / repeat
+        print(
+            f"line_wrap_content: {n_lines} lines, {len(intervals)} intervals, "
+            f"sticky_scroll={sticky_scroll}: {elapsed * 1000:.2f}ms"
+        )
+
+
 if __name__ == "__main__":
     test_merge()
     test_correct_file_paths()
     test_interval_display()
+    test_sticky_scroll()
+    benchmark_line_wrap_content()
@@ -0,0 +1,82 @@
+import re
+from typing import List, Sequence
+
+from agentless.util.api_requests import num_tokens_from_messages
+
+# Shortest prefix Anthropic caches for the Sonnet and Opus models, in tokens
+MIN_CACHEABLE_TOKENS = 1024
+
+# A str.format placeholder such as {problem_statement}
+PLACEHOLDER = re.compile(r"\{[a-zA-Z_]\w*\}")
+
+
+class PlannedPrompt(str):
+    """A prompt that is also split into static `instructions` and a variable `body`.
+
+    It behaves exactly like the full prompt string, so decoders that do not
+    plan their cache simply send it as one message. The Anthropic decoder
+    sends the instructions as a cached system block shared by all instances,
+    followed by the body as the cached per-instance user message. Without
+    instructions the prompt is sent unchanged.
+    """
+
+    def __new__(cls, text: str, body: str, instructions: str):
+        prompt = super().__new__(cls, text)
+        prompt.body = body
+        prompt.instructions = instructions
+        return prompt
+
+
+def min_cacheable_tokens(model: str) -> int:
+    """The shortest prefix, in tokens, that Anthropic caches for `model`."""
+    return 2048 if "haiku" in model else MIN_CACHEABLE_TOKENS
+
+
+def plan_prompt(
+    template: str,
+    static_fields: Sequence[str] = (),
+    min_prefix_tokens: int = MIN_CACHEABLE_TOKENS,
+    **fields,
+) -> PlannedPrompt:
+    """Formats `template` like template.format(**fields).strip() and splits it.
+
+    The static instructions, identical across instances, are the values of
+    `static_fields` followed by the paragraphs after the last paragraph with
+    another placeholder; the body is the rest of the prompt. Moving them into
+    the instructions reorders the prompt, so it is only split when the
+    instructions reach `min_prefix_tokens`, below which they would not be
+    cached anyway.
+    """
+    text = template.format(**fields).strip()
+    variable = [
+        match
+        for match in PLACEHOLDER.finditer(template)
+        if match.group()[1:-1] not in static_fields
+    ]
+    split = template.find("\n\n", variable[-1].end()) if variable else -1
+    if split == -1:
+        return PlannedPrompt(text, text, "")
+    static = [str(fields[name]).strip() for name in static_fields]
+    instructions = "\n\n".join(
+        part for part in static + [template[split:].format(**fields).strip()] if part
+    )
+    tokens = num_tokens_from_messages(instructions, approximate=True)
+    if tokens < min_prefix_tokens:
+        return PlannedPrompt(text, text, "")
+    body_template = template[:split]
+    for name in static_fields:
+        body_template = re.sub(r"\{%s\}\n?" % re.escape(name), "", body_template)
+    body = body_template.format(**fields).strip()
+    return PlannedPrompt(text, body, instructions)
+
+
+def cache_usage(trajs: List[dict]) -> dict:
+    """Sums the prompt cache write and read tokens of an instance's trajs."""
+    return {
+        "cache_creation_tokens": sum(
+            traj.get("usage", {}).get("cache_creation_token", 0) for traj in trajs
+        ),
+        "cache_read_tokens": sum(
+            traj.get("usage", {}).get("cache_read_input_tokens", 0) for traj in trajs
+        ),
+    }
@@ -0,0 +1,155 @@
+import fcntl
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+
+class TokenBucket:
+    """A bucket refilled continuously up to `per_minute` units per minute."""
+
+    def __init__(self, per_minute: float) -> None:
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+
+    def level(self, level: float, last: float, now: float) -> float:
+        return min(self.capacity, level + (now - last) * self.rate)
+
+    def wait_time(self, level: float, amount: float) -> float:
+        # requests larger than the bucket are let through once it is full
+        amount = min(amount, self.capacity)
+        if level >= amount:
+            return 0.0
+        return (amount - level) / self.rate
+
+
+class RateLimiter:
+    """Client-side requests-per-minute and tokens-per-minute limiter.
+
+    The bucket levels live in memory and are shared by all threads. When a
+    `lock_file` is given they are kept in that file instead, guarded by an
+    exclusive `flock`, so every process pointing at the same file shares them.
+    """
+
+    def __init__(
+        self,
+        rpm: Optional[float] = None,
+        tpm: Optional[float] = None,
+        lock_file: Optional[str] = None,
+    ) -> None:
+        self.buckets = {}
+        if rpm:
+            self.buckets["requests"] = TokenBucket(rpm)
+        if tpm:
+            self.buckets["tokens"] = TokenBucket(tpm)
+        self.lock_file = lock_file
+        self._lock = threading.Lock()
+        self._state = self._full_state()
+        self.waits = 0
+        self.total_wait = 0.0
+        self.acquired = 0
+
+    @property
+    def limits_tokens(self) -> bool:
+        return "tokens" in self.buckets
+
+    def _full_state(self) -> Dict[str, float]:
+        state = {name: bucket.capacity for name, bucket in self.buckets.items()}
+        state["updated"] = time.time()
+        return state
+
+    @contextmanager
+    def _shared_state(self):
+        with self._lock:
+            if self.lock_file is None:
+                yield self._state
+                return
+            with open(self.lock_file, "a+") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    content = f.read()
+                    state = json.loads(content) if content else self._full_state()
+                    yield state
+                    f.seek(0)
+                    f.truncate()
+                    f.write(json.dumps(state))
+                    f.flush()
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _try_acquire(self, amounts: Dict[str, float]) -> float:
+        """Take `amounts` from the buckets if all of them allow it, else return the wait."""
+        with self._shared_state() as state:
+            now = time.time()
+            levels = {
+                name: bucket.level(state.get(name, bucket.capacity), state["updated"], now)
+                for name, bucket in self.buckets.items()
+            }
+            wait = max(
+                self.buckets[name].wait_time(levels[name], amount)
+                for name, amount in amounts.items()
+            )
+            if wait == 0.0:
+                for name, amount in amounts.items():
+                    levels[name] -= min(amount, self.buckets[name].capacity)
+            state.update(levels)
+            state["updated"] = now
+            return wait
+
+    def acquire(self, tokens: int = 0) -> float:
+        """Block until one request of `tokens` tokens fits in the limits.
+
+        Returns the number of seconds spent waiting.
+        """
+        amounts = {"requests": 1, "tokens": tokens}
+        amounts = {name: amount for name, amount in amounts.items() if name in self.buckets}
+        if not amounts:
+            return 0.0
+
+        waited = 0.0
+        while True:
+            wait = self._try_acquire(amounts)
+            if wait == 0.0:
+                break
+            time.sleep(wait)
+            waited += wait
+
+        with self._lock:
+            self.acquired += 1
+            if waited:
+                self.waits += 1
+                self.total_wait += waited
+        return waited
+
+    def metrics(self) -> Dict:
+        with self._lock:
+            return {
+                "limits": {name: bucket.capacity for name, bucket in self.buckets.items()},
+                "shared_file": self.lock_file,
+                "acquired": self.acquired,
+                "throttled": self.waits,
+                "total_wait": self.total_wait,
+            }
+
+
+_rate_limiter = RateLimiter()
+
+
+def configure_rate_limiter(
+    rpm: Optional[float] = None,
+    tpm: Optional[float] = None,
+    lock_file: Optional[str] = None,
+) -> RateLimiter:
+    """Install the process-wide limiter used in front of every LLM request."""
+    global _rate_limiter
+    if lock_file is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(lock_file)), exist_ok=True)
+    _rate_limiter = RateLimiter(rpm, tpm, lock_file)
+    return _rate_limiter
+
+
+def get_rate_limiter() -> RateLimiter:
+    return _rate_limiter
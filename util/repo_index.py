@@ -0,0 +1,152 @@
+import hashlib
+import json
+from collections.abc import Mapping
+from typing import Dict, List, Optional, Tuple
+
+
+def get_full_file_paths_and_classes_and_functions(structure, current_path=""):
+    """
+    Recursively retrieve all file paths, classes, and functions within a directory structure.
+
+    Arguments:
+    structure -- a dictionary representing the directory structure
+    current_path -- the path accumulated so far, used during recursion (default="")
+
+    Returns:
+    A tuple containing:
+    - files: list of full file paths
+    - classes: list of class details with file paths
+    - functions: list of function details with file paths
+    """
+    files = []
+    classes = []
+    functions = []
+    for name, content in structure.items():
+        if isinstance(content, Mapping):
+            if (
+                not "functions" in content.keys()
+                and not "classes" in content.keys()
+                and not "text" in content.keys()
+            ) or not len(content.keys()) == 3:
+                # or guards against case where functions and classes are somehow part of the structure.
+                next_path = f"{current_path}/{name}" if current_path else name
+                (
+                    sub_files,
+                    sub_classes,
+                    sub_functions,
+                ) = get_full_file_paths_and_classes_and_functions(content, next_path)
+                files.extend(sub_files)
+                classes.extend(sub_classes)
+                functions.extend(sub_functions)
+            else:
+                next_path = f"{current_path}/{name}" if current_path else name
+                files.append((next_path, content["text"]))
+                if "classes" in content:
+                    for clazz in content["classes"]:
+                        classes.append(
+                            {
+                                "file": next_path,
+                                "name": clazz["name"],
+                                "start_line": clazz["start_line"],
+                                "end_line": clazz["end_line"],
+                                "methods": [
+                                    {
+                                        "name": method["name"],
+                                        "start_line": method["start_line"],
+                                        "end_line": method["end_line"],
+                                    }
+                                    for method in clazz.get("methods", [])
+                                ],
+                            }
+                        )
+                if "functions" in content:
+                    for function in content["functions"]:
+                        function["file"] = next_path
+                        functions.append(function)
+        else:
+            next_path = f"{current_path}/{name}" if current_path else name
+            files.append(next_path)
+    return files, classes, functions
+
+
+def _function_name(function) -> Optional[str]:
+    # some structures store the function's own dict under "name"
+    name = function["name"]
+    if isinstance(name, dict):
+        name = name.get("name")
+    return name if isinstance(name, str) else None
+
+
+class RepoIndex:
+    """Hash maps over a repo structure, flattened once.
+
+    Build it once per instance and pass it to the helpers that take a
+    `repo_index`. Where a lookup can match several entries, the span maps keep
+    the first one, like the linear scans they replace.
+    """
+
+    def __init__(self, structure: dict) -> None:
+        (
+            self.files,
+            self.classes,
+            self.functions,
+        ) = get_full_file_paths_and_classes_and_functions(structure)
+
+        # path -> list of lines
+        self.file_lines: Dict[str, list] = {}
+        # file name -> full paths
+        self.paths_by_basename: Dict[str, List[str]] = {}
+        for entry in self.files:
+            path = entry[0] if isinstance(entry, tuple) else entry
+            if isinstance(entry, tuple):
+                self.file_lines.setdefault(path, entry[1])
+            self.paths_by_basename.setdefault(path.split("/")[-1], []).append(path)
+
+        # (file, class) -> (start_line, end_line)
+        self.class_spans: Dict[Tuple[str, str], Tuple[int, int]] = {}
+        # (file, class, method) -> (start_line, end_line)
+        self.method_spans: Dict[Tuple[str, str, str], Tuple[int, int]] = {}
+        # (file, method) -> spans of that method in every class of the file
+        self.file_method_spans: Dict[Tuple[str, str], List[Tuple[int, int]]] = {}
+        # class -> file of its last definition
+        self.class_files: Dict[str, str] = {}
+        # method -> (file, class) of every class defining it
+        self.method_classes: Dict[str, List[Tuple[str, str]]] = {}
+        for clazz in self.classes:
+            file, name = clazz["file"], clazz["name"]
+            self.class_files[name] = file
+            first = (file, name) not in self.class_spans
+            if first:
+                span = (clazz["start_line"], clazz["end_line"])
+                self.class_spans[(file, name)] = span
+            for method in clazz["methods"]:
+                span = (method["start_line"], method["end_line"])
+                if first:
+                    self.method_spans.setdefault((file, name, method["name"]), span)
+                self.file_method_spans.setdefault((file, method["name"]), []).append(
+                    span
+                )
+                self.method_classes.setdefault(method["name"], []).append((file, name))
+
+        # (file, function) -> (start_line, end_line)
+        self.function_spans: Dict[Tuple[str, str], Tuple[int, int]] = {}
+        # function -> files defining it
+        self.function_files: Dict[str, List[str]] = {}
+        for function in self.functions:
+            name = _function_name(function)
+            if name is None:
+                continue
+            self.function_spans.setdefault(
+                (function["file"], name), (function["start_line"], function["end_line"])
+            )
+            self.function_files.setdefault(name, []).append(function["file"])
+
+    def file_text(self, path: str) -> Optional[str]:
+        lines = self.file_lines.get(path)
+        return None if lines is None else "\n".join(lines)
+
+
+def structure_digest(structure: dict) -> str:
+    """sha256 of the structure's content, recorded in the structure stores."""
+    encoded = json.dumps(structure, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
@@ -0,0 +1,147 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional
+
+
+class ReplayMissError(Exception):
+    """Raised in replay mode when a request has no recorded response."""
+
+
+def request_key(request: Dict) -> str:
+    """Content address of a request: the sha256 of its canonical JSON form."""
+    encoded = json.dumps(request, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """SQLite-backed store of decoder trajectories keyed by request hash.
+
+    Entries are evicted least-recently-used first once the stored responses
+    exceed `max_bytes`. In replay mode the cache is never written and a miss
+    raises ReplayMissError instead of reaching the API.
+    """
+
+    def __init__(
+        self, path: str, max_bytes: Optional[int] = None, replay: bool = False
+    ) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.replay = replay
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        if replay:
+            self.conn = sqlite3.connect(
+                f"file:{path}?mode=ro", uri=True, check_same_thread=False
+            )
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    trajs TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    last_used REAL NOT NULL
+                )"""
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)"
+            )
+            self.conn.commit()
+
+    def get(self, key: str) -> Optional[List[dict]]:
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT trajs FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                if self.replay:
+                    raise ReplayMissError(f"No recorded response for request {key}")
+                return None
+            self.hits += 1
+            if not self.replay:
+                self.conn.execute(
+                    "UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key)
+                )
+                self.conn.commit()
+            return json.loads(row[0])
+
+    def put(self, key: str, trajs: List[dict]) -> None:
+        if self.replay:
+            return
+        encoded = json.dumps(trajs)
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, trajs, size, last_used) VALUES (?, ?, ?, ?)",
+                (key, encoded, len(encoded), time.time()),
+            )
+            self._evict()
+            self.conn.commit()
+
+    def _evict(self) -> None:
+        if self.max_bytes is None:
+            return
+        (total,) = self.conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()
+        if total <= self.max_bytes:
+            return
+        rows = self.conn.execute(
+            "SELECT key, size FROM responses ORDER BY last_used"
+        ).fetchall()
+        evicted = []
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            evicted.append((key,))
+            total -= size
+        self.conn.executemany("DELETE FROM responses WHERE key = ?", evicted)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            (entries, size) = self.conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+            return {
+                "path": self.path,
+                "replay": self.replay,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": entries,
+                "size_bytes": size,
+                "max_bytes": self.max_bytes,
+            }
+
+    def close(self) -> None:
+        with self._lock:
+            self.conn.close()
+
+
+_response_cache: Optional[ResponseCache] = None
+
+
+def configure_response_cache(
+    path: Optional[str], max_size_mb: Optional[float] = None, replay: bool = False
+) -> Optional[ResponseCache]:
+    """Install the process-wide response cache used by make_model (None disables it)."""
+    global _response_cache
+    if path is None:
+        assert not replay, "Replay mode requires a response cache"
+        _response_cache = None
+    else:
+        max_bytes = int(max_size_mb * 1024 * 1024) if max_size_mb else None
+        _response_cache = ResponseCache(path, max_bytes, replay)
+    return _response_cache
+
+
+def get_response_cache() -> Optional[ResponseCache]:
+    return _response_cache
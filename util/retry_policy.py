@@ -0,0 +1,267 @@
+import asyncio
+import random
+import re
+import threading
+import time
+from bisect import bisect_left
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Callable, Dict, Optional
+
+# Default global deadline (seconds) for one request, all attempts included
+DEFAULT_DEADLINE = 1800.0
+
+
+class RetryPolicy:
+    """Decorrelated-jitter exponential backoff bounded by a global deadline."""
+
+    def __init__(
+        self,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0,
+        max_retries: int = 40,
+        deadline: float = DEFAULT_DEADLINE,
+    ) -> None:
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retries = max_retries
+        self.deadline = deadline
+
+    def backoff(self, previous_delay: float) -> float:
+        # decorrelated jitter: sleep = min(cap, random(base, previous * 3))
+        upper = max(self.base_delay, previous_delay * 3)
+        return min(self.max_delay, random.uniform(self.base_delay, upper))
+
+
+def _parse_duration(value: str) -> Optional[float]:
+    # OpenAI reset headers look like "1s", "6m0s" or "20ms"
+    units = {"h": 3600.0, "m": 60.0, "s": 1.0, "ms": 0.001}
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value)
+    if not parts:
+        return None
+    return sum(float(amount) * units[unit] for amount, unit in parts)
+
+
+def _seconds_until(value: str) -> Optional[float]:
+    try:
+        reset_at = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        try:
+            reset_at = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+    if reset_at.tzinfo is None:
+        reset_at = reset_at.replace(tzinfo=timezone.utc)
+    return max((reset_at - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+def retry_after_seconds(error: Exception) -> Optional[float]:
+    """Return how long the server asked us to wait, if the error response says so."""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    if headers.get("retry-after"):
+        try:
+            return float(headers["retry-after"])
+        except ValueError:
+            seconds = _seconds_until(headers["retry-after"])
+            if seconds is not None:
+                return seconds
+    for key in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens"):
+        if headers.get(key):
+            seconds = _parse_duration(headers[key])
+            if seconds is not None:
+                return seconds
+    for key in (
+        "anthropic-ratelimit-requests-reset",
+        "anthropic-ratelimit-tokens-reset",
+        "anthropic-ratelimit-input-tokens-reset",
+        "anthropic-ratelimit-output-tokens-reset",
+    ):
+        if headers.get(key):
+            seconds = _seconds_until(headers[key])
+            if seconds is not None:
+                return seconds
+    return None
+
+
+# Upper bounds in seconds of the attempt latency histogram buckets, 25% apart
+LATENCY_BUCKETS = tuple(0.01 * 1.25**i for i in range(64))
+
+
+class LatencyHistogram:
+    """Latency counters in fixed buckets, so memory does not grow with the number of
+    observations; the percentiles are the upper bounds of their buckets (at most 25%
+    above the exact value). Not thread-safe, callers hold their own lock.
+    """
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def record(self, latency: float) -> None:
+        self.count += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+        self.buckets[bisect_left(LATENCY_BUCKETS, latency)] += 1
+
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, quantile: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = min(int(self.count * quantile), self.count - 1) + 1
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank:
+                if index == len(LATENCY_BUCKETS):
+                    break
+                return min(LATENCY_BUCKETS[index], self.max)
+        return self.max
+
+
+class AttemptMetrics:
+    """Thread-safe per-attempt latency and outcome counters, grouped by backend.
+
+    Latencies are kept in a LatencyHistogram.
+    """
+
+    def __init__(self) -> None:
+        self._backends: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    def record(self, backend: str, latency: float, outcome: str) -> None:
+        with self._lock:
+            counters = self._backends.get(backend)
+            if counters is None:
+                counters = self._backends[backend] = {
+                    "outcomes": {},
+                    "latencies": LatencyHistogram(),
+                }
+            counters["outcomes"][outcome] = counters["outcomes"].get(outcome, 0) + 1
+            counters["latencies"].record(latency)
+
+    def summary(self) -> Dict[str, dict]:
+        with self._lock:
+            return {
+                backend: {
+                    "attempts": counters["latencies"].count,
+                    "outcomes": dict(counters["outcomes"]),
+                    "mean_latency": counters["latencies"].mean(),
+                    "p50_latency": counters["latencies"].percentile(0.5),
+                    "p95_latency": counters["latencies"].percentile(0.95),
+                    "max_latency": counters["latencies"].max,
+                }
+                for backend, counters in self._backends.items()
+            }
+
+
+attempt_metrics = AttemptMetrics()
+
+
+def _wait_before_retry(e, attempt, latency, logger, backend, policy, deadline, delay):
+    """Records a failed attempt and returns (wait, next delay); wait is None to give up."""
+    attempt_metrics.record(backend, latency, type(e).__name__)
+    logger.info(
+        f"{backend} attempt {attempt} failed after {latency:.2f}s: {type(e).__name__}"
+    )
+    logger.info(e)
+
+    remaining = deadline - time.time()
+    delay = policy.backoff(delay)
+    retry_after = retry_after_seconds(e)
+    wait = retry_after if retry_after is not None else delay
+    if wait >= remaining:
+        logger.warning(f"{backend} request deadline exceeded, giving up")
+        return None, delay
+    print(f"{type(e).__name__}. Waiting {wait:.1f}s...")
+    logger.info(f"Waiting {wait:.1f}s before retrying")
+    return wait, delay
+
+
+def _record_success(logger, backend, attempt, latency):
+    attempt_metrics.record(backend, latency, "ok")
+    logger.info(f"{backend} attempt {attempt} succeeded in {latency:.2f}s")
+
+
+def call_with_retries(
+    request_fn: Callable,
+    logger,
+    backend: str,
+    policy: RetryPolicy,
+    is_fatal: Callable[[Exception], bool] = lambda e: False,
+):
+    """Call `request_fn` until it succeeds, a fatal error is raised or the policy gives up.
+
+    Returns the response, or None once the retries or the deadline are exhausted.
+    Fatal errors are re-raised to the caller.
+    """
+    deadline = time.time() + policy.deadline
+    delay = policy.base_delay
+
+    for attempt in range(1, policy.max_retries + 1):
+        start_time = time.time()
+        try:
+            ret = request_fn()
+        except Exception as e:
+            if is_fatal(e):
+                attempt_metrics.record(backend, time.time() - start_time, type(e).__name__)
+                raise
+            wait, delay = _wait_before_retry(
+                e, attempt, time.time() - start_time, logger, backend, policy, deadline, delay
+            )
+            if wait is None:
+                return None
+            time.sleep(wait)
+            continue
+
+        _record_success(logger, backend, attempt, time.time() - start_time)
+        return ret
+
+    logger.warning(f"{backend} request failed after {policy.max_retries} attempts")
+    return None
+
+
+async def acall_with_retries(
+    request_fn: Callable,
+    logger,
+    backend: str,
+    policy: RetryPolicy,
+    is_fatal: Callable[[Exception], bool] = lambda e: False,
+):
+    """Async variant of call_with_retries; `request_fn` returns an awaitable."""
+    deadline = time.time() + policy.deadline
+    delay = policy.base_delay
+
+    for attempt in range(1, policy.max_retries + 1):
+        start_time = time.time()
+        try:
+            ret = await request_fn()
+        except Exception as e:
+            if is_fatal(e):
+                attempt_metrics.record(backend, time.time() - start_time, type(e).__name__)
+                raise
+            wait, delay = _wait_before_retry(
+                e, attempt, time.time() - start_time, logger, backend, policy, deadline, delay
+            )
+            if wait is None:
+                return None
+            await asyncio.sleep(wait)
+            continue
+
+        _record_success(logger, backend, attempt, time.time() - start_time)
+        return ret
+
+    logger.warning(f"{backend} request failed after {policy.max_retries} attempts")
+    return None
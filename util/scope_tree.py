@@ -0,0 +1,115 @@
+import ast
+import hashlib
+import threading
+from bisect import bisect_right
+from collections import OrderedDict
+from typing import List, Tuple
+
+# Number of scope trees kept in memory
+MAX_CACHED_TREES = 512
+
+SCOPE_NODES = (ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef)
+
+
+def _is_scope(line: str) -> bool:
+    return line.startswith("class ") or line.strip().startswith("def ")
+
+
+class ScopeTree:
+    """The scopes enclosing every line of a file.
+
+    The file is split into segments of lines that have the same enclosing
+    scopes, so `enclosing` is a bisection over the segment starts. A scope is
+    identified by its header line, the `class`/`def` line (not its
+    decorators), and spans up to its last line.
+    """
+
+    def __init__(self) -> None:
+        # first line of each segment (1-indexed, ascending) and its scopes
+        self._starts: List[int] = [1]
+        self._chains: List[Tuple[int, ...]] = [()]
+
+    def _add_segment(self, start: int, chain: Tuple[int, ...]) -> None:
+        if self._starts[-1] == start:
+            self._chains[-1] = chain
+        else:
+            self._starts.append(start)
+            self._chains.append(chain)
+
+    @classmethod
+    def from_ast(cls, module: ast.AST) -> "ScopeTree":
+        tree = cls()
+        scopes = sorted(
+            (node.lineno, -node.end_lineno)
+            for node in ast.walk(module)
+            if isinstance(node, SCOPE_NODES)
+        )
+        stack = []  # (header line, last line) of the open scopes
+
+        def close_before(line_number):
+            while stack and stack[-1][1] < line_number:
+                _, end = stack.pop()
+                tree._add_segment(end + 1, tuple(header for header, _ in stack))
+
+        for header, neg_end in scopes:
+            close_before(header)
+            stack.append((header, -neg_end))
+            tree._add_segment(header, tuple(header for header, _ in stack))
+        close_before(float("inf"))
+        return tree
+
+    @classmethod
+    def from_indentation(cls, lines: List[str]) -> "ScopeTree":
+        """Guesses the scopes from `class `/`def ` lines and their indentation.
+
+        A scope stays open until a scope line at the same or a lower indentation.
+        """
+        tree = cls()
+        stack = []  # (header line, indent level) of the open scopes
+        for line_number, line in enumerate(lines, 1):
+            if _is_scope(line):
+                indent_level = len(line) - len(line.lstrip())
+                while stack and stack[-1][1] >= indent_level:
+                    stack.pop()
+                stack.append((line_number, indent_level))
+                tree._add_segment(line_number, tuple(header for header, _ in stack))
+        return tree
+
+    def enclosing(self, line_number: int) -> Tuple[int, ...]:
+        """Header lines of the scopes enclosing `line_number`, outermost first.
+
+        A scope encloses its own header line.
+        """
+        index = bisect_right(self._starts, line_number) - 1
+        return self._chains[index] if index >= 0 else ()
+
+
+def build_scope_tree(content: str) -> ScopeTree:
+    """The scope tree of `content`, guessed from indentation if it does not parse."""
+    # ast also breaks lines at a lone "\r", which line_wrap_content does not
+    if "\r" not in content.replace("\r\n", ""):
+        try:
+            return ScopeTree.from_ast(ast.parse(content))
+        except (SyntaxError, ValueError):
+            pass
+    return ScopeTree.from_indentation(content.split("\n"))
+
+
+_trees: "OrderedDict[str, ScopeTree]" = OrderedDict()
+_trees_lock = threading.Lock()
+
+
+def get_scope_tree(content: str) -> ScopeTree:
+    """The ScopeTree of `content`, shared per content hash across the process."""
+    key = hashlib.sha256(content.encode("utf-8")).hexdigest()
+    with _trees_lock:
+        tree = _trees.get(key)
+        if tree is not None:
+            _trees.move_to_end(key)
+            return tree
+    tree = build_scope_tree(content)
+    with _trees_lock:
+        tree = _trees.setdefault(key, tree)
+        while len(_trees) > MAX_CACHED_TREES:
+            _trees.popitem(last=False)
+    return tree
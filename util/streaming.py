@@ -0,0 +1,68 @@
+import re
+
+# A closed ```python ... ``` fence, as matched by extract_python_blocks
+PYTHON_BLOCK = re.compile(r"```python\n(.*?)\n```", re.DOTALL)
+# Markers of the edit formats used by the repair prompts
+EDIT_MARKERS = ("edit_file(", ">>>>>>> REPLACE")
+
+
+class EditBlockWatcher:
+    """Accumulates a streamed completion and detects when its edit blocks are over.
+
+    A block counts once its closing fence has arrived and it holds an
+    `edit_file` command or a complete SEARCH/REPLACE edit, so plain code
+    snippets in the reasoning do not stop the stream. The stream can stop as
+    soon as `stop_after_blocks` blocks are closed.
+
+    With `quiet_chars`, `stop_after_blocks` is only a minimum: the stream then
+    stops once `quiet_chars` characters arrive after the last block without a
+    new fence. This can cut off an answer that explains its next edit at
+    length before writing it, so it is off by default.
+    """
+
+    def __init__(self, stop_after_blocks: int, quiet_chars: int = None) -> None:
+        self.stop_after_blocks = stop_after_blocks
+        self.quiet_chars = quiet_chars
+        self.chunks = []
+        self.blocks = 0
+        self._text = ""
+        self._length = 0
+        self._scan_from = 0
+        self._fence_after_blocks = False
+
+    @property
+    def text(self) -> str:
+        if self.chunks:
+            self._text += "".join(self.chunks)
+            self.chunks = []
+        return self._text
+
+    @property
+    def done(self) -> bool:
+        if self.blocks < self.stop_after_blocks:
+            return False
+        if self.quiet_chars is None:
+            return True
+        return (
+            not self._fence_after_blocks
+            and self._length - self._scan_from >= self.quiet_chars
+        )
+
+    def feed(self, delta: str) -> bool:
+        """Adds a chunk of the completion; returns True once the stream can stop."""
+        self.chunks.append(delta)
+        self._length += len(delta)
+        if "`" not in delta:
+            # only a fence can close a block or open a new one
+            return self.done
+        text = self.text
+        for match in PYTHON_BLOCK.finditer(text, self._scan_from):
+            self._scan_from = match.end()
+            if any(marker in match.group(1) for marker in EDIT_MARKERS):
+                self.blocks += 1
+        self._fence_after_blocks = "```" in text[self._scan_from :]
+        return self.done
+
+    def result(self) -> str:
+        """Everything received, including any text after the last closed block."""
+        return self.text
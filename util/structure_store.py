@@ -0,0 +1,305 @@
+import argparse
+import json
+import mmap
+import os
+import struct
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping, Sequence
+from typing import Dict, Optional, Tuple
+
+from agentless.util.repo_index import structure_digest
+
+# <magic> <header length> <header json> <blobs>
+MAGIC = b"AGSTRUCT"
+HEADER_LENGTH = struct.Struct("<Q")
+VERSION = 1
+STORE_SUFFIX = ".struct"
+# Key marking a file entry in the header tree:
+# [spans offset, spans length, text offset, text length, line count]
+FILE_KEY = "__file__"
+
+# Budget of decoded blobs shared by all threads, measured in encoded bytes
+MAX_CACHED_BYTES = 256 * 1024 * 1024
+# Number of store files kept open
+MAX_OPEN_STORES = 64
+
+
+def _copy_json(value):
+    """A deep copy of decoded JSON, much faster than copy.deepcopy."""
+    if isinstance(value, dict):
+        return {key: _copy_json(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_copy_json(item) for item in value]
+    return value
+
+
+def _is_file_entry(content) -> bool:
+    # same test as get_full_file_paths_and_classes_and_functions
+    return isinstance(content, dict) and (
+        ("functions" in content or "classes" in content or "text" in content)
+        and len(content) == 3
+    )
+
+
+def write_structure_store(structure: dict, path: str) -> None:
+    """Writes `structure` in the offset-indexed format read by StructureStore.
+
+    Class and function spans and file texts are stored as separate JSON blobs
+    so either can be decoded without the other.
+    """
+    blobs = []
+    offset = 0
+
+    def _add(value) -> Tuple[int, int]:
+        nonlocal offset
+        blob = json.dumps(value).encode("utf-8")
+        blobs.append(blob)
+        offset += len(blob)
+        return offset - len(blob), len(blob)
+
+    def _tree(node: dict) -> dict:
+        tree = {}
+        for name, content in node.items():
+            if _is_file_entry(content):
+                spans = {key: content[key] for key in content if key != "text"}
+                text = content.get("text", [])
+                tree[name] = {FILE_KEY: [*_add(spans), *_add(text), len(text)]}
+            elif isinstance(content, dict):
+                tree[name] = _tree(content)
+            else:
+                tree[name] = content
+        return tree
+
+    header = json.dumps(
+        {
+            "version": VERSION,
+            "digest": structure_digest(structure),
+            "tree": _tree(structure),
+        }
+    ).encode("utf-8")
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(HEADER_LENGTH.pack(len(header)))
+        f.write(header)
+        for blob in blobs:
+            f.write(blob)
+    os.replace(tmp_path, path)
+
+
+class _ViewCache:
+    """Process-wide LRU of decoded blobs, keyed by (store path, offset)."""
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._views: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, store: "StructureStore", offset: int, length: int):
+        key = (store.path, offset)
+        with self._lock:
+            if key in self._views:
+                self._views.move_to_end(key)
+                self.hits += 1
+                return self._views[key][0]
+            self.misses += 1
+        value = store.decode(offset, length)
+        with self._lock:
+            if key not in self._views:
+                self._views[key] = (value, length)
+                self.size += length
+                while self.size > self.max_bytes and len(self._views) > 1:
+                    _, (_, evicted) = self._views.popitem(last=False)
+                    self.size -= evicted
+        return value
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "views": len(self._views),
+                "size_bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+_view_cache = _ViewCache(MAX_CACHED_BYTES)
+
+
+class LazyLines(Sequence):
+    """The lines of a file, decoded on first access; the length is known upfront."""
+
+    def __init__(self, store: "StructureStore", offset: int, length: int, count: int):
+        self._store = store
+        self._offset = offset
+        self._length = length
+        self._count = count
+
+    def _lines(self) -> list:
+        return _view_cache.get(self._store, self._offset, self._length)
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __getitem__(self, index):
+        return self._lines()[index]
+
+    def __iter__(self):
+        return iter(self._lines())
+
+
+class LazyFile(Mapping):
+    """A read-only file entry whose spans and text are decoded on access."""
+
+    def __init__(self, store: "StructureStore", entry: list) -> None:
+        self._store = store
+        self._spans = entry[:2]
+        self._text = LazyLines(store, *entry[2:])
+
+    def _span_info(self) -> dict:
+        return _view_cache.get(self._store, *self._spans)
+
+    def __getitem__(self, key):
+        if key == "text":
+            return self._text
+        # the decoded spans are shared through the view cache, so callers get a copy
+        return _copy_json(self._span_info()[key])
+
+    def __iter__(self):
+        yield from self._span_info()
+        yield "text"
+
+    def __len__(self) -> int:
+        return len(self._span_info()) + 1
+
+
+class LazyStructure(dict):
+    """A repo structure backed by a StructureStore.
+
+    Directories are plain dicts and files are LazyFile mappings. `digest`
+    is the structure_digest of the structure the store was written from.
+    """
+
+    def __init__(self, tree: dict, digest: str) -> None:
+        super().__init__(tree)
+        self.digest = digest
+
+
+class StructureStore:
+    """A memory-mapped structure file written by write_structure_store."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        assert self._mmap[: len(MAGIC)] == MAGIC, f"{path} is not a structure store"
+        start = len(MAGIC) + HEADER_LENGTH.size
+        (header_length,) = HEADER_LENGTH.unpack(self._mmap[len(MAGIC) : start])
+        header = json.loads(self._mmap[start : start + header_length])
+        assert header["version"] == VERSION, f"unsupported store version {header}"
+        self._data_start = start + header_length
+        self.digest = header["digest"]
+        self._tree = self._lazy_tree(header["tree"])
+
+    @property
+    def structure(self) -> LazyStructure:
+        """A new structure on every access, so callers may filter it in place.
+
+        Its directories are copied; the read-only LazyFile entries are shared.
+        """
+        return LazyStructure(_copy_tree(self._tree), self.digest)
+
+    def _lazy_tree(self, tree: dict) -> dict:
+        node = {}
+        for name, content in tree.items():
+            if isinstance(content, dict) and FILE_KEY in content:
+                node[name] = LazyFile(self, content[FILE_KEY])
+            elif isinstance(content, dict):
+                node[name] = self._lazy_tree(content)
+            else:
+                node[name] = content
+        return node
+
+    def decode(self, offset: int, length: int):
+        start = self._data_start + offset
+        return json.loads(self._mmap[start : start + length])
+
+
+def _copy_tree(tree: dict) -> dict:
+    return {
+        name: _copy_tree(content) if isinstance(content, dict) else content
+        for name, content in tree.items()
+    }
+
+
+_stores: "OrderedDict[str, StructureStore]" = OrderedDict()
+_stores_lock = threading.Lock()
+
+
+def open_structure(path: str) -> LazyStructure:
+    """The lazy structure of the store at `path`, a new copy on every call.
+
+    The store itself is opened once and shared process-wide.
+    """
+    with _stores_lock:
+        store = _stores.get(path)
+        if store is not None:
+            _stores.move_to_end(path)
+            return store.structure
+    store = StructureStore(path)
+    with _stores_lock:
+        store = _stores.setdefault(path, store)
+        while len(_stores) > MAX_OPEN_STORES:
+            _stores.popitem(last=False)
+    return store.structure
+
+
+def store_path(project_file_loc: str, instance_id: str) -> str:
+    return os.path.join(project_file_loc, instance_id + STORE_SUFFIX)
+
+
+def structure_store_stats() -> Dict:
+    with _stores_lock:
+        open_stores = len(_stores)
+    return {"open_stores": open_stores, **_view_cache.stats()}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--project_file_loc",
+        type=str,
+        default=os.environ.get("PROJECT_FILE_LOC"),
+        help="Folder of <instance_id>.json structures to convert.",
+    )
+    parser.add_argument("--overwrite", action="store_true")
+    args = parser.parse_args()
+    assert args.project_file_loc, "--project_file_loc or PROJECT_FILE_LOC is required"
+
+    converted = 0
+    for name in sorted(os.listdir(args.project_file_loc)):
+        if not name.endswith(".json"):
+            continue
+        instance_id = name[: -len(".json")]
+        path = store_path(args.project_file_loc, instance_id)
+        json_path = os.path.join(args.project_file_loc, name)
+        if (
+            os.path.exists(path)
+            and not args.overwrite
+            and os.path.getmtime(path) >= os.path.getmtime(json_path)
+        ):
+            continue
+        with open(json_path) as f:
+            d = json.load(f)
+        write_structure_store(d["structure"], path)
+        converted += 1
+    print(f"Converted {converted} structures in {args.project_file_loc}")
+
+
+if __name__ == "__main__":
+    main()